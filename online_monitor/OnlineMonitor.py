@@ -1,5 +1,7 @@
 import sys
+import time
 import logging
+import multiprocessing
 
 from PyQt6 import QtWidgets, QtCore
 import pyqtgraph as pg
@@ -7,20 +9,45 @@ from pyqtgraph.dockarea import DockArea, Dock
 
 from online_monitor.utils import utils, settings
 from online_monitor.receiver.receiver import Receiver
+from online_monitor.receiver.receive_engine import ReceiveEngine
+from online_monitor.receiver.refresh_controller import RefreshController
+
+
+def get_windows(configuration):
+    ''' Names of the additional windows set for receivers with the window
+        option; receivers without window are shown in the main window
+    '''
+    receivers = configuration.get('receiver') or {}
+    return sorted(set(receiver_settings['window'] for receiver_settings in receivers.values()
+                      if receiver_settings.get('window') is not None))
 
 
 class OnlineMonitorApplication(QtWidgets.QMainWindow):
     app_name = 'Online Monitor'
 
-    def __init__(self, config_file, loglevel='INFO'):
+    def __init__(self, config_file, loglevel='INFO', window=None):
         super(OnlineMonitorApplication, self).__init__()
         utils.setup_logging(loglevel)
         logging.debug("Initialize online monitor with configuration in %s", config_file)
         self.configuration = utils.parse_config_file(config_file, expect_receiver=True)
+        # Only show the receivers of this window, the other windows run in
+        # their own processes (see start_windows())
+        self.window = window
+        if self.configuration.get('receiver'):
+            self.configuration['receiver'] = {name: receiver_settings for name, receiver_settings in self.configuration['receiver'].items()
+                                              if receiver_settings.get('window') == window}
         self.setup_style()
         self.setup_widgets()
+        # One context and receive thread for all receivers
+        self.receive_engine = ReceiveEngine()
         self.receivers = self.start_receivers()
+        # Only the receiver of the shown tab is active
+        self.on_tab_changed(self.tab_widget.currentIndex())
         self.add_refresh_toolbar()
+        # Update the status tab once per second
+        self.status_timer = QtCore.QTimer()
+        self.status_timer.timeout.connect(self.update_status)
+        self.status_timer.start(1000)
 
     def add_refresh_toolbar(self):
 
@@ -31,7 +58,11 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
         settings_menu.addAction(refresh_toolbar.toggleViewAction())
         refresh_toolbar.addWidget(QtWidgets.QLabel('Receiver refresh rates'))
         refresh_toolbar.addSeparator()
-        
+        # Sets the refresh rates of the receivers in auto mode
+        self.refresh_controller = RefreshController()
+        self.refresh_texts = {}  # actual refresh rate and time per receiver
+        self._n_refreshed, self._last_status_update = {}, time.time()
+
         # Loop over receivers and make widgets
         for recv in self.receivers:
             widget_recv = QtWidgets.QWidget()
@@ -44,11 +75,16 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
             spinbox_recv.setValue(10)
             checkbox_unlock = QtWidgets.QCheckBox('unlocked')
             checkbox_unlock.setToolTip("Unlock refresh rate to match data rate")
+            checkbox_auto = QtWidgets.QCheckBox('auto')
+            checkbox_auto.setToolTip("Adapt refresh rate to the time needed to refresh all receivers; "
+                                     "the shown receiver is preferred")
+            self.refresh_texts[recv.name] = QtWidgets.QLabel()
+            self.refresh_texts[recv.name].setToolTip("Actual refresh rate and time needed to refresh")
 
             # Connections
-            checkbox_unlock.stateChanged.connect(lambda state, spbx=spinbox_recv: spbx.setEnabled(not state))
-            checkbox_unlock.stateChanged.connect(lambda state, r=recv, spbx=spinbox_recv:
-                                                     setattr(r, 'refresh_rate', None if state else spbx.value()))
+            for checkbox in (checkbox_unlock, checkbox_auto):
+                checkbox.stateChanged.connect(lambda _, r=recv, spbx=spinbox_recv, unlock=checkbox_unlock, auto=checkbox_auto:
+                                              self.set_refresh_mode(r, spbx, unlock.isChecked(), auto.isChecked()))
             spinbox_recv.valueChanged.connect(lambda val, r=recv: setattr(r, 'refresh_rate', val))
             
             spinbox_recv.valueChanged.emit(spinbox_recv.value())
@@ -56,17 +92,30 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
             layout_recv.addWidget(label_recv)
             layout_recv.addWidget(spinbox_recv)
             layout_recv.addWidget(checkbox_unlock)
+            layout_recv.addWidget(checkbox_auto)
+            layout_recv.addWidget(self.refresh_texts[recv.name])
             refresh_toolbar.addWidget(widget_recv)
             refresh_toolbar.addSeparator()
 
+    def set_refresh_mode(self, receiver, spinbox, unlocked, auto):
+        ''' Refresh on every data if unlocked, with the rate set by the
+            refresh controller if auto, otherwise with the rate of the spin box
+        '''
+        spinbox.setEnabled(not unlocked and not auto)
+        self.refresh_controller.set_auto(receiver, auto and not unlocked)
+        if unlocked:
+            receiver.refresh_rate = None
+        elif not auto:
+            receiver.refresh_rate = spinbox.value()
+
     def closeEvent(self, event):
         super(OnlineMonitorApplication, self).closeEvent(event)
         self.stop_receivers()
-        settings.set_window_geometry(self.geometry().getRect())
+        settings.set_window_geometry(self.geometry().getRect(), name=self.window)
 
     def setup_style(self):
-        self.setWindowTitle(self.app_name)
-        stored_windows_geometry = settings.get_window_geometry()
+        self.setWindowTitle(self.app_name if self.window is None else '%s - %s' % (self.app_name, self.window))
+        stored_windows_geometry = settings.get_window_geometry(name=self.window)
         if stored_windows_geometry:
             self.setGeometry(QtCore.QRect(*stored_windows_geometry))
         # Fore/Background color
@@ -85,11 +134,12 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
             logging.info('Starting %d receivers', len(self.configuration['receiver']))
             for (receiver_name, receiver_settings) in sorted(self.configuration['receiver'].items()):
                 receiver_settings['name'] = receiver_name
-                receiver = utils.load_receiver(receiver_settings['kind'], base_class_type=Receiver, *(), **receiver_settings)
+                receiver = utils.load_receiver(receiver_settings['kind'], base_class_type=Receiver, *(),
+                                               engine=self.receive_engine, **receiver_settings)
                 receiver.setup_widgets(self.tab_widget, name=receiver_name)
                 receiver.start()
                 receivers.append(receiver)
-            return receivers
+        return receivers
 
     def on_tab_changed(self, value):
         for index, actual_receiver in enumerate(self.receivers, start=1):  # First index is status tab widget
@@ -100,6 +150,7 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
             logging.info('Stopping %d receivers', len(self.receivers))
             for receiver in self.receivers:
                 receiver.shutdown()
+        self.receive_engine.shutdown()
 
     def setup_widgets(self):
         # Main window with Tab widget
@@ -108,7 +159,24 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
         self.setup_status_widget(self.tab_widget)
         self.tab_widget.currentChanged.connect(self.on_tab_changed)
 
+    def update_status(self):
+        # Show the messages lost in transmission, if sequence numbers are send
+        for receiver in self.receivers:
+            if receiver.name in self.lost_texts and receiver.worker.sequence_checker.n_received:
+                self.lost_texts[receiver.name].setText('Lost %d (%1.1f %%)' % (receiver.n_lost, receiver.lost_fraction * 100.))
+        self.refresh_controller.update()
+        # Show the actual refresh rates and times
+        now = time.time()
+        for receiver in self.receivers:
+            n_refreshed = receiver.n_refreshed - self._n_refreshed.get(receiver.name, 0)
+            self._n_refreshed[receiver.name] = receiver.n_refreshed
+            if receiver.refresh_time is not None:
+                self.refresh_texts[receiver.name].setText('%1.1f Hz, %1.1f ms' % (n_refreshed / (now - self._last_status_update),
+                                                                                 receiver.refresh_time * 1e3))
+        self._last_status_update = now
+
     def setup_status_widget(self, parent):  # Visualizes the nodes + their connections + CPU usage
+        self.lost_texts = {}  # status text per receiver, see update_status()
         # Status dock area showing setup
         dock_area = DockArea()
         parent.addTab(dock_area, 'Status')
@@ -129,6 +197,10 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
             text = pg.TextItem('Receiver\n%s' % receiver_name, border='b', fill=(0, 0, 255, 100), anchor=(0.5, 0.5), color=(0, 0, 0, 200))
             text.setPos(0.5, 0.5)
             view.addItem(text)
+            text = pg.TextItem('', anchor=(0.5, 0.5), color=(0, 0, 0, 200))
+            text.setPos(0.5, 0.2)
+            view.addItem(text)
+            self.lost_texts[receiver_name] = text
             # Add corresponding producer info
             try:
                 if self.configuration['converter']:
@@ -199,14 +271,61 @@ class OnlineMonitorApplication(QtWidgets.QMainWindow):
 #                 view.addItem(text)   
 
 
+def run_window(config_file, loglevel, window, exit_event):  # pragma: no cover, cannot be tested in unittests due to qt event loop
+    ''' Show the receivers of one window in this process, until the window
+        is closed or the exit event is set
+    '''
+    app = QtWidgets.QApplication(sys.argv)
+    win = OnlineMonitorApplication(config_file, loglevel=loglevel, window=window)
+    win.show()
+    exit_timer = QtCore.QTimer()
+    exit_timer.timeout.connect(lambda: exit_event.is_set() and win.close())
+    exit_timer.start(200)
+    app.exec()
+
+
+def start_windows(config_file, loglevel='INFO'):
+    ''' Start one process per additional window, thus the receivers of the
+        windows are refreshed in parallel on several cores
+
+        Returns a list of (process, exit event) tuples, see stop_windows()
+    '''
+    # Forking a process with Qt initialized is not safe, start new interpreters
+    context = multiprocessing.get_context('spawn')
+    windows = []
+    for window in get_windows(utils.parse_config_file(config_file)):
+        logging.info('Starting window %s', window)
+        exit_event = context.Event()
+        process = context.Process(target=run_window, args=(config_file, loglevel, window, exit_event),
+                                  name='Window %s' % window)
+        process.start()
+        windows.append((process, exit_event))
+    return windows
+
+
+def stop_windows(windows, timeout=10.):
+    ''' Close the windows started with start_windows() '''
+    # One after another to not write the window geometries to the settings
+    # file at the same time
+    for process, exit_event in windows:
+        exit_event.set()
+        process.join(timeout)
+        if process.is_alive():
+            logging.warning('Window process %s does not close, terminate it', process.name)
+            process.terminate()
+
+
 def main():  # pragma: no cover, cannot be tested in unittests due to qt event loop
     args = utils.parse_arguments()
     utils.setup_logging(args.log)
 
+    windows = start_windows(args.config_file, loglevel=args.log)
     app = QtWidgets.QApplication(sys.argv)
-    win = OnlineMonitorApplication(args.config_file)  # enter remote IP to connect to the other side listening
+    win = OnlineMonitorApplication(args.config_file, loglevel=args.log)  # enter remote IP to connect to the other side listening
     win.show()
-    sys.exit(app.exec())
+    exit_code = app.exec()
+    stop_windows(windows)
+    sys.exit(exit_code)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,250 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import zmq
+import zmq.asyncio
+
+from online_monitor.utils import utils, tracing, shared_memory
+from online_monitor.converter.transceiver import Transceiver, _interpret_in_worker
+
+
+class AsyncTransceiver(Transceiver):
+
+    '''Transceiver running on one asyncio event loop (zmq.asyncio).
+
+    Receiving from the frontends, receiving commands and sending are
+    coroutines of one event loop in the converter process. The received
+    data is deserialized and interpreted in the loop without handing it over
+    to another thread; also handle_command() is called in the loop, thus
+    the converter state needs no locking.
+
+    Usage:
+    Inherit from this class instead of Transceiver and define the same
+    methods:
+        - setup_interpretation()
+        - deserialize_data()
+        - interpret_data()
+        - serialize_data()
+        - handle_command()
+
+    CPU heavy interpretations can be offloaded to an executor to keep
+    receiving meanwhile (see interpret_in_thread and n_workers); the
+    interpreted data is send in the order received.
+
+    Received data is not buffered in the converter: if the interpretation
+    cannot keep up the messages queue up in the frontend sockets and are
+    discarded by ZeroMQ once frontend_hwm is reached. Thus max_buffer,
+    max_buffer_bytes and drop_policy are not used. The shared memory
+    transport (shm:// addresses) is not supported.
+
+    Parameter
+    ----------
+    interpret_in_thread : boolean
+        Interpret the data in a thread. handle_command() can then be called
+        while interpret_data() runs.
+    n_workers : number
+        Number of worker processes interpreting data in parallel (see
+        Transceiver); takes precedence over interpret_in_thread.
+
+    All other parameters are the parameters of the Transceiver.
+    '''
+
+    def __init__(self, frontend, backend, kind, interpret_in_thread=False, **kwarg):
+        self.interpret_in_thread = interpret_in_thread
+        Transceiver.__init__(self, frontend, backend, kind, **kwarg)
+
+    @property
+    def n_dropped(self):
+        ''' Messages are only discarded by ZeroMQ, see frontend_hwm '''
+        return 0
+
+    @property
+    def sampling_factor(self):
+        return 1.
+
+    @property
+    def queue_depth(self):
+        ''' Interpretations in the executor not send yet '''
+        return self._results.qsize() if self.executor else 0
+
+    def _socket_class(self, address):
+        if shared_memory.is_shm_address(address):
+            raise ValueError('Converter %s: shared memory address %s is not supported '
+                             'by asynchronous converters' % (self.name, address))
+        return zmq.asyncio.Socket
+
+    def _setup_transceiver(self):
+        # ignore SIGTERM; signal shutdown() is used for controlled proc. term.
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        self.context = zmq.asyncio.Context()
+        self.frontends = [(address, self._connect_frontend(index, address))
+                          for index, address in enumerate(self.frontend_address)]
+        self.backends = [(address, self._bind_backend(index, address))
+                         for index, address in enumerate(self.backend_address)]
+        # Statistics are published without the event loop
+        self.metrics.setup_socket(zmq.Context.shadow(self.context.underlying))
+
+    def _setup_executor(self):
+        ''' Executor interpreting the data, None to interpret in the loop '''
+        if self.n_workers and self.n_workers > 1 and not self.passthrough:
+            logging.info('Converter %s interprets data with %d workers',
+                         self.name, self.n_workers)
+            return self._start_workers()
+        if self.interpret_in_thread:
+            return ThreadPoolExecutor(1, thread_name_prefix='interpret')
+        return None
+
+    def run(self):  # the event loop run in extra process
+        utils.setup_logging(self.loglevel)
+        asyncio.run(self._run())
+        logging.debug("Close %s transceiver %s at %s", self.kind, self.name,
+                      self.backend_address)
+
+    async def _run(self):
+        self._setup_transceiver()
+        self.setup_interpretation()
+        self._setup_state()
+        self.executor = self._setup_executor()
+        # Interpretations in the executor, send in the order of the input;
+        # receiving waits if too many are pending
+        self._results = asyncio.Queue(maxsize=2 * (self.n_workers or 1))
+        self._sending = []  # send futures of the interpreted data
+
+        coroutines = [self._receive_data(), self._update_statistics()]
+        if self.executor:
+            coroutines.append(self._send_results())
+        if self.backend_socket_type == zmq.DEALER:
+            coroutines.extend(self._receive_commands(actual_backend[1])
+                              for actual_backend in self.backends)
+        tasks = [asyncio.create_task(coroutine) for coroutine in coroutines]
+        for task in tasks:
+            task.add_done_callback(self._log_error)
+
+        logging.debug("Start %s transceiver %s at %s", self.kind, self.name,
+                      self.backend_address)
+        await asyncio.get_running_loop().run_in_executor(None, self.exit.wait)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.executor:
+            self.executor.shutdown(wait=True)
+        self._close_sockets()
+        self.context.term()
+
+    def _log_error(self, task):
+        if not task.cancelled() and task.exception():
+            logging.error('Converter %s stopped working', self.name,
+                          exc_info=task.exception())
+
+    async def _receive_data(self):
+        poller = zmq.asyncio.Poller()
+        for actual_frontend in self.frontends:
+            poller.register(actual_frontend[1], zmq.POLLIN)
+        while True:
+            sockets = dict(await poller.poll())
+            ready_frontends = [actual_frontend for actual_frontend in self.frontends
+                               if actual_frontend[1] in sockets]
+            batch, batch_bytes, batch_trace = [], 0, None
+            # Drain the ready frontends; every iteration takes at most one
+            # message per frontend
+            for _ in range(self.max_drain):
+                received, n_bytes, trace = [], 0, None
+                for actual_frontend in ready_frontends:
+                    try:
+                        frames = await actual_frontend[1].recv_multipart(
+                            flags=zmq.NOBLOCK, copy=False)
+                    except zmq.Again:  # no data
+                        continue
+                    frames, actual_trace, actual_n_bytes = self._split_received(actual_frontend[0], frames)
+                    n_bytes += actual_n_bytes
+                    trace = actual_trace if tracing.is_timed(actual_trace) else trace
+                    received.append((actual_frontend[0], frames))
+                if not received:
+                    break
+                # Skipped messages are not even deserialized
+                if self._skip_paused():
+                    continue
+                raw_data = self._deserialize_received(received)
+                if not raw_data:
+                    continue
+                batch.append(raw_data)
+                batch_bytes += n_bytes
+                batch_trace = trace or batch_trace
+                if len(batch) >= self.batch_size or (self.batch_bytes and batch_bytes >= self.batch_bytes):
+                    await self._interpret(batch, batch_trace)
+                    batch, batch_bytes, batch_trace = [], 0, None
+            if batch:
+                await self._interpret(batch, batch_trace)
+
+    async def _interpret(self, raw_data, trace):
+        raw_data = self._shed_load(raw_data)
+        if not raw_data:
+            return
+        if self.executor is None:
+            with self.metrics.timer('interpret'):
+                data = self.interpret_data_batch(raw_data)
+            await self._send_async(data, trace)
+            return
+        if isinstance(self.executor, ProcessPoolExecutor):
+            result = asyncio.get_running_loop().run_in_executor(self.executor, _interpret_in_worker,
+                                                                raw_data, self.load_level)
+        else:
+            result = asyncio.get_running_loop().run_in_executor(self.executor, self._interpret_timed, raw_data)
+        await self._results.put((result, trace))
+
+    def _interpret_timed(self, raw_data):
+        with self.metrics.timer('interpret'):
+            return self.interpret_data_batch(raw_data)
+
+    async def _send_results(self):
+        ''' Send the interpretations of the executor in the order received '''
+        while True:
+            result, trace = await self._results.get()
+            try:
+                data = await result
+            except BrokenProcessPool:
+                logging.error('Interpretation workers of converter %s stopped working', self.name)
+                self.exit.set()
+                return
+            await self._send_async(data, trace)
+
+    async def _send_async(self, data, trace):
+        self._send_interpreted(data, trace)
+        # Wait until sent, e.g. if the high water mark of a DEALER is reached
+        if self._sending:
+            sending, self._sending = self._sending, []
+            await asyncio.gather(*sending)
+
+    def _send(self, socket, serialized_data):
+        # Multipart data is send without copying the frames
+        if not isinstance(serialized_data, list):
+            serialized_data = [serialized_data]
+        self._sending.append(socket.send_multipart(serialized_data, copy=False))
+
+    async def _receive_commands(self, socket):
+        while True:
+            commands = [await socket.recv_json()]
+            for _ in range(self.max_drain):
+                try:
+                    commands.append(await socket.recv_json(zmq.NOBLOCK))
+                except zmq.Again:
+                    break
+            self._handle_commands(commands)
+
+    async def _update_statistics(self):
+        while True:
+            self._log_dropped()
+            self._update_load()
+            self._publish_metrics()
+            await asyncio.sleep(min(self.metrics.interval, 1.))
+
+    def _close_sockets(self):
+        for actual_frontend in self.frontends:
+            actual_frontend[1].close()
+        for actual_backend in self.backends:
+            actual_backend[1].close()
+        self.metrics.close()
@@ -5,11 +5,16 @@ import sys
 
 from online_monitor.converter.transceiver import Transceiver
 from online_monitor.utils import utils
+from online_monitor.utils.metrics import MetricsView, get_metrics_addresses
 
 
 class ConverterManager(object):
-    def __init__(self, configuration, loglevel='INFO'):
+    def __init__(self, configuration, loglevel='INFO', metrics=False):
+        ''' metrics: show the statistics published by the nodes with a
+            metrics address instead of the CPU load
+        '''
         utils.setup_logging(loglevel)
+        self.metrics = metrics
         logging.info("Initialize converter mananager with configuration in %s", configuration)
         self.configuration = utils.parse_config_file(configuration)
 
@@ -37,9 +42,19 @@ class ConverterManager(object):
             converter.start()
             process_infos.append((converter_name, psutil.Process(converter.ident)))
             converters.append(converter)
+        metrics_view = None
+        if self.metrics:
+            addresses = get_metrics_addresses(self.configuration)
+            if addresses:
+                metrics_view = MetricsView(addresses)
+            else:
+                logging.warning('No metrics addresses defined in config file')
         try:
             while True:
-                self._info_output(process_infos)
+                if metrics_view:
+                    metrics_view.show(sys.stdout)
+                else:
+                    self._info_output(process_infos)
                 time.sleep(1)
         except KeyboardInterrupt:
             logging.info('CRTL-C pressed, shutting down %d converters', len(self.configuration['converter']))
@@ -48,5 +63,7 @@ class ConverterManager(object):
 
         for converter in converters:
             converter.join()
+        if metrics_view:
+            metrics_view.close()
         logging.info('Close converter manager')
 
@@ -3,6 +3,11 @@ from online_monitor.converter.transceiver import Transceiver
 
 class Forwarder(Transceiver):
 
+    def setup_transceiver(self):
+        # A forwarder does not need to look into the data; the received
+        # frames are send without deserialization / serialization
+        self.set_passthrough()
+
     def interpret_data(self, data):
         # A forwarder just forwards data; no interpretation
         return [actual_data[1] for actual_data in data]
@@ -0,0 +1,135 @@
+import logging
+import zmq
+
+from online_monitor.utils import utils, tracing, shared_memory
+from online_monitor.converter.transceiver import Transceiver
+
+
+class Pipeline(Transceiver):
+
+    ''' Chain of converters (stages) running in one process
+
+        The data returned by interpret_data() of a stage is passed directly
+        to interpret_data() of the next stage without serialization. The
+        first stage deserializes the received data, the last stage serializes
+        the data send to the backends. Intermediate stages can publish their
+        data at a tap address; tapped data is send like the data of the
+        backends, with its own sequence numbers, and the topic of the stage.
+
+        Usage:
+
+        converter :
+            DUT0 :
+                kind : pipeline
+                frontend : tcp://127.0.0.1:5500
+                backend : tcp://127.0.0.1:5600
+                stages :
+                    - kind : example_converter
+                      threshold : 8
+                      tap : tcp://127.0.0.1:5601  # optional
+                    - kind : example_histogrammer
+
+        Every stage is configured like a converter, except for the frontend
+        and backend. The stages get the name of the pipeline if no name is
+        given. Later stages receive the data as a list with one
+        (name of the previous stage, data) tuple. If the last stage is
+        bidirectional, received commands are passed to all bidirectional
+        stages.
+    '''
+
+    def setup_transceiver(self):
+        self.stages, self.tap_addresses = [], {}
+        for index, stage_config in enumerate(self.config['stages']):
+            stage_config = dict(stage_config)
+            tap = stage_config.pop('tap', None)
+            if tap and index == len(self.config['stages']) - 1:
+                raise ValueError('The last stage of pipeline %s sends to the backends and cannot have a tap' % self.name)
+            if tap:
+                self.tap_addresses[index] = tap
+            stage_config.setdefault('name', self.name)
+            stage_config.setdefault('wire_format', self.wire_format)
+            stage_config.setdefault('schema_interval', self.schema_interval)
+            stage_config.setdefault('lazy', self.lazy)
+            stage_config.setdefault('codec', self.codec)
+            stage_config.setdefault('codec_threshold', self.codec_threshold)
+            # Stages have no sockets, the backend is only set for clarity
+            stage = utils.load_converter(stage_config['kind'], base_class_type=Transceiver, *(),
+                                         frontend=self.frontend_address, backend=tap or [],
+                                         loglevel=self.loglevel, **stage_config)
+            if stage.passthrough:
+                raise ValueError('Stage %s of pipeline %s is a pass-through converter' % (stage.kind, self.name))
+            self.stages.append(stage)
+        if self.stages[-1].backend_socket_type == zmq.DEALER:
+            self.set_bidirectional_communication()
+        logging.info('Pipeline %s with stages %s', self.name,
+                     ' > '.join(stage.kind for stage in self.stages))
+
+    def _setup_backend(self):
+        Transceiver._setup_backend(self)
+        self.taps = {}  # (address, socket) tuples by stage index
+        for index, address in self.tap_addresses.items():
+            tap = self.context.socket(zmq.PUB, socket_class=shared_memory.socket_class(address))
+            tap.setsockopt(zmq.LINGER, 500)
+            tap.set_hwm(self._socket_setting(self.backend_hwm, 0))
+            tap.bind(address)
+            self.taps[index] = (address, tap)
+
+    def _close_sockets(self):
+        for tap in self.taps.values():
+            tap[1].close()
+        Transceiver._close_sockets(self)
+
+    def setup_interpretation(self):
+        for stage in self.stages:
+            stage.setup_interpretation()
+
+    def set_load_level(self, level):
+        for stage in self.stages:
+            stage.set_load_level(level)
+
+    def deserialize_data(self, data):
+        return self.stages[0].deserialize_data(data)
+
+    def interpret_data_batch(self, data):
+        ''' Pass the data through all stages
+
+            Returns (stage index, data) tuples of the last stage and of the
+            stages with tap.
+        '''
+        interpreted_data = []
+        last_index = len(self.stages) - 1
+        for index, stage in enumerate(self.stages):
+            stage_data = stage.interpret_data_batch(data)
+            if not stage_data:
+                break
+            if index == last_index or index in self.tap_addresses:
+                interpreted_data.extend((index, actual_data) for actual_data in stage_data)
+            data = [[(stage.name, actual_data)] for actual_data in stage_data]
+        return interpreted_data
+
+    def serialize_data(self, data):
+        return self.stages[-1].serialize_data(data)
+
+    def get_topic(self, data):
+        return self.stages[-1].get_topic(data)
+
+    def send_data(self, data):
+        ''' Data of the last stage is send to the backends, data of
+            intermediate stages to their taps
+        '''
+        if self.trace:
+            tracing.stamp(self.trace, self.name, 'send')
+        last_index = len(self.stages) - 1
+        last_stage_data = [actual_data for index, actual_data in data if index == last_index]
+        if last_stage_data:
+            self._send_serialized(self.backends, last_stage_data)
+        for index, actual_data in data:
+            if index == last_index:
+                continue
+            self._send_serialized([self.taps[index]], [actual_data], stream=index,
+                                  converter=self.stages[index])
+
+    def handle_command(self, commands):
+        for stage in self.stages:
+            if stage.backend_socket_type == zmq.DEALER:
+                stage.handle_command(commands)
@@ -3,9 +3,50 @@ import threading
 import zmq
 import logging
 import signal
+import time
 import psutil
 import queue as queue
-from online_monitor.utils import utils
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from online_monitor.utils import utils, tracing, shared_memory, compression
+from online_monitor.utils.data_buffer import DataBuffer
+from online_monitor.utils.metrics import Metrics
+
+# Converter instance of an interpretation worker process
+_worker_converter = None
+
+
+def _setup_worker(converter_class, settings):
+    ''' Create the converter of an interpretation worker process
+
+        Every worker creates its own converter instance of the class of the
+        converter and calls setup_interpretation(), since the converter
+        cannot be pickled.
+    '''
+    global _worker_converter
+    # ignore SIGINT; the converter process terminates the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    utils.setup_logging(settings['loglevel'])
+    _worker_converter = converter_class(*(), **settings)
+    _worker_converter.setup_interpretation()
+
+
+def _check_worker():
+    ''' True if the converter of the worker was created '''
+    return _worker_converter is not None
+
+
+def _interpret_in_worker(data, load_level=0):
+    ''' Interpret the data with the converter of the worker
+
+        The load level of the converter process is passed with the data,
+        thus set_load_level() is also called in the workers.
+    '''
+    if load_level != _worker_converter.load_level:
+        _worker_converter.load_level = load_level
+        _worker_converter.set_load_level(load_level)
+    return _worker_converter.interpret_data_batch(data)
 
 
 class Transceiver(multiprocessing.Process):
@@ -40,12 +81,117 @@ class Transceiver(multiprocessing.Process):
     max_buffer : number
         Maximum messages buffered for interpretation, if exeeded
         data is discarded. If None no limit is applied.
+    max_buffer_bytes : number
+        Maximum size in bytes of the messages buffered for interpretation, if
+        exeeded data is discarded. If None no limit is applied.
+    drop_policy : str
+        Data discarded if the buffer is full: 'oldest', 'newest', 'latest'
+        (only the latest message is buffered) or 'sample' (random sampling
+        with the probability sample_fraction). See utils.DataBuffer.
+    sample_fraction : number
+        Probability to keep a message with the 'sample' drop policy. The
+        resulting sampling factor (received / interpreted messages) is
+        published in the metrics and available as sampling_factor, e.g. to
+        scale rates or histograms in interpret_data().
+    frontend_hwm, backend_hwm : number, list
+        ZeroMQ high water mark of the frontend / backend sockets. Give a list
+        to set the high water mark per socket.
+    wire_format : str
+        Serialization used by the std. serialize_data() method. 'json' sends
+        one json message with base64 encoded arrays, 'multipart' sends a json
+        header frame followed by the raw array buffers without copying,
+        'schema' sends the array dtypes and shapes only once per schema
+        interval and otherwise only the raw array buffers (see
+        utils.SchemaEncoder). Received data is decoded accordingly in any
+        case.
+    schema_interval : number
+        Time in seconds after that the schema is send again with the
+        'schema' wire format, for receivers connecting later
+    lazy : boolean
+        Deserialize the received data lazily with the std.
+        deserialize_data() method: the data is a read only
+        utils.LazyMessage that decodes the arrays on first access. Dropped
+        messages and unused arrays are thus not decoded.
+    codec : str
+        Compression of the arrays send by the std. serialize_data() method:
+        'none', 'blosc-lz4', 'zstd' or 'bitshuffle' (see utils.compression).
+        The codec is stored with every array, thus the receivers decode the
+        data independent of this setting; receivers of older versions
+        cannot decode arrays with codec though. If None the json wire format
+        encodes the arrays as older versions (blosc compressed if blosc is
+        installed), the multipart wire format does not compress to not copy
+        the arrays.
+    codec_threshold : number
+        Arrays smaller than this size in bytes are not compressed
+    batch_size : number
+        Maximum number of queued messages interpreted at once by
+        interpret_data_batch().
+    batch_bytes : number
+        Maximum size in bytes of the messages interpreted at once. If None no
+        limit is applied.
+    n_workers : number
+        Number of worker processes interpreting data in parallel. Every
+        worker has its own converter instance; results are send in the
+        order the data was received. If None the data is interpreted in the
+        converter process. The load level (see set_load_level()) is passed
+        to the workers and paused data (see pause_decimation) is skipped
+        before it reaches them. Commands are only handled in the converter
+        process and do not change the state of the workers! The converter
+        stops with an error if the workers cannot create the converter.
+    target_load : number
+        CPU load in percent of one core of the converter process (including
+        its workers) to keep. If exceeded the load level is increased every
+        second to shed load, if below 80 % of the target the level is
+        decreased again. If None no load shedding is applied.
+    load_shedding : str
+        How to shed load: 'skip' skips the fraction level / (max_load_level
+        + 1) of the messages evenly spaced, thus every level skips about 9 %
+        more; 'reduce' does not skip data and relies on
+        set_load_level() to switch interpret_data() to a cheaper mode.
+        set_load_level() is called on every level change in both cases.
+    metrics : str
+        Address to publish throughput and timing statistics at (see
+        utils.metrics.Metrics). If None no statistics are published.
+    metrics_interval : number
+        Publishing interval of the statistics in seconds
+    sequence : boolean
+        Append a sequence number to every send message (see utils.tracing),
+        to allow the subscribers to detect lost messages. Messages with time
+        stamps for latency tracing always get a sequence number.
+    topics : list of str
+        Topics to subscribe to at the frontends; only messages with a topic
+        starting with one of these are received. If None all messages are
+        received.
+    publish_topics : boolean
+        Send a topic frame (see get_topic()) in front of every message, to
+        allow the subscribers to filter. Pass-through converters forward the
+        received topic frames instead.
+    pause_decimation : number
+        Receivers connected bidirectionally pause the converter while they
+        are not shown (see Receiver pause_upstream). While paused only every
+        n-th received message is interpreted; if None no message is
+        interpreted. Set 1 for converters that have to see all data (e.g.
+        to accumulate histograms). The converter is paused as long as any
+        receiver requests it.
     loglevel : str
         The verbosity level for the logging (e.g. INFO, WARNING)
     '''
 
+    # Maximum messages received from a ready socket before polling again
+    max_drain = 100
+    # Maximum load level for load shedding
+    max_load_level = 10
+
     def __init__(self, frontend, backend, kind, name='Undefined',
-                 max_buffer=None, loglevel='INFO', **kwarg):
+                 max_buffer=None, max_buffer_bytes=None, drop_policy='oldest',
+                 sample_fraction=0.1, frontend_hwm=10, backend_hwm=10,
+                 wire_format='json', schema_interval=1., lazy=False, codec=None,
+                 codec_threshold=compression.MIN_SIZE,
+                 batch_size=1, batch_bytes=None,
+                 n_workers=None, target_load=None, load_shedding='skip',
+                 metrics=None, metrics_interval=1., sequence=False, topics=None,
+                 publish_topics=False, pause_decimation=None, loglevel='INFO',
+                 **kwarg):
         multiprocessing.Process.__init__(self)
 
         self.kind = kind  # kind of transeiver (e.g. forwarder)
@@ -53,16 +199,58 @@ class Transceiver(multiprocessing.Process):
         self.backend_address = backend  # socket facing a data receiver
         # Maximum number of input messages buffered, otherwise data omitted
         self.max_buffer = max_buffer
+        self.max_buffer_bytes = max_buffer_bytes
+        if drop_policy not in DataBuffer.drop_policies:
+            raise ValueError('Unknown drop policy %s' % drop_policy)
+        self.drop_policy = drop_policy
+        self.sample_fraction = sample_fraction
+        # High water marks of the sockets, per socket if given as list
+        self.frontend_hwm = frontend_hwm
+        self.backend_hwm = backend_hwm
+        if wire_format not in ('json', 'multipart', 'schema'):
+            raise ValueError('Unknown wire format %s' % wire_format)
+        self.wire_format = wire_format
+        self.schema_interval = schema_interval
+        self.lazy = lazy
+        self.schema_encoder = utils.SchemaEncoder(interval=schema_interval)
+        if codec is not None:
+            compression.check_codec(codec)
+        self.codec = codec
+        self.codec_threshold = codec_threshold
+        # Maximum messages / bytes taken from the buffer for one interpretation
+        self.batch_size = batch_size
+        self.batch_bytes = batch_bytes
+        # Number of interpretation worker processes
+        self.n_workers = n_workers
+        # Load shedding settings
+        self.target_load = target_load
+        if load_shedding not in ('skip', 'reduce'):
+            raise ValueError('Unknown load shedding %s' % load_shedding)
+        self.load_shedding = load_shedding
+        self.load_level = 0  # 0: no load shedding
+        self.sequence = sequence
+        self.topics = topics
+        self.publish_topics = publish_topics
+        self.pause_decimation = pause_decimation
+        # Throughput and timing statistics
+        self.metrics = Metrics(name=name, kind=kind,
+                               timers=('deserialize', 'interpret', 'serialize'),
+                               address=metrics, interval=metrics_interval)
         self.name = name  # name of the DAQ/device
         # Std. setting is unidirectional frondend communication
         self.frontend_socket_type = zmq.SUB
         # Std. setting is unidirectional backend communication
         self.backend_socket_type = zmq.PUB
+        # Std. setting is to deserialize received and serialize send data
+        self.passthrough = False
 
         if 'max_cpu_load' in kwarg:
             logging.warning('The parameter max_cpu_load is deprecated! Use max_buffer!')
 
         self.config = kwarg
+        # Settings to create the converter again in the worker processes
+        self._settings = dict(frontend=frontend, backend=backend, kind=kind,
+                              name=name, loglevel=loglevel, **kwarg)
 
         # Determine how many frontends/backends the converter has
         # just one frontend socket given
@@ -94,46 +282,97 @@ class Transceiver(multiprocessing.Process):
                      'backend', self.name)
         self.backend_socket_type = zmq.DEALER
 
+    def set_passthrough(self):
+        ''' Received frames are not deserialized and send untouched
+
+            interpret_data() gets the list of received zmq frames as data and
+            has to return lists of frames to be send.
+        '''
+        logging.info('Set pass-through mode for converter %s', self.name)
+        self.passthrough = True
+
     def _setup_frontend(self):
         ''' Receiver sockets facing clients (DAQ systems)
         '''
         self.frontends = []
         self.fe_poller = zmq.Poller()
-        for actual_frontend_address in self.frontend_address:
-            # Subscriber or server socket
+        for index, actual_frontend_address in enumerate(self.frontend_address):
             actual_frontend = (actual_frontend_address,
-                               self.context.socket(self.frontend_socket_type))
-            # Wait 0.5 s before termating socket
-            actual_frontend[1].setsockopt(zmq.LINGER, 500)
-            # Buffer only 10 meassages, then throw data away
-            actual_frontend[1].set_hwm(10)
-            # A suscriber has to set to not filter any data
-            if self.frontend_socket_type == zmq.SUB:
-                actual_frontend[1].setsockopt_string(zmq.SUBSCRIBE, u'')
-            actual_frontend[1].connect(actual_frontend_address)
+                               self._connect_frontend(index, actual_frontend_address))
             self.frontends.append(actual_frontend)
             self.fe_poller.register(actual_frontend[1], zmq.POLLIN)
-        self.raw_data = queue.Queue()
-        self.fe_stop = threading.Event()
+        self.raw_data = DataBuffer(max_items=self.max_buffer,
+                                   max_bytes=self.max_buffer_bytes,
+                                   drop_policy=self.drop_policy,
+                                   sample_fraction=self.sample_fraction)
+        # Wake up signal to stop the blocking receive loop
+        self.fe_wakeup = self._setup_wakeup('fe')
+        self.fe_poller.register(self.fe_wakeup[1], zmq.POLLIN)
 
     def _setup_backend(self):
         ''' Send sockets facing services (e.g. online monitor, other forwarders)
         '''
         self.backends = []
         self.be_poller = zmq.Poller()
-        for actual_backend_address in self.backend_address:
-            # publisher or client socket
+        for index, actual_backend_address in enumerate(self.backend_address):
             actual_backend = (actual_backend_address,
-                              self.context.socket(self.backend_socket_type))
-            # Wait 0.5 s before termating socket
-            actual_backend[1].setsockopt(zmq.LINGER, 500)
-            # Buffer only 100 meassages, then throw data away
-            actual_backend[1].set_hwm(10)
-            actual_backend[1].bind(actual_backend_address)
+                              self._bind_backend(index, actual_backend_address))
             self.backends.append(actual_backend)
-            if self.backend_socket_type != zmq.DEALER:
+            if self.backend_socket_type == zmq.DEALER:
                 self.be_poller.register(actual_backend[1], zmq.POLLIN)
-        self.be_stop = threading.Event()
+        # Wake up signal to stop the blocking command loop
+        self.be_wakeup = self._setup_wakeup('be')
+        self.be_poller.register(self.be_wakeup[1], zmq.POLLIN)
+
+    def _connect_frontend(self, index, address):
+        ''' Subscriber or server socket connected to the frontend address '''
+        socket = self.context.socket(self.frontend_socket_type,
+                                     socket_class=self._socket_class(address))
+        # Wait 0.5 s before termating socket
+        socket.setsockopt(zmq.LINGER, 500)
+        # Buffer only hwm meassages, then throw data away
+        socket.set_hwm(self._socket_setting(self.frontend_hwm, index))
+        # A suscriber has to set to not filter any data
+        if self.frontend_socket_type == zmq.SUB and self.topics is None:
+            socket.setsockopt_string(zmq.SUBSCRIBE, u'')
+        elif self.frontend_socket_type == zmq.SUB:
+            for topic in self.topics:
+                socket.setsockopt(zmq.SUBSCRIBE, utils.topic_frame(topic))
+        socket.connect(address)
+        return socket
+
+    def _bind_backend(self, index, address):
+        ''' Publisher or client socket bound to the backend address '''
+        socket = self.context.socket(self.backend_socket_type,
+                                     socket_class=self._socket_class(address))
+        # Wait 0.5 s before termating socket
+        socket.setsockopt(zmq.LINGER, 500)
+        # Buffer only hwm meassages, then throw data away
+        socket.set_hwm(self._socket_setting(self.backend_hwm, index))
+        socket.bind(address)
+        return socket
+
+    def _socket_class(self, address):
+        return shared_memory.socket_class(address)
+
+    def _socket_setting(self, setting, index):
+        ''' Setting of the socket at index; same for all if not a list '''
+        if isinstance(setting, (list, tuple)):
+            return setting[index]
+        return setting
+
+    def _setup_wakeup(self, name):
+        ''' Connected socket pair to wake up a thread blocking in poll()
+
+            The first socket sends the signal and is used by the main thread,
+            the second socket receives and is used by the polling thread.
+        '''
+        address = 'inproc://%s_wakeup' % name
+        sender = self.context.socket(zmq.PAIR)
+        sender.bind(address)
+        receiver = self.context.socket(zmq.PAIR)
+        receiver.connect(address)
+        return sender, receiver
 
     def _setup_transceiver(self):
         # ignore SIGTERM; signal shutdown() is used for controlled proc. term.
@@ -144,102 +383,442 @@ class Transceiver(multiprocessing.Process):
 
         self._setup_frontend()
         self._setup_backend()
+        self.metrics.setup_socket(self.context)
 
     def recv_data(self):
-        while not self.fe_stop.is_set():
-            self.fe_poller.poll(1)  # max block 1 ms
-            raw_data = []
-            # Loop over all frontends
-            for actual_frontend in self.frontends:
-                try:
-                    actual_raw_data = actual_frontend[1].recv(flags=zmq.NOBLOCK)
-                    raw_data.append((actual_frontend[0],
-                                     self.deserialize_data(actual_raw_data)))
-                except zmq.Again:  # no data
-                    pass
-            if raw_data:
-                self.raw_data.put_nowait(raw_data)
+        while True:
+            # Block until data is available or the wake up signal is send
+            sockets = dict(self.fe_poller.poll())
+            if self.fe_wakeup[1] in sockets:
+                break
+            ready_frontends = [actual_frontend for actual_frontend in self.frontends
+                               if actual_frontend[1] in sockets]
+            # Drain the ready frontends; every iteration takes at most one
+            # message per frontend
+            for _ in range(self.max_drain):
+                received, n_bytes, trace = [], 0, None
+                for actual_frontend in ready_frontends:
+                    try:
+                        frames = actual_frontend[1].recv_multipart(
+                            flags=zmq.NOBLOCK, copy=False)
+                    except zmq.Again:  # no data
+                        continue
+                    frames, actual_trace, actual_n_bytes = self._split_received(actual_frontend[0], frames)
+                    n_bytes += actual_n_bytes
+                    trace = actual_trace if tracing.is_timed(actual_trace) else trace
+                    received.append((actual_frontend[0], frames))
+                if not received:
+                    break
+                # Skipped messages are not even deserialized
+                if self._skip_paused():
+                    continue
+                raw_data = self._deserialize_received(received)
+                if raw_data:
+                    self.raw_data.put((raw_data, trace), n_bytes)
+
+    def _split_received(self, address, frames):
+        ''' Count the received frames and split the trace trailer
+
+            Returns the frames, the trace and the size in bytes.
+        '''
+        n_bytes = sum(len(frame) for frame in frames)
+        self.metrics.count_in(n_bytes)
+        frames, trace = tracing.split_trace(frames)
+        if trace:
+            _, topic = utils.split_topic(frames)
+            self.sequence_checker.check((address, topic), trace['seq'])
+        if tracing.is_timed(trace):
+            tracing.stamp(trace, self.name, 'receive')
+        return frames, trace, n_bytes
+
+    def _deserialize_received(self, received):
+        ''' Deserialize the (address, frames) tuples received at once into
+            the input of interpret_data()
+        '''
+        raw_data = []
+        for address, frames in received:
+            if self.passthrough:  # topic frames are forwarded
+                raw_data.append((address, frames))
+            else:
+                frames, _ = utils.split_topic(frames)
+                with self.metrics.timer('deserialize'):
+                    actual_data = self.deserialize_data(utils.unpack_frames(frames))
+                if actual_data is None:  # e.g. schema not received yet
+                    continue
+                raw_data.append((address, actual_data))
+        return raw_data
+
+    def _skip_paused(self):
+        ''' True if the received message is not interpreted since the
+            receivers paused the converter (see pause_decimation)
+        '''
+        if not self.paused.is_set():
+            return False
+        self.n_paused += 1
+        return not self.pause_decimation or self.n_paused % self.pause_decimation != 0
 
     def recv_commands(self):
-        if self.backend_socket_type == zmq.DEALER:
-            while not self.be_stop.wait(0.1):
-                self.be_poller.poll(1)  # max block 1 ms
-                commands = []
-                # Check for bidirectional communication
-                if self.backend_socket_type == zmq.DEALER:
-                    for actual_backend in self.backends:
-                        try:
-                            # Check if command was send
-                            command = actual_backend[1].recv_json(zmq.NOBLOCK)
-                            logging.debug("%s converter %s received command %s",
-                                          self.kind, self.name, command)
-                            commands.append(command)
-                        except zmq.error.Again:
-                            pass
-                if commands:
-                    self.handle_command(commands)
+        # Check for bidirectional communication
+        if self.backend_socket_type != zmq.DEALER:
+            return
+        while True:
+            # Block until a command is send or the wake up signal is send
+            sockets = dict(self.be_poller.poll())
+            if self.be_wakeup[1] in sockets:
+                break
+            commands = []
+            for actual_backend in self.backends:
+                if actual_backend[1] not in sockets:
+                    continue
+                for _ in range(self.max_drain):
+                    try:
+                        # Check if command was send
+                        commands.append(actual_backend[1].recv_json(zmq.NOBLOCK))
+                    except zmq.error.Again:
+                        break
+            self._handle_commands(commands)
+
+    def _handle_commands(self, commands):
+        ''' Handle the control commands of the receivers here, pass all other
+            commands to handle_command()
+        '''
+        user_commands = []
+        for command in commands:
+            logging.debug("%s converter %s received command %s",
+                          self.kind, self.name, command)
+            if isinstance(command, dict) and '__control__' in command:
+                self._handle_control(command['__control__'], command.get('receiver'))
+            else:
+                user_commands.append(command)
+        if user_commands:
+            self.handle_command(user_commands)
+
+    def _handle_control(self, control, receiver=None):
+        ''' Pause / resume the interpretation on request of the receivers
+
+            Receivers sharing the converter pause it independently; it is
+            resumed once no receiver requests the pause anymore.
+        '''
+        if control == 'pause':
+            logging.info('Converter %s paused by receiver %s', self.name, receiver)
+            self._pausing.add(receiver)
+        elif control == 'resume':
+            logging.info('Converter %s resumed by receiver %s', self.name, receiver)
+            self._pausing.discard(receiver)
+        else:
+            logging.warning('Converter %s received unknown control command %s',
+                            self.name, control)
+            return
+        if self._pausing:
+            self.paused.set()
+        else:
+            self.paused.clear()
+
+    def wait_for_exit(self):
+        ''' Blocks until shutdown() is called, then wakes up the main loop '''
+        self.exit.wait()
+        self.raw_data.put_signal()
 
     def send_data(self, data):
         ''' This function can be overwritten in derived class
 
-            Std. function is to broadcast all receiver data to all backends
+            Std. function is to broadcast all receiver data to all backends.
+            The trace of the data (see utils.tracing) is appended if
+            requested.
+        '''
+        if self.trace:
+            tracing.stamp(self.trace, self.name, 'send')
+        self._send_serialized(self.backends, data)
+
+    def _send_serialized(self, sockets, data, stream=None, converter=None):
+        ''' Serialize the data and send it to the (address, socket) tuples
+
+            The trace trailer with the sequence number of the stream and
+            topic and the topic frame are added if requested. The data is serialized and
+            its topic is set by the converter, std. is this converter (e.g.
+            a pipeline stage for its tap).
         '''
+        converter = converter or self
         for frontend_data in data:
-            serialized_data = self.serialize_data(frontend_data)
-            for actual_backend in self.backends:
-                actual_backend[1].send(serialized_data)
+            if self.passthrough:  # received frames are send untouched
+                serialized_data = frontend_data
+                _, topic = utils.split_topic(frontend_data)
+            else:
+                with self.metrics.timer('serialize'):
+                    serialized_data = converter.serialize_data(frontend_data)
+                topic = converter.get_topic(frontend_data) if self.publish_topics else None
+            if self.sequence or self.trace:
+                # Subscribers might filter topics, thus every topic has
+                # its own sequence numbers
+                serialized_data = self.append_trace(serialized_data, (stream, topic))
+            if self.publish_topics and not self.passthrough:
+                if not isinstance(serialized_data, list):
+                    serialized_data = [serialized_data]
+                serialized_data = [utils.topic_frame(topic)] + serialized_data
+            self.metrics.count_out(utils.get_nbytes(serialized_data) * len(sockets))
+            for actual_socket in sockets:
+                self._send(actual_socket[1], serialized_data)
+
+    def _send(self, socket, serialized_data):
+        # Multipart data is send without copying the frames
+        if isinstance(serialized_data, list):
+            socket.send_multipart(serialized_data, copy=False)
+        else:
+            socket.send(serialized_data)
 
     def run(self):  # the Receiver loop run in extra process
         utils.setup_logging(self.loglevel)
         self._setup_transceiver()
         self.setup_interpretation()
+        self._setup_state()
 
-        process = psutil.Process(self.ident)  # access this process info
-        self.cpu_load = 0.
+        pool = self._setup_workers()
+        pending = deque()  # results of the workers in the order of the input
 
         be_thread = threading.Thread(target=self.recv_commands)
         be_thread.start()
         fe_thread = threading.Thread(target=self.recv_data)
         fe_thread.start()
+        exit_thread = threading.Thread(target=self.wait_for_exit, daemon=True)
+        exit_thread.start()
 
         logging.debug("Start %s transceiver %s at %s", self.kind, self.name,
                       self.backend_address)
-        while not self.exit.wait(0.01):
-            if self.raw_data.empty():
-                continue
-            else:
-                raw_data = self.raw_data.get_nowait()
-
-            actual_cpu_load = process.cpu_percent()
-            # Filter cpu load by running mean since it changes rapidly;
-            # cpu load spikes can be filtered away since data queues up
-            # through ZMQ
-            self.cpu_load = 0.90 * self.cpu_load + 0.1 * actual_cpu_load
-            # Check if already too many messages queued up then omit data
-            if not self.max_buffer or self.max_buffer > self.raw_data.qsize():
-                data = self.interpret_data(raw_data)
-                # Data is None if the data cannot be converted
-                # (e.g. is incomplete, broken, etc.)
-                if data is not None and len(data) != 0:
-                    self.send_data(data)
-            else:
-                logging.warning('Converter cannot keep up, omitting data for interpretation!')
-
-        self.be_stop.set()
+        # Wake up regularly to publish the statistics if requested
+        timeout = self.metrics.interval if self.metrics.socket else None
+        while not self.exit.is_set():
+            raw_data, trace = self._get_batch(timeout=timeout)
+            self._log_dropped()
+            self._update_load()
+            self._publish_metrics()
+            raw_data = self._shed_load(raw_data)
+            if raw_data:
+                if pool:
+                    result = pool.submit(_interpret_in_worker, raw_data, self.load_level)
+                    # Put a wake up signal into the queue when the result is
+                    # ready, to not wait for the next data
+                    result.add_done_callback(lambda _: self.raw_data.put_signal())
+                    pending.append((result, trace))
+                else:
+                    with self.metrics.timer('interpret'):
+                        data = self.interpret_data_batch(raw_data)
+                    self._send_interpreted(data, trace)
+            # Send results of the workers in the order of the input data,
+            # block if too many results are pending
+            try:
+                while pending and (pending[0][0].done() or len(pending) > 2 * self.n_workers):
+                    result, trace = pending.popleft()
+                    self._send_interpreted(result.result(), trace)
+            except BrokenProcessPool:
+                logging.error('Interpretation workers of converter %s stopped working', self.name)
+                self.exit.set()
+
+        self.be_wakeup[0].send(b'')
         be_thread.join()
-        self.fe_stop.set()
+        self.fe_wakeup[0].send(b'')
         fe_thread.join()
-        # Close connections
-        for actual_frontend in self.frontends:
-            actual_frontend[1].close()
-        for actual_backend in self.backends:
-            actual_backend[1].close()
+        if pool:
+            pool.shutdown(wait=True, cancel_futures=True)
+        self._close_sockets()
         self.context.term()
 
         logging.debug(
             "Close %s transceiver %s at %s", self.kind, self.name,
             self.backend_address)
 
+    def _setup_state(self):
+        ''' State of the running converter, set in the converter process '''
+        self.process = psutil.Process(self.ident)  # access this process info
+        self.cpu_load = 0.
+        self._children = {}  # process infos of the interpretation workers
+        self.n_skipped = 0  # messages skipped due to load shedding
+        self.trace = None  # trace of the data to send (see utils.tracing)
+        self._seq = {}  # sequence number of the next send message per stream and topic
+        self.sequence_checker = tracing.SequenceChecker()  # lost input messages
+        self.paused = threading.Event()  # set by the receivers, see pause_decimation
+        self._pausing = set()  # receivers requesting the pause
+        self.n_paused = 0  # messages received while paused
+        self._n_dropped_logged, self._n_lost_logged = 0, 0
+        self._last_drop_log = time.time()
+        self._last_load_measurement = time.time()
+        self._keep_credit = 1.  # messages to keep, see _shed_load()
+
+    def _close_sockets(self):
+        for actual_frontend in self.frontends:
+            actual_frontend[1].close()
+        for actual_backend in self.backends:
+            actual_backend[1].close()
+        for socket in self.fe_wakeup + self.be_wakeup:
+            socket.close()
+        self.metrics.close()
+
+    def _update_load(self):
+        ''' Measure the cpu load once per second and adjust the load level '''
+        now = time.time()
+        if now - self._last_load_measurement < 1.:
+            return
+        self._last_load_measurement = now
+        actual_cpu_load = self.process.cpu_percent()
+        for child in self.process.children():  # interpretation workers
+            try:
+                actual_cpu_load += self._children.setdefault(child.pid, child).cpu_percent()
+            except psutil.NoSuchProcess:
+                pass
+        # Filter cpu load by running mean since it changes rapidly;
+        # cpu load spikes can be filtered away since data queues up
+        # through ZMQ
+        self.cpu_load = 0.5 * self.cpu_load + 0.5 * actual_cpu_load
+        if not self.target_load:
+            return
+        if self.cpu_load > self.target_load and self.load_level < self.max_load_level:
+            self.load_level += 1
+        elif self.cpu_load < 0.8 * self.target_load and self.load_level > 0:
+            self.load_level -= 1
+        else:
+            return
+        logging.info('Converter %s at %1.1f %% cpu load, set load level %d',
+                     self.name, self.cpu_load, self.load_level)
+        self.set_load_level(self.load_level)
+
+    def _shed_load(self, raw_data):
+        ''' Skip the fraction level / (max_load_level + 1) of the messages if
+            the load level is set and load shedding is 'skip'
+
+            The kept messages are evenly spaced: every message adds the kept
+            fraction to a credit, a message is kept if a full message is
+            credited.
+        '''
+        if raw_data and self.load_level and self.load_shedding == 'skip':
+            keep_fraction = 1. - float(self.load_level) / (self.max_load_level + 1)
+            actual_raw_data = []
+            for actual_data in raw_data:
+                if self._keep_credit >= 1.:
+                    actual_raw_data.append(actual_data)
+                    self._keep_credit -= 1.
+                self._keep_credit += keep_fraction
+            self.n_skipped += len(raw_data) - len(actual_raw_data)
+            return actual_raw_data
+        return raw_data
+
+    def append_trace(self, serialized_data, stream=None):
+        ''' Append the trace trailer with the next sequence number of the
+            stream, e.g. a (stream, topic) tuple, and the time stamps of the interpreted data to the message
+            frames
+        '''
+        seq = self._seq.get(stream, 0)
+        self._seq[stream] = seq + 1
+        trace = tracing.new_trace(seq)
+        if self.trace:
+            trace['stamps'] = self.trace['stamps']
+        if not isinstance(serialized_data, list):
+            serialized_data = [serialized_data]
+        return serialized_data + [tracing.pack(trace)]
+
+    @property
+    def n_dropped(self):
+        ''' Messages omitted for interpretation, see max_buffer '''
+        return self.raw_data.n_dropped
+
+    @property
+    def queue_depth(self):
+        ''' Messages waiting for interpretation '''
+        return self.raw_data.qsize()
+
+    @property
+    def sampling_factor(self):
+        ''' Ratio of received to buffered messages, see max_buffer '''
+        return self.raw_data.sampling_factor
+
+    def _publish_metrics(self):
+        self.metrics.queue_depth = self.queue_depth
+        self.metrics.dropped = self.n_dropped + self.n_skipped
+        self.metrics.lost = self.sequence_checker.n_lost
+        self.metrics.sampling_factor = self.sampling_factor
+        self.metrics.cpu_load = self.cpu_load
+        self.metrics.publish()
+
+    def _log_dropped(self):
+        ''' Log the number of omitted and lost messages at most once per
+            second
+        '''
+        now = time.time()
+        if now - self._last_drop_log < 1.:
+            return
+        n_dropped = self.n_dropped - self._n_dropped_logged
+        if n_dropped:
+            logging.warning('Converter %s cannot keep up, omitted %d messages '
+                            'for interpretation in %1.1f s!', self.name,
+                            n_dropped, now - self._last_drop_log)
+        self._n_dropped_logged += n_dropped
+        n_lost = self.sequence_checker.n_lost - self._n_lost_logged
+        if n_lost:
+            logging.warning('Converter %s lost %d messages in transmission in '
+                            '%1.1f s!', self.name, n_lost, now - self._last_drop_log)
+        self._n_lost_logged += n_lost
+        self._last_drop_log = now
+
+    def _setup_workers(self):
+        ''' Start the interpretation worker processes if requested '''
+        if not self.n_workers or self.n_workers < 2:
+            return None
+        if self.passthrough:
+            logging.warning('Converter %s is in pass-through mode, no '
+                            'interpretation workers are used', self.name)
+            return None
+        logging.info('Converter %s interprets data with %d workers',
+                     self.name, self.n_workers)
+        return self._start_workers()
+
+    def _start_workers(self):
+        ''' Process pool with a converter instance per worker
+
+            Raises a RuntimeError if the workers cannot create the converter,
+            instead of waiting for results that never come.
+        '''
+        pool = ProcessPoolExecutor(self.n_workers, initializer=_setup_worker,
+                                   initargs=(type(self), self._settings))
+        try:
+            pool.submit(_check_worker).result()
+        except BrokenProcessPool:
+            pool.shutdown(wait=False)
+            raise RuntimeError('Interpretation workers of converter %s cannot create the converter %s'
+                               % (self.name, self.kind))
+        return pool
+
+    def _send_interpreted(self, data, trace=None):
+        # Data is None if the data cannot be converted
+        # (e.g. is incomplete, broken, etc.)
+        if data is not None and len(data) != 0:
+            if trace:
+                tracing.stamp(trace, self.name, 'interpret')
+            self.trace = trace
+            self.send_data(data)
+
+    def _get_batch(self, timeout=None):
+        ''' Take queued messages for interpretation
+
+            Blocks until data or a wake up signal is available, then drains
+            the queue up to batch_size messages / batch_bytes bytes. Returns
+            the messages and the trace of the latest traced message; the
+            messages are an empty list if woken up or no data arrived within
+            timeout.
+        '''
+        batch, batch_bytes, trace = [], 0, None
+        while len(batch) < self.batch_size and (not self.batch_bytes or batch_bytes < self.batch_bytes):
+            try:
+                # Only wait for the first message of a batch
+                raw_data, n_bytes = self.raw_data.get(block=not batch,
+                                                      timeout=timeout)
+            except queue.Empty:
+                break
+            if raw_data is None:  # wake up signal
+                break
+            raw_data, actual_trace = raw_data
+            batch.append(raw_data)
+            batch_bytes += n_bytes
+            trace = actual_trace or trace
+        return batch, trace
+
     def shutdown(self):
         self.exit.set()
 
@@ -250,6 +829,23 @@ class Transceiver(multiprocessing.Process):
         '''
         pass
 
+    def get_topic(self, data):
+        ''' Topic of the data to send if publish_topics is set
+
+            Std. is the name of the converter. Can be overwritten in derived
+            class to publish different data products (e.g. histograms) with
+            different topics.
+        '''
+        return self.name
+
+    def set_load_level(self, level):
+        ''' Called if the load level changes (see target_load)
+
+            Can be overwritten in derived class to switch interpret_data() to
+            a cheaper mode for level > 0. Level 0 is normal operation.
+        '''
+        pass
+
     def setup_interpretation(self):
         # This function has to be overwritten in derived class and is called
         # once at the beginning
@@ -257,7 +853,13 @@ class Transceiver(multiprocessing.Process):
 
     def deserialize_data(self, data):
         ''' To be overwritten when custom serialization is used
+
+            Data is a list of frames for multipart messages, bytes otherwise
         '''
+        if self.lazy:
+            return utils.lazy_dec(data)
+        if isinstance(data, list):
+            return utils.multipart_dec(data)
         return zmq.utils.jsonapi.loads(data, object_hook=utils.json_numpy_obj_hook)
 
     def interpret_data(self, data):
@@ -269,10 +871,34 @@ class Transceiver(multiprocessing.Process):
         raise NotImplementedError("You have to implement a interpret_data "
                                   "method!")
 
+    def interpret_data_batch(self, data):
+        ''' Interpret several messages at once
+
+            Data is a list of interpret_data() inputs in the order received.
+            Can be overwritten in derived class for a vectorized
+            interpretation; std. is to call interpret_data() for every
+            message and to combine the results.
+        '''
+        interpreted_data = []
+        for raw_data in data:
+            actual_data = self.interpret_data(raw_data)
+            if actual_data is not None:
+                interpreted_data.extend(actual_data)
+        return interpreted_data
+
     def serialize_data(self, data):
         ''' To be overwritten when object needs custom serialization
+
+            Return bytes for a single frame or a list of frames for a
+            multipart message
         '''
-        return zmq.utils.jsonapi.dumps(data, cls=utils.NumpyEncoder)
+        if self.wire_format == 'schema':
+            return self.schema_encoder.encode(data)
+        if self.wire_format == 'multipart':
+            return utils.multipart_enc(data, codec=self.codec or 'none',
+                                       codec_threshold=self.codec_threshold)
+        return zmq.utils.jsonapi.dumps(data, cls=utils.NumpyEncoder, codec=self.codec,
+                                       codec_threshold=self.codec_threshold)
 
     def handle_command(self, commands):
         ''' Command received from a receiver (bidir. commun. mode).'''
@@ -0,0 +1,22 @@
+''' Example how to define a converter that accumulates data, e.g. as stage of a pipeline after the example converter '''
+import numpy as np
+
+from online_monitor.converter.transceiver import Transceiver
+
+
+class ExampleHistogrammer(Transceiver):
+
+    def setup_interpretation(self):  # Called once at the beginning
+        self.histogram = None
+
+    def interpret_data(self, data):  # sum up all position data
+        data = data[0][1]
+        for actual_data_type in data:  # only the position data is decoded if lazy
+            if actual_data_type.startswith('position'):
+                actual_data = data[actual_data_type]
+                if self.histogram is None:
+                    self.histogram = np.zeros_like(actual_data)
+                self.histogram += actual_data
+        if self.histogram is not None:
+            return [{'time_stamp': data['time_stamp'],
+                     'position_histogram_%s' % self.name: self.histogram}]
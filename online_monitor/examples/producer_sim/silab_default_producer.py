@@ -36,8 +36,9 @@ class SiLabDefaultProducerSim(ProducerSim):
         meta_data['dtype'] = str(data.dtype)    
         meta_data['scan_parameters'] = {} if scan_params is None else scan_params
 
-        # Encode and return
-        return utils.simple_enc(data=data, meta=meta_data)
+        # Encode and return; version 2 copies the data only once and
+        # needs no pickle
+        return utils.simple_enc(data=data, meta=meta_data, version=2)
 
     def send_data(self):
 
@@ -0,0 +1,49 @@
+''' Example how to define a receiver that accumulates the data in the receive thread to not block the GUI '''
+import numpy as np
+from zmq.utils import jsonapi
+
+import pyqtgraph as pg
+from pyqtgraph.dockarea import DockArea, Dock
+
+from online_monitor.receiver.receiver import Receiver
+from online_monitor.utils import utils
+from online_monitor.utils.double_buffer import DoubleBuffer
+
+
+class ExampleAccumulatingReceiver(Receiver):
+
+    def setup_receiver(self):
+        self.buffer = DoubleBuffer()  # sum of all positions
+
+    def setup_widgets(self, parent, name):
+        dock_area = DockArea()
+        parent.addTab(dock_area, name)
+
+        dock_position = Dock("Position sum")
+        dock_area.addDock(dock_position)
+
+        # Position 2d plot
+        position_graphics = pg.GraphicsLayoutWidget()
+        position_graphics.show()
+        view = position_graphics.addViewBox()
+        self.position_img = pg.ImageItem(border='w')
+        self.position_img.setLookupTable(utils.lut_from_colormap('viridis'))
+        view.addItem(self.position_img)
+        dock_position.addWidget(position_graphics)
+
+    def deserialize_data(self, data):
+        return jsonapi.loads(data, object_hook=utils.json_numpy_obj_hook)
+
+    def process_data(self, data):  # called in the receive thread, also if not shown
+        with self.buffer.write() as back:
+            for actual_data_type, actual_data in data.items():
+                if 'time_stamp' not in actual_data_type:  # time stamp info is not plotted
+                    if 'position' not in back:
+                        back['position'] = np.zeros(actual_data.shape)
+                    back['position'] += actual_data
+        # Nothing to hand over to handle_data()
+
+    def refresh_data(self):
+        front = self.buffer.swap()
+        if front:
+            self.position_img.setImage(front['position'], autoDownsample=True)
@@ -0,0 +1,24 @@
+import logging
+
+import numpy as np
+
+from online_monitor.receiver.headless_receiver import HeadlessReceiver
+
+
+class ExampleThresholdWatcher(HeadlessReceiver):
+
+    ''' Warns if too many positions are above threshold; no GUI needed '''
+
+    def setup_receiver(self):
+        self.max_hits = self.config.get('max_hits', 10)
+        self.n_alarms = 0
+
+    def handle_data(self, data):
+        for actual_data_type, actual_data in data.items():
+            if 'time_stamp' not in actual_data_type and np.count_nonzero(actual_data) > self.max_hits:
+                self.n_alarms += 1
+
+    def refresh_data(self):
+        if self.n_alarms:
+            logging.warning('%s: %d times more than %d hits', self.name, self.n_alarms, self.max_hits)
+            self.n_alarms = 0
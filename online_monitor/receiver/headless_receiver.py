@@ -0,0 +1,288 @@
+import zmq
+import logging
+import time
+from threading import Event, Lock, Thread
+from collections import deque
+
+from online_monitor.utils import utils, tracing, shared_memory
+from online_monitor.utils.metrics import Metrics
+from online_monitor.receiver.receiver import MessageReceiver
+
+
+class HeadlessReceiver(MessageReceiver):
+
+    '''Receiver without GUI, e.g. for alarm / threshold watchers, recorders or
+    as sink of throughput benchmarks on servers without display.
+
+    The same methods as for a receiver.Receiver are implemented:
+    deserialize_data(), handle_data() / handle_data_batch() and
+    refresh_data(). All of them are called one after the other in the receive
+    thread of the receiver, thus no Qt event loop is needed. Headless
+    receivers are always active. Receiving, conflation and deserialization
+    are shared with the receivers (see receiver.MessageReceiver).
+
+    Usage:
+
+    headless_receiver :
+        DUT0 :
+            kind : example_threshold_watcher
+            frontend : tcp://127.0.0.1:5600
+            refresh_rate : 1
+
+    Start the headless receivers of a configuration with
+    start_headless_receiver configuration.yaml
+
+    Parameter
+    ----------
+    frontend : str
+        Address of the converter publishing the data
+    kind : str
+        String describing the kind of receiver
+    hwm : number
+        ZeroMQ high water mark of the receiving socket
+    topics : list of str
+        Topics to subscribe to (see Transceiver publish_topics); only
+        messages with a topic starting with one of these are received. If
+        None all messages are received.
+    conflate : number
+        Handle only the latest received messages, at most this number, as
+        list with handle_data_batch(); older messages are dropped without
+        deserialization. If None every message is handed to handle_data().
+    refresh_rate : number
+        Rate in Hz refresh_data() is called with. If None refresh_data() is
+        called after every handled data.
+    metrics : str
+        Address to publish throughput and timing statistics at (see
+        utils.metrics.Metrics). If None no statistics are published.
+    metrics_interval : number
+        Publishing interval of the statistics in seconds
+    loglevel : str
+        The verbosity level for the logging (e.g. INFO, WARNING)
+    '''
+
+    @property
+    def n_lost(self):
+        ''' Number of messages lost in transmission; only detected for
+            messages with sequence number (see utils.tracing)
+        '''
+        return self.sequence_checker.n_lost
+
+    @property
+    def lost_fraction(self):
+        ''' Fraction of messages lost in transmission, e.g. to correct rates '''
+        return self.sequence_checker.lost_fraction
+
+    @property
+    def is_active(self):
+        return True
+
+    def __init__(self, frontend, kind, name='Undefined', hwm=10, topics=None,
+                 conflate=None, refresh_rate=None, metrics=None,
+                 metrics_interval=1., loglevel='INFO', **kwarg):
+        self.kind = kind
+        self.frontend_address = frontend
+        self.hwm = hwm
+        self.topics = topics
+        self.conflate = conflate
+        self.refresh_rate = refresh_rate
+        self.name = name  # name of the DAQ/device
+        self.config = kwarg
+        # Standard is unidirectional communication with PUB/SUB pattern, see
+        # MessageReceiver
+        self._setup_messages(self.deserialize_data,
+                             Metrics(name=name, kind=kind,
+                                     timers=('deserialize', 'handle', 'refresh'),
+                                     address=metrics, interval=metrics_interval))
+        self.n_refreshed = 0
+        self._trace = None  # trace of the latest handled data
+        self._stop_readout = Event()
+        self.thread = None
+        self.context = None
+        # Socket pair to wake up the receive loop blocking in poll(), e.g.
+        # to send commands; the sender is used by all other threads
+        self._wakeup_sender, self._wakeup_receiver = None, None
+        self._wakeup_lock = Lock()
+
+        utils.setup_logging(loglevel)
+        logging.debug("Initialize %s headless receiver %s at %s", self.kind,
+                      self.name, self.frontend_address)
+        self.setup_receiver()
+
+    def set_bidirectional_communication(self):
+        self.socket_type = zmq.DEALER
+
+    def start(self):
+        ''' Start receiving in a new thread '''
+        logging.info("Start %s headless receiver %s at %s", self.kind,
+                     self.name, self.frontend_address)
+        self._stop_readout.clear()
+        self.context = zmq.Context()
+        self._wakeup_sender = self.context.socket(zmq.PAIR)
+        self._wakeup_sender.bind('inproc://wakeup')
+        self._wakeup_receiver = self.context.socket(zmq.PAIR)
+        self._wakeup_receiver.connect('inproc://wakeup')
+        self.thread = Thread(target=self.receive_data, name=self.name)
+        self.thread.start()
+
+    def shutdown(self):
+        self._stop_readout.set()
+        self.wakeup()
+
+    def wakeup(self):
+        ''' Wake up the receive thread, e.g. to send commands '''
+        with self._wakeup_lock:
+            if self._wakeup_sender is not None and not self._wakeup_sender.closed:
+                self._wakeup_sender.send(b'')
+
+    def join(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def receive_data(self):
+        ''' Receive loop, runs until shutdown() is called '''
+        self.receiver = self.context.socket(self.socket_type,
+                                            socket_class=shared_memory.socket_class(self.frontend_address))
+        self.receiver.set_hwm(self.hwm)
+        if self.socket_type == zmq.SUB:
+            self._subscribe(self.topics)
+        self.receiver.connect(self.frontend_address)
+        self.metrics.setup_socket(self.context)
+        poller = zmq.Poller()
+        poller.register(self.receiver, zmq.POLLIN)
+        poller.register(self._wakeup_receiver, zmq.POLLIN)
+        latest = deque(maxlen=self.conflate) if self.conflate else None
+        next_refresh = time.time()
+        try:
+            while not self._stop_readout.is_set():
+                self._apply_settings()
+                self.publish_metrics()
+                # Block until data is available, the wake up signal is send
+                # or it is time to refresh / to publish the statistics
+                timeouts = []
+                if self.refresh_rate:
+                    timeouts.append(max(next_refresh - time.time(), 0.))
+                if self.metrics.socket:
+                    timeouts.append(self.metrics.interval)
+                sockets = dict(poller.poll(min(timeouts) * 1e3 if timeouts else None))
+                if self._wakeup_receiver in sockets:
+                    while True:
+                        try:
+                            self._wakeup_receiver.recv(zmq.NOBLOCK)
+                        except zmq.Again:
+                            break
+                if self.receiver in sockets:
+                    self._receive(latest)
+                if self.refresh_rate and time.time() >= next_refresh:
+                    self._refresh_data()
+                    next_refresh = max(next_refresh + 1. / self.refresh_rate, time.time())
+        finally:
+            self.receiver.close()
+            self.metrics.close()
+            with self._wakeup_lock:
+                self._wakeup_sender.close()
+            self._wakeup_receiver.close()
+            self.context.term()
+            logging.info("Close %s headless receiver %s at %s", self.kind,
+                         self.name, self.frontend_address)
+
+    def _receive(self, latest):
+        for frames, trace in self._receive_messages():
+            if latest is not None:  # deserialized when handled
+                self.n_conflated += self._enqueue(latest, (frames, trace))
+                continue
+            data = self._deserialize(frames)
+            if data is None:  # e.g. schema not received yet
+                continue
+            with self.metrics.timer('handle'):
+                self.handle_data(data)
+            self._set_trace(trace)
+            if self.refresh_rate is None:
+                self._refresh_data()
+        if latest:
+            data = self._deserialize_batch(latest)
+            if data:
+                with self.metrics.timer('handle'):
+                    self.handle_data_batch(data)
+            self._set_trace(latest[-1][1])
+            latest.clear()
+            if self.refresh_rate is None:
+                self._refresh_data()
+
+    def _set_trace(self, trace):
+        if tracing.is_timed(trace):
+            self._trace = trace
+
+    def _refresh_data(self):
+        with self.metrics.timer('refresh'):
+            self.refresh_data()
+        self.n_refreshed += 1
+        # The latency of the data is measured when refreshed
+        if self._trace:
+            tracing.stamp(self._trace, self.name, 'refresh')
+            tracing.record_latencies(self.metrics, self._trace)
+            self._trace = None
+
+    def setup_receiver(self):
+        ''' Method can be defined to setup receiver specific parameters
+            (e.g. bidirectional communication)
+        '''
+        pass
+
+    def handle_data(self, data):
+        ''' Handle data
+
+            Receives a dictionary with data, e.g. to check thresholds or
+            to record the data.
+        '''
+        raise NotImplementedError('You have to implement a handle_data '
+                                  'method!')
+
+    def handle_data_batch(self, data):
+        ''' Handle a list of data dictionaries (see conflate)
+
+            Std. is to call handle_data() for every item. Can be overwritten
+            to handle the data at once.
+        '''
+        for actual_data in data:
+            self.handle_data(actual_data)
+
+    def refresh_data(self):
+        ''' Method can be defined to act on the handled data with the refresh
+            rate, e.g. to write a summary
+        '''
+        pass
+
+    def set_topics(self, topics):
+        ''' Receive only messages with a topic starting with one of the
+            topics; all messages if None
+        '''
+        self.topics = topics
+        self._topics = (topics, )  # applied in the receive thread; can be None
+        self.wakeup()
+
+    def subscribe(self, topic):
+        ''' Receive the messages with the topic in addition to the
+            subscribed topics; if no topics were set only these messages
+        '''
+        self.set_topics((self.topics or []) + [topic])
+
+    def unsubscribe(self, topic):
+        ''' Stop receiving the messages with the topic '''
+        self.set_topics([actual_topic for actual_topic in self.topics or [] if actual_topic != topic])
+
+    def send_command(self, command):
+        ''' Send command to transceiver
+
+            Has to be json serializable; send in the receive thread
+        '''
+        self._commands.append(command)
+        self.wakeup()
+
+    def deserialize_data(self, data):
+        ''' Has to convert the data do a python dict
+
+            Data is a list of frames for multipart messages, bytes otherwise
+        '''
+        if isinstance(data, list):
+            return utils.multipart_dec(data)
+        return zmq.utils.jsonapi.loads(data, object_hook=utils.json_numpy_obj_hook)
@@ -0,0 +1,65 @@
+import logging
+import time
+import sys
+
+from online_monitor.receiver.headless_receiver import HeadlessReceiver
+from online_monitor.utils import utils
+from online_monitor.utils.metrics import MetricsView, get_metrics_addresses
+
+
+class HeadlessReceiverManager(object):
+    def __init__(self, configuration, loglevel='INFO', metrics=False):
+        ''' metrics: show the statistics published by the nodes with a
+            metrics address instead of the received messages
+        '''
+        utils.setup_logging(loglevel)
+        self.loglevel = loglevel
+        self.metrics = metrics
+        logging.info("Initialize headless receiver mananager with configuration in %s", configuration)
+        self.configuration = utils.parse_config_file(configuration)
+
+    def _info_output(self, receivers):
+        info_str = 'INFO: ' + ', '.join('%s: %d received, %d lost' % (receiver.name, receiver.metrics.messages_in, receiver.n_lost)
+                                        for receiver in receivers)
+        info_str += '\r'
+        sys.stdout.write(info_str)
+        sys.stdout.flush()
+
+    def start(self):
+        if not self.configuration.get('headless_receiver'):
+            logging.info('No headless receivers defined in config file')
+            logging.info('Close headless receiver manager')
+            return
+        logging.info('Starting %d headless receivers', len(self.configuration['headless_receiver']))
+        receivers = []
+
+        for (receiver_name, receiver_settings) in self.configuration['headless_receiver'].items():
+            receiver_settings['name'] = receiver_name
+            receiver_settings.setdefault('loglevel', self.loglevel)
+            receiver = utils.load_receiver(receiver_settings['kind'], base_class_type=HeadlessReceiver, *(), **receiver_settings)
+            receiver.start()
+            receivers.append(receiver)
+        metrics_view = None
+        if self.metrics:
+            addresses = get_metrics_addresses(self.configuration)
+            if addresses:
+                metrics_view = MetricsView(addresses)
+            else:
+                logging.warning('No metrics addresses defined in config file')
+        try:
+            while True:
+                if metrics_view:
+                    metrics_view.show(sys.stdout)
+                else:
+                    self._info_output(receivers)
+                time.sleep(1)
+        except KeyboardInterrupt:
+            logging.info('CRTL-C pressed, shutting down %d headless receivers', len(receivers))
+            for receiver in receivers:
+                receiver.shutdown()
+
+        for receiver in receivers:
+            receiver.join()
+        if metrics_view:
+            metrics_view.close()
+        logging.info('Close headless receiver manager')
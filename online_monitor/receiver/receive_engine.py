@@ -0,0 +1,127 @@
+from PyQt6 import QtCore
+import zmq
+import logging
+from threading import Event, Lock
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class ReceiveEngine(QtCore.QObject):
+
+    '''Receives the data of many receivers with one ZeroMQ context and one
+    thread polling all receiver sockets.
+
+    The sockets of the registered receivers (see receiver.DataWorker) are
+    only used in the receive thread. Received messages are deserialized and
+    processed in a bounded pool of threads; the messages of one receiver
+    are handled one after the other to keep their order.
+
+    Parameter
+    ----------
+    n_threads : number
+        Number of threads deserializing / processing the received data
+    '''
+
+    def __init__(self, n_threads=4):
+        QtCore.QObject.__init__(self)
+        self.context = zmq.Context()
+        self.executor = ThreadPoolExecutor(max_workers=n_threads,
+                                           thread_name_prefix='receive')
+        self.workers = {}  # socket -> data worker
+        self.poller = zmq.Poller()
+        self._actions = deque()  # functions to call in the receive thread
+        self._stop_readout = Event()
+        # Socket pair to wake up the receive loop blocking in poll(); the
+        # sender is used by all other threads
+        self._wakeup_sender = self.context.socket(zmq.PAIR)
+        self._wakeup_sender.bind('inproc://wakeup')
+        self._wakeup_receiver = self.context.socket(zmq.PAIR)
+        self._wakeup_receiver.connect('inproc://wakeup')
+        self._wakeup_lock = Lock()
+        self.poller.register(self._wakeup_receiver, zmq.POLLIN)
+        self.thread = QtCore.QThread()  # no parent
+        self.moveToThread(self.thread)
+        self.thread.started.connect(self.receive_data)
+
+    def start(self):
+        ''' Start the receive thread if not running already '''
+        if not self.thread.isRunning():
+            self.thread.start()
+
+    def register(self, worker, frontend_address, socket_type, hwm=10, topics=None):
+        ''' Connect the socket of the data worker and receive its data '''
+        worker.engine = self
+        self.call_soon(self._add, worker, frontend_address, socket_type, hwm, topics)
+
+    def unregister(self, worker):
+        ''' Close the socket of the data worker '''
+        self.call_soon(self._remove, worker)
+
+    def call_soon(self, function, *args):
+        ''' Call the function in the receive thread, to access the sockets '''
+        self._actions.append((function, args))
+        self.wakeup()
+
+    def wakeup(self):
+        with self._wakeup_lock:
+            if not self._wakeup_sender.closed:
+                self._wakeup_sender.send(b'')
+
+    def shutdown(self):
+        self._stop_readout.set()
+        if self.thread.isRunning():
+            self.wakeup()
+            # Loop is/should be terminated already
+            self.thread.quit()
+            self.thread.wait()
+        else:
+            self._close()
+
+    def receive_data(self):  # pragma: no cover; no covered since qt event loop
+        ''' Infinite loop via QObject.moveToThread(), does not block event loop
+        '''
+        while not self._stop_readout.is_set():
+            for worker in self.workers.values():
+                worker.publish_metrics()
+            # Wake up regularly to publish the statistics if requested
+            intervals = [worker.metrics.interval for worker in self.workers.values() if worker.metrics.socket]
+            timeout = min(intervals) * 1e3 if intervals else None
+            # Block until data is available or the wake up signal is send
+            sockets = dict(self.poller.poll(timeout))
+            if self._wakeup_receiver in sockets:
+                while True:
+                    try:
+                        self._wakeup_receiver.recv(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+            while self._actions:
+                function, args = self._actions.popleft()
+                function(*args)
+            for socket, worker in self.workers.items():
+                if socket in sockets:
+                    worker.receive()
+        self._close()
+
+    def _add(self, worker, frontend_address, socket_type, hwm, topics):
+        worker.connect_zmq(self.context, frontend_address, socket_type,
+                           hwm=hwm, topics=topics)
+        self.workers[worker.receiver] = worker
+        self.poller.register(worker.receiver, zmq.POLLIN)
+
+    def _remove(self, worker):
+        if self.workers.pop(worker.receiver, None) is None:
+            return
+        self.poller.unregister(worker.receiver)
+        worker.close()
+
+    def _close(self):
+        # Queued data is still handed over
+        self.executor.shutdown(wait=True)
+        for worker in self.workers.values():
+            worker.close()
+        self.workers = {}
+        with self._wakeup_lock:
+            self._wakeup_sender.close()
+        self._wakeup_receiver.close()
+        self.context.term()
+        logging.debug('Receive engine closed')
@@ -1,58 +1,276 @@
 from PyQt6 import QtCore
 import zmq
 import logging
-from threading import Event
+import time
+import uuid
+from threading import Lock
+from collections import deque
 
-from online_monitor.utils import utils
+from online_monitor.utils import utils, tracing, shared_memory
+from online_monitor.utils.metrics import Metrics
+from online_monitor.receiver.receive_engine import ReceiveEngine
 
 
+class MessageReceiver(object):
 
+    ''' Receives the messages of one socket without GUI; shared by the
+        DataWorker of a Receiver and the headless_receiver.HeadlessReceiver
 
-class DataWorker(QtCore.QObject):
-    data = QtCore.pyqtSignal(dict)
-    finished = QtCore.pyqtSignal()
+        Splits topic frame and trace trailer, counts the lost messages,
+        conflates and deserializes the messages, sends the commands and
+        subscribes to the topics. The socket is only used in the receive
+        thread.
+    '''
 
-    def __init__(self, deserializer):
-        QtCore.QObject.__init__(self)
+    # Maximum messages received before polling again
+    max_drain = 100
+
+    def _setup_messages(self, deserializer, metrics):
         self.deserializer = deserializer
-        self._stop_readout = Event()
-        self._send_data = None
+        self.metrics = metrics
+        self.receiver = None
+        self.socket_type = zmq.SUB
+        self.n_conflated = 0  # messages dropped by conflation
+        self.n_dropped = 0  # messages dropped since the handling is too slow
+        self.sequence_checker = tracing.SequenceChecker()  # lost messages
+        self._commands = deque()  # commands to send, see send_data()
+        self._subscriptions = []  # subscribed topic frames
+        self._topics = None  # topics to subscribe to, set in receive thread
+
+    def publish_metrics(self):
+        self.metrics.lost = self.sequence_checker.n_lost
+        self.metrics.dropped = self.n_conflated + self.n_dropped
+        self.metrics.publish()
+
+    def _receive_messages(self):
+        ''' Yields the frames and the trace of the received messages, at most
+            max_drain
+        '''
+        for _ in range(self.max_drain):
+            try:
+                frames = self.receiver.recv_multipart(flags=zmq.NOBLOCK,
+                                                      copy=False)
+            except zmq.Again:
+                break
+            self.metrics.count_in(sum(len(frame) for frame in frames))
+            frames, topic = utils.split_topic(frames)
+            frames, trace = tracing.split_trace(frames)
+            if trace:
+                self.sequence_checker.check(topic, trace['seq'])  # one publisher per receiver
+            if tracing.is_timed(trace):
+                tracing.stamp(trace, self.metrics.name, 'receive')
+            yield frames, trace
+
+    @staticmethod
+    def _enqueue(messages, message):
+        ''' Append the message to the bounded deque; returns True if the
+            oldest message was dropped
+        '''
+        dropped = len(messages) == messages.maxlen
+        messages.append(message)
+        return dropped
+
+    def _deserialize(self, frames):
+        ''' Returns None if the data cannot be deserialized (yet) '''
+        with self.metrics.timer('deserialize'):
+            return self.deserializer(utils.unpack_frames(frames))
+
+    def _deserialize_batch(self, messages):
+        with self.metrics.timer('deserialize'):
+            data = [self.deserializer(utils.unpack_frames(frames)) for frames, _ in messages]
+        return [actual_data for actual_data in data if actual_data is not None]
+
+    def _apply_settings(self):
+        ''' Send the commands and subscribe to the topics set meanwhile '''
+        if self.receiver is None or self.receiver.closed:
+            return
+        while self._commands:
+            if self.socket_type != zmq.DEALER:
+                raise RuntimeError('You send data without a bidirectional '
+                                   'connection! Define a bidirectional '
+                                   'connection.')
+            self.receiver.send_json(self._commands.popleft())
+        if self._topics is not None:
+            self._subscribe(self._topics[0])
+            self._topics = None
+
+    def _subscribe(self, topics):
+        for subscription in self._subscriptions:
+            self.receiver.setsockopt(zmq.UNSUBSCRIBE, subscription)
+        if topics is None:  # all messages
+            self._subscriptions = [b'']
+        else:
+            self._subscriptions = [utils.topic_frame(topic) for topic in topics]
+        for subscription in self._subscriptions:
+            self.receiver.setsockopt(zmq.SUBSCRIBE, subscription)
+
+
+class DataWorker(QtCore.QObject, MessageReceiver):
+
+    ''' Receives the data of a receiver with a receive engine (see
+        receive_engine.ReceiveEngine)
+
+        The socket is only used in the receive thread of the engine, the
+        received messages are deserialized and processed in the thread pool
+        of the engine.
+    '''
 
-    def connect_zmq(self, frontend_address, socket_type):
-        self.context = zmq.Context()
-        self.receiver = self.context.socket(socket_type)  # subscriber
+    data = QtCore.pyqtSignal(dict)
+    data_batch = QtCore.pyqtSignal(list)  # conflated data, see Receiver conflate
+    trace = QtCore.pyqtSignal(dict)  # emitted before the data of traced messages
+
+    def __init__(self, deserializer, metrics, conflate=None, processor=None):
+        QtCore.QObject.__init__(self)
+        self._setup_messages(deserializer, metrics)
+        self.processor = processor  # called in the thread pool, see Receiver.process_data
+        self.engine = None  # set when registered
+        # Latest received messages, older ones are dropped undeserialized
+        self._latest = deque(maxlen=conflate) if conflate else None
+        self._in_flight = False  # conflated data emitted but not handled yet
+        self._pending = None  # received messages waiting for deserialization
+        self._scheduled = False  # handling of the messages is scheduled
+        self._lock = Lock()
+        self._active = False  # only data of active receivers is handed over
+
+    def connect_zmq(self, context, frontend_address, socket_type, hwm=10, topics=None):
+        self.receiver = context.socket(socket_type,  # subscriber
+                                       socket_class=shared_memory.socket_class(frontend_address))
         self.socket_type = socket_type
-        # A subscriber has to set to not filter any data
+        # A subscriber has to set to not filter any data, if no topics are
+        # given
         if self.socket_type == zmq.SUB:
-            self.receiver.setsockopt_string(zmq.SUBSCRIBE, u'')
-        # Buffer only 10 meassages, then throw data away
-        self.receiver.set_hwm(10)
+            self._subscribe(topics)
+        # Buffer only hwm meassages, then throw data away
+        self.receiver.set_hwm(hwm)
+        self._pending = deque(maxlen=hwm)
         self.receiver.connect(frontend_address)
-
-    def receive_data(self):  # pragma: no cover; no covered since qt event loop
-        ''' Infinite loop via QObject.moveToThread(), does not block event loop
+        self.metrics.setup_socket(context)
+        self._apply_settings()
+
+    def close(self):
+        self.receiver.close()
+        self.metrics.close()
+
+    def receive(self):
+        ''' Called in the receive thread if data is available '''
+        for frames, trace in self._receive_messages():
+            # The data of inactive receivers is not shown, thus only
+            # received to not queue up outdated data; unless it is
+            # processed (e.g. accumulated) in process_data()
+            if not self._active and self.processor is None:
+                continue
+            with self._lock:
+                if self._latest is not None:  # deserialized when handed over
+                    self.n_conflated += self._enqueue(self._latest, (frames, trace))
+                else:
+                    self.n_dropped += self._enqueue(self._pending, (frames, trace))
+        self._schedule()
+
+    def _schedule(self):
+        ''' Hand the messages to the thread pool, if not done already '''
+        with self._lock:
+            if self._scheduled or not (self._pending or (self._latest and not self._in_flight)):
+                return
+            self._scheduled = True
+        try:
+            self.engine.executor.submit(self._handle_messages)
+        except RuntimeError:  # engine shut down
+            pass
+
+    def _handle_messages(self):
+        ''' Called in the thread pool; deserializes and emits the messages
+            one after the other
+
+            Messages that cannot be deserialized or processed are logged and
+            dropped, the following messages are still handled.
         '''
-        while(not self._stop_readout.wait(0.01)):  # use wait(), do not block
-            if self._send_data:
-                if self.socket_type != zmq.DEALER:
-                    raise RuntimeError('You send data without a bidirectional '
-                                       'connection! Define a bidirectional '
-                                       'connection.')
-                self.receiver.send_json(self._send_data)
-                self._send_data = None
-            try:
-                data_serialized = self.receiver.recv(flags=zmq.NOBLOCK)
-                data = self.deserializer(data_serialized)
-                self.data.emit(data)
-            except zmq.Again:
-                pass
-        self.finished.emit()
-
-    def shutdown(self):
-        self._stop_readout.set()
+        try:
+            while True:
+                with self._lock:
+                    if self._pending:
+                        frames, trace = self._pending.popleft()
+                        messages = None
+                    elif self._latest and not self._in_flight:
+                        messages = list(self._latest)
+                        self._latest.clear()
+                        self._in_flight = True
+                    else:
+                        self._scheduled = False
+                        return
+                try:
+                    if messages is None:
+                        self._emit(frames, trace)
+                    else:
+                        self._emit_conflated(messages)
+                except Exception:
+                    logging.exception('Receiver %s cannot handle the received data, data dropped',
+                                      self.metrics.name)
+                    with self._lock:
+                        if messages is None:
+                            self.n_dropped += 1
+                        else:
+                            self.n_dropped += len(messages)
+                            self._in_flight = False
+        except BaseException:
+            # Nobody reads the result of the thread pool, thus schedule the
+            # next messages anyway; reset only here, since after a normal
+            # return the next handling might be scheduled already
+            with self._lock:
+                self._scheduled = False
+            raise
+
+    def _emit(self, frames, trace):
+        data = self._deserialize(frames)
+        if data is None:  # e.g. schema not received yet
+            return
+        data = self._process(data)
+        if data is None or not self._active:  # processed only, not shown
+            return
+        if tracing.is_timed(trace):
+            self.trace.emit(trace)
+        self.data.emit(data)
+
+    def _process(self, data):
+        if self.processor is None:
+            return data
+        with self.metrics.timer('process'):
+            return self.processor(data)
+
+    def _emit_conflated(self, messages):
+        data = [actual_data for actual_data in map(self._process, self._deserialize_batch(messages))
+                if actual_data is not None]
+        if not data or not self._active:  # processed only, not shown
+            with self._lock:
+                self._in_flight = False
+            return
+        traces = [trace for _, trace in messages if tracing.is_timed(trace)]
+        if traces:
+            self.trace.emit(traces[-1])
+        self.data_batch.emit(data)
+
+    def ack(self):
+        ''' Called when the conflated data was handled; the next data is
+            handed over
+        '''
+        with self._lock:
+            self._in_flight = False
+        if self.engine is not None:
+            self._schedule()
+
+    def send_data(self, data):
+        ''' Queue a command; send in the receive thread '''
+        self._commands.append(data)
+        if self.engine is not None:
+            self.engine.call_soon(self._apply_settings)
+
+    def set_active(self, value):
+        self._active = value
 
-    def send_data(self, data):  # FIXME: not thread safe
-        self._send_data = data
+    def set_topics(self, topics):
+        ''' Change the subscribed topics; applied in the receive thread '''
+        self._topics = (topics, )  # topics can be None
+        if self.engine is not None:
+            self.engine.call_soon(self._apply_settings)
 
 
 class Receiver(QtCore.QObject):
@@ -61,8 +279,61 @@ class Receiver(QtCore.QObject):
     to the specified data type.
 
     Usage:
+
+    Parameter
+    ----------
+    frontend : str
+        Address of the converter publishing the data
+    kind : str
+        String describing the kind of receiver
+    hwm : number
+        ZeroMQ high water mark of the receiving socket and maximum number of
+        received messages waiting for deserialization; if exceeded data is
+        discarded
+    topics : list of str
+        Topics to subscribe to (see Transceiver publish_topics); only
+        messages with a topic starting with one of these are received. If
+        None all messages are received.
+    conflate : number
+        Hand over only the latest received messages, at most this number,
+        once the previous data was handled and refreshed; older messages
+        are dropped without deserialization. The messages are handed over
+        as list to handle_data_batch(). Set 1 to show only the latest
+        message. If None every message is handed to handle_data().
+    pause_upstream : boolean
+        Tell the converter to pause (see Transceiver pause_decimation) while
+        the receiver is not active; only possible with bidirectional
+        communication. Off by default, since a paused converter does not
+        interpret the data (e.g. accumulated histograms miss it).
+    metrics : str
+        Address to publish throughput and timing statistics at (see
+        utils.metrics.Metrics). If None no statistics are published.
+    metrics_interval : number
+        Publishing interval of the statistics in seconds
+    engine : receive_engine.ReceiveEngine
+        Receive engine shared by all receivers of the online monitor. If None
+        the receiver starts its own engine.
+    loglevel : str
+        The verbosity level for the logging (e.g. INFO, WARNING)
     '''
 
+    @property
+    def n_lost(self):
+        ''' Number of messages lost in transmission; only detected for
+            messages with sequence number (see utils.tracing)
+        '''
+        return self.worker.sequence_checker.n_lost
+
+    @property
+    def lost_fraction(self):
+        ''' Fraction of messages lost in transmission, e.g. to correct rates '''
+        return self.worker.sequence_checker.lost_fraction
+
+    @property
+    def is_active(self):
+        ''' True if the receiver is shown '''
+        return bool(self._active)
+
     @property
     def refresh_rate(self):
         return self._refresh_rate
@@ -75,20 +346,37 @@ class Receiver(QtCore.QObject):
             if rate == 0:
                 logging.warning(f"{self.name} receiver refreshing stopped. Data is not buffered!")
                 self.refresh_timer.stop()
+                self._acknowledge()
             else:
                 logging.debug(f"{self.name} receiver refreshing at {rate} Hz!")
                 self.refresh_timer.start(int(1e3 / rate))  # timer interval needs to be given in ms
             
         self._refresh_rate = rate        
 
-    def __init__(self, frontend, kind, name='Undefined', loglevel='INFO', **kwarg):
+    def __init__(self, frontend, kind, name='Undefined', hwm=10, topics=None,
+                 conflate=None, pause_upstream=False, metrics=None,
+                 metrics_interval=1., engine=None, loglevel='INFO', **kwarg):
         QtCore.QObject.__init__(self)
         self.kind = kind
         self.frontend_address = frontend
+        self.hwm = hwm
+        self.topics = topics
+        self.conflate = conflate
+        self.pause_upstream = pause_upstream
+        self._id = uuid.uuid4().hex  # identifies the pause requests at the converter
+        # Receivers without shared engine start their own
+        self._own_engine = engine is None
+        self.engine = engine
         self.name = name  # name of the DAQ/device
         self.config = kwarg
-        # Flag to tell receiver if its active (viewed int the foreground)
-        self._active = False
+        # Throughput and timing statistics; data is received in the receive
+        # engine, handled and refreshed in the GUI thread
+        self.metrics = Metrics(name=name, kind=kind,
+                               timers=('deserialize', 'process', 'handle', 'refresh'),
+                               address=metrics, interval=metrics_interval)
+        # Flag to tell receiver if its active (viewed int the foreground);
+        # None until set the first time
+        self._active = None
         # Standard is unidirectional communication with PUB/SUB pattern
         self.socket_type = zmq.SUB
 
@@ -103,60 +391,112 @@ class Receiver(QtCore.QObject):
 
         # Qtimer to detach plot refresh rate from data rate
         self.refresh_timer = QtCore.QTimer()
-        self.refresh_timer.timeout.connect(self.refresh_data)
+        self.refresh_timer.timeout.connect(self._refresh_data)
+        self._ack_pending = False  # conflated data handled, not refreshed
         self.refresh_rate = None  # go as fast as data
+        self._trace = None  # trace of the latest handled data
+        self.refresh_time = None  # running mean of the refresh_data() time
+        self.n_refreshed = 0
 
         self._deprecation_warning_handle_data_issued = False
 
     def set_bidirectional_communication(self):
         self.socket_type = zmq.DEALER
 
-    def setup_receiver_device(self):  # start new receiver thread
+    def setup_receiver_device(self):
         logging.info("Start %s receiver %s at %s", self.kind, self.name,
                      self.frontend_address)
-        self.thread = QtCore.QThread()  # no parent
-
-        self.worker = DataWorker(self.deserialize_data)  # no parent
-        # move worker instance to new thread
-        self.worker.moveToThread(self.thread)
+        self.worker = DataWorker(self.deserialize_data, self.metrics,
+                                 conflate=self.conflate,
+                                 processor=self._get_processor())  # no parent
 
     # Slot called if the receiver tab widget gets active
     def active(self, value):
+        if value == self._active:
+            return
         self._active = value
+        # Inactive receivers only deserialize the received data to
+        # process it (see process_data())
+        self.worker.set_active(value)
+        # Nobody looks at the data, thus the converter can pause
+        if self.pause_upstream and self.socket_type == zmq.DEALER:
+            self.send_command({'__control__': 'resume' if value else 'pause',
+                               'receiver': self._id})
 
     def start(self):
-        # Connect to ZMQ publisher
-        self.worker.connect_zmq(self.frontend_address, self.socket_type)
-        # Quit thread on worker finished
-        self.worker.finished.connect(self.thread.quit)
-        # Activate data handle
+        # Activate data handle; data is emitted in the thread pool of the
+        # engine and handled in this thread
+        self.worker.trace.connect(self._set_trace)
         self.worker.data.connect(self.handle_data_if_active)
-
-        # Start receive data loop when thread starts
-        self.thread.started.connect(self.worker.receive_data)
-        # Print on thread finished info
-        self.thread.finished.connect(self.finished_info)
-        self.thread.start()  # start thread
+        self.worker.data_batch.connect(self._handle_data_batch_if_active)
+        if self._own_engine:
+            self.engine = ReceiveEngine(n_threads=1)
+        # Connect to ZMQ publisher
+        self.engine.register(self.worker, self.frontend_address,
+                             self.socket_type, hwm=self.hwm,
+                             topics=self.topics)
+        self.engine.start()
 
     def shutdown(self):
-        # Set signal to quit receive loop; can take some time
-        self.worker.shutdown()
-        # Tell thread to exit, loop is/should be terminated already
-        self.thread.exit()
-        # Delay needed if thread did not exit yet, otherwise message:
-        # QThread: Destroyed while thread is still running
-        self.thread.wait(500)
-
-    def finished_info(self):  # called when thread finished successfully
+        if self.engine is None:  # not started
+            return
+        if self._own_engine:
+            self.engine.shutdown()
+        else:
+            self.engine.unregister(self.worker)
         logging.info("Close %s receiver %s at %s", self.kind, self.name,
                      self.frontend_address)
 
     def handle_data_if_active(self, data):
         ''' Forwards data to data handling function if reveiver is active'''
         if self._active:
-            self.handle_data(data)
+            with self.metrics.timer('handle'):
+                self.handle_data(data)
             if self.refresh_rate is None:
-                self.refresh_data()
+                self._refresh_data()
+
+    def _handle_data_batch_if_active(self, data):
+        ''' Forwards conflated data to handle_data_batch() if receiver is
+            active; the worker hands over new data once it is refreshed
+        '''
+        if self._active:
+            with self.metrics.timer('handle'):
+                self.handle_data_batch(data)
+            if self.refresh_rate is None:
+                self._refresh_data()
+            elif self.refresh_rate:
+                self._ack_pending = True
+                return
+        self.worker.ack()
+
+    def _acknowledge(self):
+        if self._ack_pending:
+            self._ack_pending = False
+            self.worker.ack()
+
+    def _set_trace(self, trace):
+        if self._active:
+            self._trace = trace
+
+    def _refresh_data(self):
+        start_time = time.time()
+        with self.metrics.timer('refresh'):
+            self.refresh_data()
+        refresh_time = time.time() - start_time
+        self.refresh_time = refresh_time if self.refresh_time is None else 0.8 * self.refresh_time + 0.2 * refresh_time
+        self.n_refreshed += 1
+        # The latency of the data is measured when shown
+        if self._trace:
+            tracing.stamp(self._trace, self.name, 'refresh')
+            tracing.record_latencies(self.metrics, self._trace)
+            self._trace = None
+        self._acknowledge()
+
+    def _get_processor(self):
+        # Data is only processed in the receive thread if requested
+        if type(self).process_data is Receiver.process_data:
+            return None
+        return self.process_data
 
     def setup_receiver(self):
         ''' Method can be defined to setup receiver specific parameters
@@ -168,6 +508,21 @@ class Receiver(QtCore.QObject):
         raise NotImplementedError('You have to implement a setup_widgets '
                                   'method!')
 
+    def process_data(self, data):
+        ''' Process data in the receive thread
+
+            Called for every deserialized data dictionary before it is handed
+            over to the GUI thread, also while the receiver is not shown.
+            Can be overwritten to do heavy work (e.g. accumulating
+            histograms) without blocking the GUI. Write
+            the results into a utils.double_buffer.DoubleBuffer and take them
+            in refresh_data(). Do not access widgets here!
+
+            Return the data to hand over to handle_data() or None. If no
+            data is handed over a refresh rate has to be set to refresh.
+        '''
+        return data
+
     def handle_data(self, data):
         ''' Handle data
 
@@ -177,6 +532,15 @@ class Receiver(QtCore.QObject):
         raise NotImplementedError('You have to implement a handle_data '
                                   'method!')
 
+    def handle_data_batch(self, data):
+        ''' Handle a list of data dictionaries (see conflate)
+
+            Std. is to call handle_data() for every item. Can be overwritten
+            to handle the data at once.
+        '''
+        for actual_data in data:
+            self.handle_data(actual_data)
+
     def refresh_data(self):
         ''' Method can be defined to detach data handling from refreshing plot data
         '''
@@ -186,6 +550,23 @@ class Receiver(QtCore.QObject):
             self._deprecation_warning_handle_data_issued = True
 
 
+    def set_topics(self, topics):
+        ''' Receive only messages with a topic starting with one of the
+            topics; all messages if None
+        '''
+        self.topics = topics
+        self.worker.set_topics(topics)
+
+    def subscribe(self, topic):
+        ''' Receive the messages with the topic in addition to the
+            subscribed topics; if no topics were set only these messages
+        '''
+        self.set_topics((self.topics or []) + [topic])
+
+    def unsubscribe(self, topic):
+        ''' Stop receiving the messages with the topic '''
+        self.set_topics([actual_topic for actual_topic in self.topics or [] if actual_topic != topic])
+
     def send_command(self, command):
         ''' Send command to transceiver
 
@@ -194,5 +575,10 @@ class Receiver(QtCore.QObject):
         self.worker.send_data(command)
 
     def deserialize_data(self, data):
-        ''' Has to convert the data do a python dict '''
+        ''' Has to convert the data do a python dict
+
+            Data is a list of frames for multipart messages, bytes otherwise
+        '''
+        if isinstance(data, list):
+            return utils.multipart_dec(data)
         return zmq.utils.jsonapi.loads(data, object_hook=utils.json_numpy_obj_hook)
@@ -0,0 +1,57 @@
+class RefreshController(object):
+
+    '''Adapts the refresh rates of receivers to a budget of GUI time.
+
+    The refresh_data() methods of all receivers run in the GUI thread. The
+    controller sets the refresh rates of the receivers in auto mode from
+    their measured refresh time (see Receiver.refresh_time), thus the
+    refreshs take at most the given fraction of the GUI time. Active
+    receivers (shown tab) share the budget first, the other receivers share
+    what is left.
+
+    Parameter
+    ----------
+    budget : number
+        Fraction of the GUI time to spend in refresh_data() of all receivers
+    max_rate : number
+        Maximum refresh rate in Hz
+    min_rate : number
+        Minimum refresh rate in Hz, also if the budget is exceeded
+    '''
+
+    def __init__(self, budget=0.5, max_rate=30., min_rate=1.):
+        self.budget = budget
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.receivers = []  # receivers in auto mode
+
+    def set_auto(self, receiver, auto):
+        if auto and receiver not in self.receivers:
+            self.receivers.append(receiver)
+        elif not auto and receiver in self.receivers:
+            self.receivers.remove(receiver)
+
+    def get_rates(self):
+        ''' Refresh rates of the receivers in auto mode '''
+        rates, budget = {}, self.budget
+        active = [receiver for receiver in self.receivers if receiver.is_active]
+        inactive = [receiver for receiver in self.receivers if not receiver.is_active]
+        for receivers in (active, inactive):
+            if not receivers:
+                continue
+            share = max(budget, 0.) / len(receivers)
+            for receiver in receivers:
+                refresh_time = receiver.refresh_time or 0.
+                rate = min(self.max_rate, share / refresh_time) if refresh_time else self.max_rate
+                rates[receiver] = max(self.min_rate, rate)
+                budget -= rates[receiver] * refresh_time
+        return rates
+
+    def update(self):
+        ''' Set the refresh rates; call regularly '''
+        for receiver, rate in self.get_rates().items():
+            rate = round(rate, 1)
+            # Restarting the refresh timer delays the refresh, thus only
+            # change significantly
+            if not receiver.refresh_rate or abs(rate - receiver.refresh_rate) > 0.1 * receiver.refresh_rate:
+                receiver.refresh_rate = rate
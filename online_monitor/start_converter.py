@@ -7,7 +7,7 @@ def main():
     args = utils.parse_arguments()
     utils.setup_logging(args.log)
 
-    cm = ConverterManager(args.config_file)
+    cm = ConverterManager(args.config_file, loglevel=args.log, metrics=args.metrics)
     cm.start()  # blocking function, returns on SIGTERM signal
 
 if __name__ == '__main__':
@@ -0,0 +1,14 @@
+#!/usr/bin/env python
+from online_monitor.utils import utils
+from online_monitor.receiver.headless_receiver_manager import HeadlessReceiverManager
+
+
+def main():
+    args = utils.parse_arguments()
+    utils.setup_logging(args.log)
+
+    hm = HeadlessReceiverManager(args.config_file, loglevel=args.log, metrics=args.metrics)
+    hm.start()  # blocking function, returns on SIGTERM signal
+
+if __name__ == '__main__':
+    main()
@@ -8,7 +8,7 @@ from PyQt6 import QtWidgets
 
 
 from online_monitor.utils import settings
-from online_monitor.OnlineMonitor import OnlineMonitorApplication
+from online_monitor.OnlineMonitor import OnlineMonitorApplication, start_windows, stop_windows
 from online_monitor.utils import utils
 
 
@@ -47,6 +47,7 @@ def main():
 # Helper function to run code after OnlineMonitor Application exit
     def appExec():
         app.exec()
+        stop_windows(windows)
         # Stop other processes
         try:
             kill(producer_sim_process)
@@ -56,7 +57,9 @@ def main():
             kill(converter_manager_process)
         except psutil.NoSuchProcess:  # If the process was never started it cannot be killed
             pass
-    # Start the online monitor
+    # Start the online monitor, receivers of additional windows are shown
+    # by their own processes
+    windows = start_windows(args.config_file, loglevel=args.log)
     app = QtWidgets.QApplication(sys.argv)
     win = OnlineMonitorApplication(args.config_file)
     win.show()
@@ -9,8 +9,16 @@ import os
 import zmq
 import psutil
 import signal
+import queue
+import json
+import numpy as np
 
 import online_monitor
+from online_monitor.utils import utils, tracing
+from online_monitor.converter import transceiver
+from online_monitor.converter.transceiver import Transceiver
+from online_monitor.converter.async_transceiver import AsyncTransceiver
+from online_monitor.utils.data_buffer import DataBuffer
 
 # Get the absoulte path of the online_monitor installation
 package_path = os.path.dirname(online_monitor.__file__)
@@ -255,6 +263,448 @@ class TestConverter(unittest.TestCase):
             self.assertNotEqual(converter_manager_process.poll(), None)
 
 
+class BatchConverter(Transceiver):
+
+    def interpret_data(self, data):
+        return [actual_data[1] for actual_data in data]
+
+    def set_load_level(self, level):
+        self.load_levels.append(level)
+
+
+class TopicConverter(BatchConverter):
+    ''' Publishes the data with the topic set in the data '''
+
+    def get_topic(self, data):
+        return data['topic']
+
+
+class FailingWorkerConverter(BatchConverter):
+    ''' Cannot be set up in the interpretation workers '''
+
+    def setup_interpretation(self):
+        if transceiver._worker_converter is self:
+            raise RuntimeError('Converter cannot be set up in the worker')
+
+
+class AsyncCommandConverter(AsyncTransceiver):
+    ''' Sends the received data with the latest command '''
+
+    def setup_transceiver(self):
+        self.set_bidirectional_communication()
+
+    def setup_interpretation(self):
+        self.command = None
+
+    def interpret_data(self, data):
+        return [dict(actual_data[1], command=self.command) for actual_data in data]
+
+    def handle_command(self, commands):
+        self.command = commands[-1]
+
+
+class FakeProcess(object):
+    ''' Replaces psutil.Process to set the cpu load '''
+
+    def __init__(self):
+        self.cpu_load = 0.
+
+    def cpu_percent(self):
+        return self.cpu_load
+
+    def children(self):
+        return []
+
+
+class TestTransceiver(unittest.TestCase):
+
+    def test_batch_interpretation(self):
+        ''' Check draining of the buffer into batches and batch interpretation '''
+        converter = BatchConverter(frontend='tcp://127.0.0.1:5500',
+                                   backend='tcp://127.0.0.1:5501',
+                                   kind='batch_converter', batch_size=3,
+                                   batch_bytes=250)
+        converter.raw_data = DataBuffer()
+        for index in range(5):
+            # Only the second message is traced
+            trace = {'seq': index} if index == 1 else None
+            converter.raw_data.put(([('address', index)], trace), 100)
+        batch, trace = converter._get_batch()  # limited by bytes
+        self.assertEqual(batch, [[('address', 0)], [('address', 1)], [('address', 2)]])
+        self.assertEqual(trace, {'seq': 1})  # latest traced message
+        self.assertEqual(converter.interpret_data_batch(batch), [0, 1, 2])
+        batch, trace = converter._get_batch()
+        self.assertEqual(converter.interpret_data_batch(batch), [3, 4])
+        self.assertIsNone(trace)
+        self.assertEqual(converter._get_batch(timeout=0.1), ([], None))  # no data
+        converter.raw_data.put_signal()
+        self.assertEqual(converter._get_batch(), ([], None))  # woken up
+
+    def test_load_shedding(self):
+        ''' Check the load level controller '''
+        converter = BatchConverter(frontend='tcp://127.0.0.1:5500',
+                                   backend='tcp://127.0.0.1:5501',
+                                   kind='batch_converter', target_load=50)
+        converter.load_levels = []
+        converter.process = FakeProcess()
+        converter.cpu_load, converter._children = 0., {}
+
+        def measure(cpu_load, n_times):
+            converter.process.cpu_load = cpu_load
+            for _ in range(n_times):
+                converter._last_load_measurement = 0.  # force new measurement
+                converter._update_load()
+
+        measure(100., 4)  # first measurement is filtered below target
+        self.assertEqual(converter.load_levels, [1, 2, 3])
+        converter.cpu_load = 45.
+        measure(45., 3)  # within hysteresis, no change
+        self.assertEqual(converter.load_level, 3)
+        measure(10., 20)
+        self.assertEqual(converter.load_levels, [1, 2, 3, 2, 1, 0])
+        measure(1000., 20)
+        self.assertEqual(converter.load_level, converter.max_load_level)
+        # Every level skips a bit more of the messages, evenly spaced
+        converter.load_shedding, converter.n_skipped = 'skip', 0
+        for load_level, n_kept in ((0, 110), (1, 100), (2, 90), (5, 60), (10, 10)):
+            converter.load_level, converter._keep_credit = load_level, 1.
+            self.assertEqual(len(converter._shed_load(list(range(110)))), n_kept)
+        converter.load_level, converter._keep_credit = 6, 1.
+        self.assertEqual(converter._shed_load(list(range(11))), [0, 3, 5, 7, 9])
+        self.assertEqual(converter.n_skipped, 10 + 20 + 50 + 100 + 6)
+
+    def test_pause(self):
+        ''' Check the interpretation while paused by the receivers '''
+        for pause_decimation, skipped in ((None, [True] * 6), (3, [True, True, False] * 2)):
+            converter = BatchConverter(frontend='tcp://127.0.0.1:5500',
+                                       backend='tcp://127.0.0.1:5501',
+                                       kind='batch_converter',
+                                       pause_decimation=pause_decimation)
+            converter._setup_state()
+            self.assertFalse(converter._skip_paused())
+            converter._handle_control('pause', 'receiver 1')
+            self.assertListEqual([converter._skip_paused() for _ in range(6)], skipped)
+            converter._handle_control('resume', 'receiver 1')
+            self.assertFalse(converter._skip_paused())
+        # Paused as long as one of the receivers requests it
+        converter._handle_commands([{'__control__': 'pause', 'receiver': 'receiver 1'},
+                                    {'__control__': 'pause', 'receiver': 'receiver 2'},
+                                    {'__control__': 'resume', 'receiver': 'receiver 1'}])
+        self.assertTrue(converter.paused.is_set())
+        converter._handle_commands([{'__control__': 'resume', 'receiver': 'receiver 2'}])
+        self.assertFalse(converter.paused.is_set())
+
+    def test_drop_policies(self):
+        ''' Check the data buffer drop policies '''
+        def fill_buffer(**kwargs):
+            data_buffer = DataBuffer(**kwargs)
+            for index in range(5):
+                data_buffer.put(index, 100)
+            items = []
+            while data_buffer.qsize():
+                items.append(data_buffer.get()[0])
+            return data_buffer, items
+
+        data_buffer, items = fill_buffer(max_items=2, drop_policy='oldest')
+        self.assertEqual(items, [3, 4])
+        self.assertEqual(data_buffer.n_dropped, 3)
+        self.assertAlmostEqual(data_buffer.sampling_factor, 2.5)
+        data_buffer, items = fill_buffer(max_bytes=250, drop_policy='newest')
+        self.assertEqual(items, [0, 1])
+        self.assertEqual(data_buffer.n_bytes, 0)
+        data_buffer, items = fill_buffer(drop_policy='latest')
+        self.assertEqual(items, [4])
+        data_buffer, items = fill_buffer(max_items=2, drop_policy='sample',
+                                         sample_fraction=1.)
+        self.assertEqual(items, [3, 4])
+        data_buffer, items = fill_buffer(max_items=2, drop_policy='sample',
+                                         sample_fraction=0.)
+        self.assertEqual(items, [0, 1])
+        with self.assertRaises(queue.Empty):
+            data_buffer.get(block=False)
+        with self.assertRaises(ValueError):
+            DataBuffer(drop_policy='unknown')
+        # The sampling factor of the converter is published in the metrics
+        converter = BatchConverter(frontend='tcp://127.0.0.1:5500',
+                                   backend='tcp://127.0.0.1:5501',
+                                   kind='batch_converter')
+        converter.raw_data, _ = fill_buffer(max_items=2, drop_policy='sample',
+                                            sample_fraction=0.)
+        converter.n_skipped, converter.cpu_load = 0, 0.
+        converter.sequence_checker = tracing.SequenceChecker()
+        converter._publish_metrics()
+        self.assertAlmostEqual(converter.metrics.sampling_factor, 2.5)
+
+    def test_pipeline(self):
+        ''' Pass data through the stages of a pipeline without serialization '''
+        converter = utils.load_converter('pipeline', base_class_type=Transceiver,
+                                         *(),
+                                         **{'frontend': 'tcp://127.0.0.1:5700',
+                                            'backend': 'tcp://127.0.0.1:5701',
+                                            'kind': 'pipeline',
+                                            'name': 'DUT',
+                                            'stages': [{'kind': 'example_converter',
+                                                        'threshold': 1,
+                                                        'tap': 'tcp://127.0.0.1:5702'},
+                                                       {'kind': 'example_histogrammer'}]})
+        self.assertEqual([stage.kind for stage in converter.stages], ['example_converter', 'example_histogrammer'])
+        converter.setup_interpretation()
+        raw_data = [[('tcp://127.0.0.1:5700', {'time_stamp': time_stamp, 'position': np.ones((10, 10))})]
+                    for time_stamp in range(3)]
+        data = converter.interpret_data_batch(raw_data)
+        # Data of the tapped first stage and of the last stage
+        self.assertEqual([index for index, _ in data], [0, 0, 0, 1, 1, 1])
+        self.assertTrue((data[-1][1]['position_histogram_DUT'] == 3).all())
+        self.assertEqual(data[-1][1]['time_stamp'], 2)
+        # No data if the first stage returns None
+        self.assertEqual(converter.interpret_data_batch([[('tcp://127.0.0.1:5700', {'time_stamp': 3, 'position': np.zeros((10, 10))})]]), [])
+        with self.assertRaises(ValueError):  # last stage with tap
+            utils.load_converter('pipeline', base_class_type=Transceiver, *(),
+                                 **{'frontend': 'tcp://127.0.0.1:5700', 'backend': 'tcp://127.0.0.1:5701',
+                                    'kind': 'pipeline', 'stages': [{'kind': 'example_converter', 'threshold': 1,
+                                                                    'tap': 'tcp://127.0.0.1:5702'}]})
+
+    def test_pipeline_taps(self):
+        ''' Tapped data is send with trace trailer and topic frame '''
+        converter = utils.load_converter('pipeline', base_class_type=Transceiver,
+                                         *(),
+                                         **{'frontend': 'tcp://127.0.0.1:5700',
+                                            'backend': 'tcp://127.0.0.1:5701',
+                                            'kind': 'pipeline',
+                                            'name': 'DUT',
+                                            'sequence': True,
+                                            'publish_topics': True,
+                                            'stages': [{'kind': 'example_converter',
+                                                        'name': 'THR',
+                                                        'threshold': 1,
+                                                        'tap': 'tcp://127.0.0.1:5702'},
+                                                       {'kind': 'example_histogrammer'}]})
+        converter.context = zmq.Context()
+        converter._setup_backend()
+        converter._setup_state()
+        converter.setup_interpretation()
+        receivers = []
+        for address in ('tcp://127.0.0.1:5701', 'tcp://127.0.0.1:5702'):
+            receiver = converter.context.socket(zmq.SUB)
+            receiver.setsockopt(zmq.SUBSCRIBE, b'')
+            receiver.connect(address)
+            receivers.append(receiver)
+        time.sleep(0.5)
+        for time_stamp in range(3):
+            converter.send_data(converter.interpret_data_batch(
+                [[('tcp://127.0.0.1:5700', {'time_stamp': time_stamp, 'position': np.ones((10, 10))})]]))
+        received = []
+        for receiver in receivers:
+            received.append([])
+            while receiver.poll(500):
+                frames, topic = utils.split_topic(receiver.recv_multipart())
+                frames, trace = tracing.split_trace(frames)
+                received[-1].append((topic, trace['seq']))
+            receiver.close()
+        converter.context.destroy(linger=0)
+        # Every stream has its own sequence numbers
+        self.assertListEqual(received, [[('DUT', seq) for seq in range(3)],
+                                        [('THR', seq) for seq in range(3)]])
+        self.assertEqual(converter.metrics.messages_out, 6)
+
+    def test_lazy_deserialization(self):
+        ''' Decode only the arrays accessed by the interpretation '''
+        converter = utils.load_converter('example_histogrammer',
+                                         base_class_type=Transceiver,
+                                         *(),
+                                         **{'frontend': 'tcp://127.0.0.1:5700',
+                                            'backend': 'tcp://127.0.0.1:5701',
+                                            'kind': 'example_histogrammer',
+                                            'name': 'DUT',
+                                            'lazy': True})
+        converter.setup_interpretation()
+        data = {'time_stamp': 1, 'position': np.ones((10, 10)), 'unused': np.ones(1000)}
+        raw_data = converter.deserialize_data(json.dumps(data, cls=utils.NumpyEncoder).encode('utf-8'))
+        self.assertIsInstance(raw_data, utils.LazyMessage)
+        data = converter.interpret_data([('tcp://127.0.0.1:5700', raw_data)])
+        self.assertTrue((data[0]['position_histogram_DUT'] == 1).all())
+        self.assertNotIn('unused', raw_data._decoded)
+
+    def test_topics(self):
+        ''' Filter the received and send data by topic '''
+        converter = utils.load_converter('example_converter',
+                                         base_class_type=Transceiver,
+                                         *(),
+                                         **{'frontend': 'tcp://127.0.0.1:5700',
+                                            'backend': 'tcp://127.0.0.1:5701',
+                                            'kind': 'example_converter',
+                                            'name': 'DUT',
+                                            'threshold': 1,
+                                            'topics': ['raw_data'],
+                                            'publish_topics': True})
+        converter.start()
+        context = zmq.Context()
+        sender = context.socket(zmq.PUB)
+        sender.bind(r'tcp://127.0.0.1:5700')
+        receivers = []
+        for topic in ('DUT', 'OTHER'):
+            receiver = context.socket(zmq.SUB)
+            receiver.connect(r'tcp://127.0.0.1:5701')
+            receiver.setsockopt(zmq.SUBSCRIBE, utils.topic_frame(topic))
+            receivers.append(receiver)
+        time.sleep(3)
+        for time_stamp in range(10):
+            topic = 'raw_data' if time_stamp % 2 else 'meta_data'
+            sender.send_multipart([utils.topic_frame(topic),
+                                   json.dumps({'time_stamp': time_stamp, 'position': np.ones((10, 10))},
+                                              cls=utils.NumpyEncoder).encode('utf-8')])
+        time.sleep(1.5)
+        time_stamps = []
+        for receiver in receivers:
+            time_stamps.append([])
+            while True:
+                try:
+                    frames = receiver.recv_multipart(flags=zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                frames, topic = utils.split_topic(frames)
+                self.assertEqual(topic, 'DUT')
+                time_stamps[-1].append(json.loads(frames[0])['time_stamp'])
+            receiver.close()
+        converter.shutdown()
+        converter.join(timeout=5)
+        sender.close()
+        context.term()
+        self.assertListEqual(time_stamps, [[1, 3, 5, 7, 9], []])
+        self.assertEqual(converter.exitcode, 0)
+
+    def test_topic_sequences(self):
+        ''' Every topic has its own sequence numbers, thus subscribers
+            filtering topics do not see lost messages
+        '''
+        converter = TopicConverter(frontend='tcp://127.0.0.1:5700',
+                                   backend='tcp://127.0.0.1:5701',
+                                   kind='topic_converter',
+                                   sequence=True,
+                                   publish_topics=True)
+        converter.context = zmq.Context()
+        converter._setup_backend()
+        converter._setup_state()
+        receiver = converter.context.socket(zmq.SUB)
+        receiver.setsockopt(zmq.SUBSCRIBE, utils.topic_frame('hit_hist'))
+        receiver.connect('tcp://127.0.0.1:5701')
+        time.sleep(0.5)
+        converter.send_data([{'topic': 'hit_hist' if index % 3 else 'occupancy', 'index': index}
+                             for index in range(9)])
+        sequence_checker = tracing.SequenceChecker()
+        while receiver.poll(500):
+            frames, topic = utils.split_topic(receiver.recv_multipart())
+            frames, trace = tracing.split_trace(frames)
+            self.assertEqual(topic, 'hit_hist')
+            sequence_checker.check(topic, trace['seq'])
+        converter.context.destroy(linger=0)
+        self.assertEqual((sequence_checker.n_received, sequence_checker.n_lost), (6, 0))
+        # The receiving converter checks the sequence numbers per topic
+        converter._setup_state()
+        for seq, topic in enumerate(('hit_hist', 'occupancy', 'hit_hist')):
+            converter._split_received('tcp://127.0.0.1:5700', [utils.topic_frame(topic), b'{}',
+                                                               tracing.pack(tracing.new_trace(seq // 2))])
+        self.assertEqual(converter.sequence_checker.n_lost, 0)
+
+    def test_interpretation_workers(self):
+        ''' Interpret data in several worker processes and check the order '''
+        converter = utils.load_converter('example_converter',
+                                         base_class_type=Transceiver,
+                                         *(),
+                                         **{'frontend': 'tcp://127.0.0.1:5700',
+                                            'backend': 'tcp://127.0.0.1:5701',
+                                            'kind': 'example_converter',
+                                            'name': 'DUT',
+                                            'threshold': 1,
+                                            'n_workers': 3})
+        converter.start()
+        context = zmq.Context()
+        sender = context.socket(zmq.PUB)
+        sender.bind(r'tcp://127.0.0.1:5700')
+        receiver = context.socket(zmq.SUB)
+        receiver.connect(r'tcp://127.0.0.1:5701')
+        receiver.setsockopt_string(zmq.SUBSCRIBE, u'')
+        time.sleep(3)
+        for time_stamp in range(10):
+            sender.send_json({'time_stamp': time_stamp,
+                              'position': np.ones((10, 10))},
+                             cls=utils.NumpyEncoder)
+        time.sleep(1.5)
+        time_stamps = []
+        while True:
+            try:
+                time_stamps.append(receiver.recv_json(flags=zmq.NOBLOCK)['time_stamp'])
+            except zmq.Again:
+                break
+        converter.shutdown()
+        converter.join(timeout=5)
+        sender.close()
+        receiver.close()
+        context.term()
+        self.assertListEqual(time_stamps, list(range(10)))
+        self.assertEqual(converter.exitcode, 0)
+
+    def test_interpretation_worker_setup(self):
+        ''' Create the converter in the workers from its class, pass the load
+            level and stop if the workers cannot create the converter
+        '''
+        sigint_handler = signal.getsignal(signal.SIGINT)
+        try:
+            transceiver._setup_worker(BatchConverter, {'frontend': 'tcp://127.0.0.1:5700',
+                                                       'backend': 'tcp://127.0.0.1:5701',
+                                                       'kind': 'batch_converter',
+                                                       'loglevel': 'INFO'})
+            transceiver._worker_converter.load_levels = []
+            self.assertTrue(transceiver._check_worker())
+            self.assertEqual(transceiver._interpret_in_worker([[('address', 0)]], 2), [0])
+            self.assertEqual(transceiver._interpret_in_worker([[('address', 1)]], 2), [1])
+            self.assertEqual(transceiver._worker_converter.load_levels, [2])
+        finally:
+            transceiver._worker_converter = None
+            signal.signal(signal.SIGINT, sigint_handler)
+        converter = FailingWorkerConverter(frontend='tcp://127.0.0.1:5700',
+                                           backend='tcp://127.0.0.1:5701',
+                                           kind='failing_worker_converter',
+                                           n_workers=2)
+        converter.start()
+        converter.join(timeout=20)
+        self.assertFalse(converter.is_alive())
+        self.assertNotEqual(converter.exitcode, 0)
+
+    def test_async_transceiver(self):
+        ''' Receive, interpret and send data and commands on one event loop '''
+        for settings in ({}, {'interpret_in_thread': True, 'batch_size': 3}):
+            converter = AsyncCommandConverter(frontend='tcp://127.0.0.1:5700',
+                                              backend='tcp://127.0.0.1:5701',
+                                              kind='async_command_converter',
+                                              name='DUT', **settings)
+            converter.start()
+            context = zmq.Context()
+            sender = context.socket(zmq.PUB)
+            sender.bind(r'tcp://127.0.0.1:5700')
+            receiver = context.socket(zmq.DEALER)
+            receiver.connect(r'tcp://127.0.0.1:5701')
+            time.sleep(3)
+            receiver.send_json('first')
+            time.sleep(0.5)
+            for time_stamp in range(10):
+                sender.send_json({'time_stamp': time_stamp, 'position': np.ones((10, 10))},
+                                 cls=utils.NumpyEncoder)
+            time.sleep(1.5)
+            data = []
+            while receiver.poll(100):
+                data.append(json.loads(receiver.recv(), object_hook=utils.json_numpy_obj_hook))
+            converter.shutdown()
+            converter.join(timeout=5)
+            sender.close()
+            receiver.close()
+            context.term()
+            self.assertListEqual([actual_data['time_stamp'] for actual_data in data], list(range(10)))
+            self.assertTrue((data[-1]['position'] == 1).all())
+            self.assertEqual(set(actual_data['command'] for actual_data in data), {'first'})
+            self.assertEqual(converter.exitcode, 0)
+
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestConverter)
     unittest.TextTestRunner(verbosity=2).run(suite)
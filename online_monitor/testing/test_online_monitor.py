@@ -7,11 +7,19 @@ import yaml
 import subprocess
 import time
 import os
+import json
 import psutil
-from PyQt6 import QtWidgets
+import zmq
+from PyQt6 import QtWidgets, QtCore
+from testfixtures import log_capture
 
 import online_monitor
 from online_monitor import OnlineMonitor
+from online_monitor.receiver.receiver import DataWorker
+from online_monitor.receiver.receive_engine import ReceiveEngine
+from online_monitor.receiver.refresh_controller import RefreshController
+from online_monitor.receiver.headless_receiver import HeadlessReceiver
+from online_monitor.utils.metrics import Metrics
 
 # Get package path
 # Get the absoulte path of the online_monitor installation
@@ -161,6 +169,216 @@ class TestOnlineMonitor(unittest.TestCase):
                          3, 'Number of tab widgets wrong')  # 2 receiver + status widget expected
 
 
+class TestDataWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = ReceiveEngine(n_threads=2)
+        self.context = zmq.Context()
+        self.sender = self.context.socket(zmq.PUB)
+        self.sender.bind('tcp://127.0.0.1:6700')
+
+    def tearDown(self):
+        self.engine.shutdown()
+        self.sender.close()
+        self.context.term()
+
+    def start_worker(self, deserializer, **kwargs):
+        worker = DataWorker(deserializer, Metrics(name='DUT', kind='receiver'), **kwargs)
+        worker.set_active(True)
+        self.engine.register(worker, 'tcp://127.0.0.1:6700', zmq.SUB)
+        self.engine.start()
+        return worker
+
+    def test_receive_engine(self):
+        received = [[], []]
+        for index in range(2):  # two workers receiving in one engine
+            worker = self.start_worker(json.loads)
+            # Direct connection, since no Qt event loop is running
+            worker.data.connect(lambda data, index=index: received[index].append(data['index']),
+                                QtCore.Qt.ConnectionType.DirectConnection)
+        time.sleep(0.5)  # wait for the subscription
+        for index in range(10):
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        self.assertListEqual(received, [list(range(10))] * 2)  # in order
+        self.engine.unregister(worker)
+        self.sender.send_json({'index': 10})
+        time.sleep(0.5)
+        self.assertListEqual([len(actual_received) for actual_received in received], [11, 10])
+
+    def test_conflation(self):
+        worker = self.start_worker(lambda data: json.loads(data)['index'], conflate=2)
+        batches = []
+        worker.data_batch.connect(batches.append, QtCore.Qt.ConnectionType.DirectConnection)
+        time.sleep(0.5)  # wait for the subscription
+        self.sender.send_json({'index': 0})
+        time.sleep(0.5)
+        for index in range(1, 6):
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        self.assertListEqual(batches, [[0]])  # previous data not handled yet
+        worker.ack()
+        time.sleep(0.5)
+        self.assertListEqual(batches, [[0], [4, 5]])  # latest messages only
+        self.assertEqual(worker.n_conflated, 3)
+
+    @log_capture()
+    def test_handling_error(self, log):
+        def deserialize(data):
+            index = json.loads(data)['index']
+            if index == 1:
+                raise ValueError('Cannot deserialize')
+            return {'index': index}
+
+        worker = self.start_worker(deserialize)
+        received = []
+        worker.data.connect(lambda data: received.append(data['index']),
+                            QtCore.Qt.ConnectionType.DirectConnection)
+        time.sleep(0.5)  # wait for the subscription
+        for index in range(5):
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        self.assertListEqual(received, [0, 2, 3, 4])  # following data is still handled
+        self.assertEqual(worker.n_dropped, 1)
+        self.assertIn('cannot handle the received data', str(log))
+
+    def test_process_data(self):
+        processed = []
+
+        def process(data):  # hand over only every second data
+            processed.append(data)
+            return data if data['index'] % 2 else None
+
+        worker = self.start_worker(json.loads, processor=process)
+        handed_over = []
+        worker.data.connect(lambda data: handed_over.append(data['index']),
+                            QtCore.Qt.ConnectionType.DirectConnection)
+        time.sleep(0.5)  # wait for the subscription
+        for index in range(5):
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        self.assertListEqual([data['index'] for data in processed], [0, 1, 2, 3, 4])
+        self.assertListEqual(handed_over, [1, 3])
+        self.assertEqual(worker.metrics.histograms[worker.metrics.timers.index('process')].sum(), 5)
+        # Data of inactive receivers is processed but not handed over
+        worker.set_active(False)
+        for index in range(5, 8):
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        self.assertListEqual([data['index'] for data in processed], list(range(8)))
+        self.assertListEqual(handed_over, [1, 3])
+
+
+class RecordingReceiver(HeadlessReceiver):
+
+    def setup_receiver(self):
+        self.received, self.refreshed = [], []
+
+    def handle_data(self, data):
+        self.received.append(data['index'])
+
+    def refresh_data(self):
+        self.refreshed.append(len(self.received))
+
+
+class TestHeadlessReceiver(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.sender = self.context.socket(zmq.PUB)
+        self.sender.bind('tcp://127.0.0.1:6710')
+
+    def tearDown(self):
+        self.sender.close()
+        self.context.term()
+
+    def receive(self, messages, **kwargs):
+        receiver = RecordingReceiver(frontend='tcp://127.0.0.1:6710', kind='recording_receiver',
+                                     name='DUT', **kwargs)
+        receiver.start()
+        time.sleep(0.5)  # wait for the subscription
+        for index in messages:
+            self.sender.send_json({'index': index})
+        time.sleep(0.5)
+        receiver.shutdown()
+        receiver.join()
+        return receiver
+
+    def test_receive(self):
+        receiver = self.receive(range(10))
+        self.assertListEqual(receiver.received, list(range(10)))  # in order
+        self.assertListEqual(receiver.refreshed, list(range(1, 11)))  # refreshed on every data
+        self.assertFalse(receiver.thread.is_alive())
+
+    def test_conflation(self):
+        receiver = self.receive(range(10), conflate=2, refresh_rate=0.1)
+        # Only the latest messages of every receive are handled
+        self.assertListEqual(receiver.received[-2:], [8, 9])
+        self.assertLess(len(receiver.received), 10)
+        self.assertEqual(receiver.n_conflated + len(receiver.received), 10)
+        self.assertListEqual(receiver.refreshed, [0])  # refreshed at start only
+
+    def test_send_command(self):
+        ''' The receive thread is woken up to send commands and to stop '''
+        backend = self.context.socket(zmq.DEALER)
+        backend.bind('tcp://127.0.0.1:6711')
+        receiver = RecordingReceiver(frontend='tcp://127.0.0.1:6711', kind='recording_receiver', name='DUT')
+        receiver.set_bidirectional_communication()
+        receiver.start()
+        time.sleep(0.5)  # wait for the connection
+        receiver.send_command({'command': 'reset'})
+        self.assertTrue(backend.poll(50))  # not delayed by polling
+        self.assertEqual(backend.recv_json(), {'command': 'reset'})
+        receiver.shutdown()
+        receiver.join(timeout=0.1)
+        self.assertFalse(receiver.thread.is_alive())
+        backend.close()
+
+
+class FakeReceiver(object):
+
+    def __init__(self, refresh_time, is_active=False):
+        self.refresh_time = refresh_time
+        self.is_active = is_active
+        self.refresh_rate = 10
+
+
+class TestRefreshController(unittest.TestCase):
+
+    def test_rates(self):
+        controller = RefreshController(budget=0.5, max_rate=30., min_rate=1.)
+        shown = FakeReceiver(refresh_time=0.02, is_active=True)
+        cheap = FakeReceiver(refresh_time=0.001)
+        expensive = FakeReceiver(refresh_time=0.1)
+        new = FakeReceiver(refresh_time=None)  # not refreshed yet
+        for receiver in (shown, cheap, expensive, new):
+            controller.set_auto(receiver, True)
+        rates = controller.get_rates()
+        self.assertAlmostEqual(rates[shown], 25.)  # budget of the active receiver
+        self.assertEqual(rates[new], 30.)
+        # The rest of the budget (0.5 s/s - 25 * 0.02 s) is used up
+        self.assertEqual(rates[cheap], 1.)
+        self.assertEqual(rates[expensive], 1.)
+        controller.set_auto(shown, False)
+        rates = controller.get_rates()
+        self.assertEqual(rates[cheap], 30.)
+        self.assertAlmostEqual(rates[expensive], 0.5 / 3 / 0.1)
+        controller.update()
+        self.assertEqual((cheap.refresh_rate, expensive.refresh_rate, new.refresh_rate), (30., 1.7, 30.))
+        self.assertEqual(shown.refresh_rate, 10)  # not in auto mode
+
+
+class TestWindows(unittest.TestCase):
+
+    def test_get_windows(self):
+        configuration = {'receiver': {'DUT0': {'kind': 'example_receiver'},
+                                      'DUT1': {'kind': 'example_receiver', 'window': 'Telescope'},
+                                      'DUT2': {'kind': 'example_receiver', 'window': 'DUT'},
+                                      'DUT3': {'kind': 'example_receiver', 'window': 'Telescope'}}}
+        self.assertEqual(OnlineMonitor.get_windows(configuration), ['DUT', 'Telescope'])
+        self.assertEqual(OnlineMonitor.get_windows({'converter': {}}), [])
+
+
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestOnlineMonitor)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -7,7 +7,8 @@ import zmq
 
 from zmq.tests import BaseZMQTestCase
 
-from online_monitor.utils import utils
+from online_monitor.utils import utils, shared_memory
+from online_monitor.utils.shared_memory import ShmSocket
 
 
 def get_test_raw_data(N=20000):
@@ -87,6 +88,24 @@ def recv_simple(socket):
     return array
 
 
+def send_multipart(socket, data, scan_par_id, name='ReadoutData'):
+    data_with_meta_data = dict(
+        data=data[0],
+        name=name,
+        timestamp_start=data[1],  # float
+        timestamp_stop=data[2],  # float
+        error=data[3],  # int
+        scan_par_id=scan_par_id
+    )
+    socket.send_multipart(utils.multipart_enc(data_with_meta_data), copy=False)
+
+
+def recv_multipart(socket):
+    frames = socket.recv_multipart(copy=False)
+    data_with_meta_data = utils.multipart_dec(frames)
+    return data_with_meta_data['data']
+
+
 def send_std(socket, data, scan_par_id, name='ReadoutData'):
     data_with_meta_data = dict(
         data=data[0],
@@ -158,8 +177,93 @@ class TestSerialization(BaseZMQTestCase):
         A = recv_simple(socket=b)
         self.assertTrue((data[0] == A).all())
 
+    def test_multipart_send_rcv(self):
+        ''' Serialization schema with a json header frame and raw array frames
+
+            Arrays are neither copied on sending nor on receiving.
+            Works also with record arrays
+        '''
+        a, b = self.create_bound_pair(zmq.PAIR, zmq.PAIR)
+        # UInt32 array data
+        data, scan_par_id = get_test_raw_data()
+        send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        A = recv_multipart(socket=b)
+        np.testing.assert_array_equal(data[0], A)
+        # Record array data
+        data, scan_par_id = get_test_rec_array_data()
+        send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        A = recv_multipart(socket=b)
+        self.assertTrue((data[0] == A).all())
+
+    @unittest.skipIf(not shared_memory.has_ipc, 'ipc endpoints are not supported, e.g. under windows')
+    def test_shared_memory_send_rcv(self):
+        ''' Multipart messages with the array frames transported via a shared
+            memory ring buffer
+        '''
+        a = self.context.socket(zmq.PAIR, socket_class=ShmSocket)
+        a.bind('shm://test_serialization?size=1000000')
+        b = self.context.socket(zmq.PAIR, socket_class=ShmSocket)
+        b.connect('shm://test_serialization')
+        time.sleep(0.5)
+        # UInt32 array data
+        data, scan_par_id = get_test_raw_data()
+        send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        A = recv_multipart(socket=b)
+        np.testing.assert_array_equal(data[0], A)
+        # Record array data
+        data, scan_par_id = get_test_rec_array_data()
+        send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        A = recv_multipart(socket=b)
+        self.assertTrue((data[0] == A).all())
+        # Single frame messages, e.g. json or simple_enc buffers
+        data, scan_par_id = get_test_raw_data()
+        send_simple(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        frames = b.recv_multipart()
+        self.assertEqual(len(frames), 1)
+        A, _ = utils.simple_dec(frames[0])
+        np.testing.assert_array_equal(data[0], A)
+        a.send(b'x' * 2000)
+        self.assertEqual(b.recv_multipart(), [b'x' * 2000])
+        # Messages overwritten before they are received are skipped
+        data, scan_par_id = get_test_raw_data()
+        for _ in range(20):  # 1.6 MB > 1 MB ring buffer
+            send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        time.sleep(0.5)
+        n_received = 0
+        while True:
+            try:
+                A = utils.multipart_dec(b.recv_multipart(flags=zmq.NOBLOCK))['data']
+            except zmq.Again:
+                break
+            np.testing.assert_array_equal(data[0], A)
+            n_received += 1
+        self.assertEqual(n_received + b.reader.n_overwritten, 20)
+        self.assertTrue(0 < n_received < 20)
+        a.close()
+        b.close()
+
+    def test_shared_memory_tcp_fallback(self):
+        ''' Descriptors are send via local tcp if ipc is not supported '''
+        has_ipc, shared_memory.has_ipc = shared_memory.has_ipc, False
+        try:
+            self.assertEqual(shared_memory.get_endpoint('test', 5790), 'tcp://127.0.0.1:5790')
+            port = int(shared_memory.get_endpoint('test').rpartition(':')[2])
+            self.assertTrue(shared_memory.MIN_PORT <= port < 65536)
+            a = self.context.socket(zmq.PAIR, socket_class=ShmSocket)
+            a.bind('shm://test_serialization_tcp?size=1000000&port=5790')
+            b = self.context.socket(zmq.PAIR, socket_class=ShmSocket)
+            b.connect('shm://test_serialization_tcp?port=5790')
+        finally:
+            shared_memory.has_ipc = has_ipc
+        time.sleep(0.5)
+        data, scan_par_id = get_test_raw_data()
+        send_multipart(socket=a, data=data, scan_par_id=scan_par_id, name='testdata')
+        A = recv_multipart(socket=b)
+        np.testing.assert_array_equal(data[0], A)
+        a.close()
+        b.close()
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSerialization)
     unittest.TextTestRunner(verbosity=2).run(suite)
-
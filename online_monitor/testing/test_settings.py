@@ -7,6 +7,8 @@ should be untouched.
 import unittest
 import yaml
 import os
+import shutil
+import tempfile
 
 from online_monitor.utils import settings
 
@@ -26,6 +28,17 @@ def create_forwarder_config_yaml(n_converter):
 
 class TestSettings(unittest.TestCase):
 
+    def setUp(self):  # work on a copy, to not change the OnlineMonitor.ini
+        self.tmp_dir = tempfile.mkdtemp()
+        self.file_name = settings._file_name
+        settings._file_name = os.path.join(self.tmp_dir, 'OnlineMonitor.ini')
+        if os.path.isfile(self.file_name):
+            shutil.copy(self.file_name, settings._file_name)
+
+    def tearDown(self):
+        settings._file_name = self.file_name
+        shutil.rmtree(self.tmp_dir)
+
     def test_entities_settings(self):
         settings.add_converter_path(r'C:\\test\\converter\\path')
         settings.add_receiver_path(r'/home/receiver/path')
@@ -47,6 +60,11 @@ class TestSettings(unittest.TestCase):
     def test_interface_settings(self):
         self.assertTupleEqual(settings.get_window_geometry(), (100, 100, 1024, 768), 'This can fail if you started the online monitor once and changed the windows size')
 
+    def test_window_geometry(self):
+        settings.set_window_geometry((10, 20, 300, 400), name='Test window')
+        self.assertTupleEqual(settings.get_window_geometry(name='Test window'), (10, 20, 300, 400))
+        self.assertTupleEqual(settings.get_window_geometry(name='Not stored'), (100, 100, 1024, 768))
+
 
 if __name__ == '__main__':
     suite = unittest.TestLoader().loadTestsFromTestCase(TestSettings)
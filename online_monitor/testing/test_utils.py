@@ -6,12 +6,19 @@ import yaml
 import os
 import numpy as np
 import json
+import time
+import base64
+import pickle
+import threading
+import zmq
 
 from testfixtures import log_capture
 
-from online_monitor.utils import utils, producer_sim
+from online_monitor.utils import utils, producer_sim, metrics, tracing, compression
+from online_monitor.utils.double_buffer import DoubleBuffer
 from online_monitor.converter.transceiver import Transceiver
 from online_monitor.receiver.receiver import Receiver
+from online_monitor.receiver.headless_receiver import HeadlessReceiver
 
 
 # creates a yaml config describing n_converter of type forwarder that are all
@@ -97,13 +104,283 @@ class TestUtils(unittest.TestCase):
             data_serialized, object_hook=utils.json_numpy_obj_hook)
         self.assertTrue((data['array'] == data_deserialized['array']).all())
 
+    def test_multipart_serializer(self):
+        data = {'array': np.ones((100, 101)),
+                'array_t': np.arange(20).reshape((4, 5)).T,
+                'rec_array': np.ones((100, ), dtype=[('event_number', '<i8'),
+                                                     ('trigger_number', '<u4')]),
+                'nested': {'array': np.zeros(10, dtype=np.uint16)},
+                'time_stamp': 1.5}
+        frames = utils.multipart_enc(data)
+        self.assertEqual(len(frames), 5)  # header + 4 array frames
+        data_deserialized = utils.multipart_dec(frames)
+        for key in ('array', 'array_t', 'rec_array'):
+            self.assertTrue((data[key] == data_deserialized[key]).all())
+            self.assertEqual(data[key].dtype, data_deserialized[key].dtype)
+        self.assertTrue((data['nested']['array'] == data_deserialized['nested']['array']).all())
+        self.assertEqual(data_deserialized['time_stamp'], 1.5)
+        # Numpy scalars are converted as with the json serialization
+        data = {'n_hits': np.uint32(3), 'mean': np.float32(1.5)}
+        self.assertEqual(utils.multipart_dec(utils.multipart_enc(data)), {'n_hits': 3, 'mean': 1.5})
+        # Without arrays the header equals the std. json serialization
+        data = {'time_stamp': 1.5, 'name': 'test'}
+        self.assertEqual(utils.multipart_enc(data),
+                         [json.dumps(data, cls=utils.NumpyEncoder).encode('utf-8')])
+
+    def test_codecs(self):
+        hits = np.zeros((100, 100), dtype=np.uint32)
+        hits[10, 20] = 5
+        data = {'hits': hits, 'small': np.ones(3)}
+        # Every array header records its codec; small arrays are not compressed
+        header = json.loads(json.dumps(data, cls=utils.NumpyEncoder, codec='none'))
+        self.assertEqual((header['hits']['codec'], header['small']['codec']), ('none', 'none'))
+        codecs = ['none'] + (['blosc-lz4', 'zstd', 'bitshuffle'] if compression.has_blosc else [])
+        for codec in codecs:
+            header = json.loads(json.dumps(data, cls=utils.NumpyEncoder, codec=codec))
+            self.assertEqual((header['hits']['codec'], header['small']['codec']), (codec, 'none'))
+            for decoded in (json.loads(json.dumps(data, cls=utils.NumpyEncoder, codec=codec),
+                                       object_hook=utils.json_numpy_obj_hook),
+                            utils.multipart_dec(utils.multipart_enc(data, codec=codec))):
+                self.assertTrue((decoded['hits'] == hits).all())
+                self.assertTrue((decoded['small'] == 1).all())
+            for version in (1, 2):
+                decoded, meta = utils.simple_dec(utils.simple_enc(hits, meta={'name': 'hits'},
+                                                                  codec=codec, version=version))
+                self.assertTrue((decoded == hits).all())
+        # Arrays of older versions have no codec in the header; they are
+        # compressed if blosc is installed
+        legacy_data = compression.blosc.compress(hits.tobytes(), typesize=8) if compression.has_blosc else hits.tobytes()
+        legacy = {'__ndarray__': base64.b64encode(legacy_data).decode('utf-8'),
+                  'dtype': str(hits.dtype), 'shape': list(hits.shape)}
+        self.assertTrue((utils.json_numpy_obj_hook(legacy) == hits).all())
+        # Without codec the arrays are encoded as by older versions
+        self.assertDictEqual(json.loads(json.dumps({'hits': hits}, cls=utils.NumpyEncoder))['hits'], legacy)
+        with self.assertRaises(ValueError):
+            compression.check_codec('unknown')
+
+    def test_schema(self):
+        data = {'array': np.ones((100, 101)),
+                'rec_array': np.ones((100, ), dtype=[('event_number', '<i8'),
+                                                     ('trigger_number', '<u4')]),
+                'nested': {'array': np.zeros(10, dtype=np.uint16), 'n_hits': 3},
+                'time_stamp': 1.5}
+        encoder = utils.SchemaEncoder(interval=0.2)
+        frames = encoder.encode(data)
+        self.assertEqual(len(frames), 5)  # header + values + 3 array frames
+        self.assertTrue(utils.is_schema_message(frames))
+        self.assertFalse(utils.is_schema_message(utils.multipart_enc(data)))
+        # Only the first message of a stream announces the schema
+        next_frames = encoder.encode(data)
+        self.assertGreater(len(frames[0]), len(next_frames[0]))
+        # Schema id, number of shape values and 3 + 2 + 2 shape values
+        self.assertEqual(len(next_frames[0]), len(utils.SCHEMA_PREFIX) + 8 + 7 * 8)
+        for actual_frames in (frames, next_frames):
+            data_deserialized = utils.multipart_dec(actual_frames)
+            for key in ('array', 'rec_array'):
+                self.assertTrue((data[key] == data_deserialized[key]).all())
+                self.assertEqual(data[key].dtype, data_deserialized[key].dtype)
+            self.assertTrue((data['nested']['array'] == data_deserialized['nested']['array']).all())
+            self.assertEqual(data_deserialized['nested']['n_hits'], 3)
+            self.assertEqual(data_deserialized['time_stamp'], 1.5)
+        # Receivers connecting later drop the data until the schema is send again
+        utils._schemas.clear()
+        self.assertIsNone(utils.multipart_dec(encoder.encode(data)))
+        time.sleep(0.2)
+        self.assertEqual(utils.multipart_dec(encoder.encode(data))['time_stamp'], 1.5)
+        # Another dtype is another schema
+        frames = encoder.encode({'array': np.ones(10, dtype=np.uint8)})
+        self.assertGreater(len(frames[0]), len(utils.SCHEMA_PREFIX) + 8 + 2 * 8)
+        self.assertEqual(utils.multipart_dec(frames)['array'].dtype, np.uint8)
+        # Arrays of variable length keep their schema
+        for n_hits in (3, 0, 7):
+            frames = encoder.encode({'array': np.arange(n_hits, dtype=np.uint8)})
+            self.assertEqual(len(frames[0]), len(utils.SCHEMA_PREFIX) + 8 + 2 * 8)
+            self.assertTrue((utils.multipart_dec(frames)['array'] == np.arange(n_hits)).all())
+        # Only the schemas used last are kept
+        for n_arrays in range(encoder.max_schemas + 1):
+            encoder.encode({'array_%d' % index: np.ones(1) for index in range(n_arrays)})
+        self.assertEqual(len(encoder._schemas), encoder.max_schemas)
+        frames = encoder.encode({'array': np.ones(10, dtype=np.uint8)})
+        self.assertGreater(len(frames[0]), len(utils.SCHEMA_PREFIX) + 8 + 2 * 8)  # announced again
+        self.assertLessEqual(len(utils._schemas), utils._schemas.maxsize)
+        # The dtypes of the other serializers are cached too
+        hits = utils.dtype_from_str.cache_info().hits
+        utils.multipart_dec(utils.multipart_enc(data))
+        self.assertGreater(utils.dtype_from_str.cache_info().hits, hits)
+
+    def test_lazy_message(self):
+        data = {'array': np.ones((100, 101)),
+                'unused': np.arange(1000),
+                'nested': {'array': np.zeros(10, dtype=np.uint16), 'n_hits': 3},
+                'arrays': [np.ones(3), 2],
+                'time_stamp': 1.5}
+        for received in (json.dumps(data, cls=utils.NumpyEncoder).encode('utf-8'),
+                         utils.multipart_enc(data),
+                         [zmq.Frame(frame) for frame in utils.multipart_enc(data)]):
+            message = utils.lazy_dec(received)
+            self.assertIsInstance(message, utils.LazyMessage)
+            self.assertEqual(sorted(message), sorted(data))
+            self.assertEqual(message['time_stamp'], 1.5)
+            self.assertTrue((message['array'] == data['array']).all())
+            self.assertIs(message['array'], message['array'])  # decoded once
+            self.assertTrue((message['nested']['array'] == 0).all())
+            self.assertEqual(message['nested']['n_hits'], 3)
+            self.assertTrue((message['arrays'][0] == 1).all())
+            self.assertNotIn('unused', message._decoded)  # never accessed
+            # Lazy messages can be send and pickled like dicts
+            for decoded in (utils.multipart_dec(utils.multipart_enc(message)),
+                            json.loads(json.dumps(message, cls=utils.NumpyEncoder),
+                                       object_hook=utils.json_numpy_obj_hook),
+                            utils.multipart_dec(utils.SchemaEncoder().encode(message)),
+                            pickle.loads(pickle.dumps(message))):
+                self.assertIsInstance(decoded, dict)
+                self.assertTrue((decoded['unused'] == data['unused']).all())
+                self.assertEqual(decoded['nested']['n_hits'], 3)
+        # Schema messages are decoded at once
+        self.assertIsInstance(utils.lazy_dec(utils.SchemaEncoder().encode(data)), dict)
+
+    def test_topics(self):
+        frames = utils.multipart_enc({'array': np.ones(10)})
+        self.assertEqual(utils.split_topic(frames), (frames, None))  # no topic
+        self.assertEqual(utils.split_topic([utils.topic_frame('hit_hist')] + frames),
+                         (frames, 'hit_hist'))
+        # Subscriptions are prefixes of the topic frame
+        self.assertTrue(utils.topic_frame('hit_hist').startswith(utils.topic_frame('hit')))
+
+    def test_metrics(self):
+        context = zmq.Context()
+        receiver = context.socket(zmq.SUB)
+        receiver.setsockopt_string(zmq.SUBSCRIBE, u'')
+        receiver.connect('tcp://127.0.0.1:5750')
+        node_metrics = metrics.Metrics(name='DUT', kind='forwarder', timers=('interpret', ),
+                                       address='tcp://127.0.0.1:5750')
+        node_metrics.setup_socket(context)
+        time.sleep(0.5)  # wait for the subscription
+        for _ in range(3):
+            node_metrics.count_in(100)
+            node_metrics.add_time('interpret', 1e-3)
+        node_metrics.count_out(200)
+        node_metrics.queue_depth = 5
+        node_metrics.sampling_factor = 2.5
+        node_metrics.publish()  # interval did not elapse
+        node_metrics.publish(force=True)
+        node_metrics.count_in(100)
+        node_metrics.publish(force=True)
+        first = metrics.Metrics.unpack(receiver.recv_multipart())
+        second = metrics.Metrics.unpack(receiver.recv_multipart())
+        self.assertEqual(first['name'], 'DUT')
+        self.assertEqual((first['messages_in'], first['bytes_in']), (3, 300))
+        self.assertEqual((first['messages_out'], first['bytes_out']), (1, 200))
+        self.assertEqual(first['queue_depth'], 5)
+        self.assertEqual(first['sampling_factor'], 2.5)
+        self.assertEqual(first['histograms']['interpret'].sum(), 3)
+        self.assertAlmostEqual(metrics.Metrics.quantile(first['histograms']['interpret'], 0.5), 1e-3)
+        # Published values are the changes since the last publication
+        self.assertEqual((second['messages_in'], second['messages_out']), (1, 0))
+        self.assertIsNone(metrics.Metrics.quantile(second['histograms']['interpret'], 0.5))
+        node_metrics.close()
+        receiver.close()
+        context.term()
+        # Counters and timers can be updated from several threads
+        node_metrics = metrics.Metrics(name='DUT', kind='forwarder')
+
+        def update():
+            for index in range(1000):
+                node_metrics.count_in(1)
+                node_metrics.add_time('timer %d' % (index % 10), 1e-3)
+
+        threads = [threading.Thread(target=update) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((node_metrics.messages_in, node_metrics.bytes_in), (4000, 4000))
+        self.assertEqual(len(node_metrics.timers), 10)
+        self.assertEqual(node_metrics.histograms.sum(), 4000)
+        # Addresses are taken from all sections of the configuration
+        configuration = {'converter': {'DUT0': {'kind': 'forwarder', 'metrics': 'tcp://127.0.0.1:5751'},
+                                       'DUT1': {'kind': 'forwarder'}},
+                         'receiver': {'DUT0': {'kind': 'example_receiver', 'metrics': 'tcp://127.0.0.1:5752'}}}
+        self.assertEqual(sorted(metrics.get_metrics_addresses(configuration)),
+                         ['tcp://127.0.0.1:5751', 'tcp://127.0.0.1:5752'])
+
+    def test_tracing(self):
+        frames = utils.multipart_enc({'array': np.ones(10)})
+        self.assertEqual(tracing.split_trace(frames), (frames, None))  # untraced
+        self.assertEqual(tracing.new_trace(3), {'seq': 3})  # not timed
+        trace = tracing.new_trace(3, source='DUT0')
+        tracing.stamp(trace, 'Converter', 'receive')
+        tracing.stamp(trace, 'Converter', 'send')
+        tracing.stamp(trace, 'Receiver', 'refresh')
+        frames_split, trace_split = tracing.split_trace(frames + [tracing.pack(trace)])
+        self.assertEqual(frames_split, frames)
+        self.assertEqual(trace_split, trace)
+        # Latencies of all hops and of the full path
+        node_metrics = metrics.Metrics(name='Receiver', kind='receiver')
+        tracing.record_latencies(node_metrics, trace)
+        self.assertEqual(node_metrics.timers, ('hop DUT0.send > Converter.receive',
+                                               'hop Converter.receive > Converter.send',
+                                               'hop Converter.send > Receiver.refresh',
+                                               'path DUT0 > Converter > Receiver'))
+        self.assertTrue((node_metrics.histograms.sum(axis=1) == 1).all())
+        # Gap detection per stream
+        checker = tracing.SequenceChecker()
+        self.assertEqual([checker.check('A', seq) for seq in (5, 6, 9, 10)], [0, 0, 2, 0])
+        self.assertEqual(checker.check('B', 0), 0)  # new stream
+        self.assertEqual(checker.check('A', 0), 0)  # publisher restarted
+        self.assertEqual((checker.n_received, checker.n_lost), (6, 2))
+        self.assertAlmostEqual(checker.lost_fraction, 0.25)
+
+    def test_double_buffer(self):
+        buffer = DoubleBuffer()
+        self.assertIsNone(buffer.swap())  # no data
+        for _ in range(2):
+            with buffer.write() as back:
+                back.setdefault('hist', np.zeros(3))
+                back['hist'] += 1
+        front = buffer.swap()
+        self.assertTrue((front['hist'] == 2).all())
+        self.assertIsNone(buffer.swap())  # no new data
+        with buffer.write() as back:  # accumulates on top of the front buffer
+            back['hist'] += 1
+            self.assertIsNone(buffer.swap())  # GUI thread is not blocked
+        self.assertTrue((front['hist'] == 2).all())  # front buffer unchanged
+        self.assertTrue((buffer.swap()['hist'] == 3).all())
+        buffer.clear()
+        self.assertEqual(buffer.swap(), {})
+        # Without accumulation the back buffer holds the previous data
+        buffer = DoubleBuffer(accumulate=False)
+        for value in range(3):
+            with buffer.write() as back:
+                back['value'] = value
+            self.assertEqual(buffer.swap()['value'], value)
+
     def test_simple_encoder(self):
         data = np.ones((100, 101))
         meta = {"a": 1, "b": "2"}
         data_buffer = utils.simple_enc(data, meta)
         data_des, meta_des = utils.simple_dec(data_buffer)
         self.assertTrue(np.all(data == data_des))
+        self.assertEqual(meta, {"a": 1, "b": "2"})  # not changed
+        self.assertEqual(meta_des.pop('data_meta'), {'dtype': data.dtype, 'shape': data.shape})
         self.assertTrue(meta == meta_des)
+        # Version 2 has json meta data; the meta data decodes to the same
+        data = np.arange(20, dtype=np.uint32).reshape((4, 5)).T
+        meta = {'name': 'ReadoutData', 'error': np.int64(1), 'timestamp_start': 1.5,
+                'scan_parameters': {}}
+        data_buffer = utils.simple_enc(data, meta, version=2)
+        self.assertTrue(data_buffer.startswith(utils.SIMPLE_PREFIX))
+        data_des, meta_des = utils.simple_dec(data_buffer)
+        self.assertTrue(np.all(data == data_des))
+        self.assertEqual(data.dtype, data_des.dtype)
+        legacy_data_des, legacy_meta_des = utils.simple_dec(utils.simple_enc(data, meta))
+        self.assertTrue(np.all(legacy_data_des == data_des))
+        self.assertEqual(legacy_meta_des, meta_des)
+        self.assertEqual(utils.simple_dec(zmq.Frame(bytes(data_buffer)))[1], meta_des)
+        # Meta data only
+        self.assertEqual(utils.simple_dec(utils.simple_enc(meta=meta, version=2)), (None, meta))
+        with self.assertRaises(ValueError):
+            utils.simple_enc(data, meta, version=3)
 
     def test_entity_loader(self):
         utils.load_converter('forwarder', base_class_type=Transceiver,
@@ -123,6 +400,11 @@ class TestUtils(unittest.TestCase):
                             **{'frontend': '0',
                                'kind': 'example_receiver',
                                'name': 'DUT'})
+        utils.load_receiver('example_threshold_watcher', base_class_type=HeadlessReceiver,
+                            *(),
+                            **{'frontend': '0',
+                               'kind': 'example_threshold_watcher',
+                               'name': 'DUT'})
         utils.load_producer_sim('example_producer_sim',
                                 base_class_type=producer_sim.ProducerSim,
                                 *(),
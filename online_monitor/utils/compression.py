@@ -0,0 +1,80 @@
+''' Compression codecs of the array data send by the online monitor
+
+    The codec is stored in the header of every encoded array (see
+    utils.NumpyEncoder, utils.multipart_enc, utils.simple_enc), thus the
+    receiver can always decode the data. The blosc codecs shuffle the bytes
+    (bits) according to the item size of the array dtype.
+
+    Codecs:
+        - 'none': no compression
+        - 'blosc-lz4': blosc with lz4 and byte shuffle
+        - 'zstd': blosc with zstd and byte shuffle; better compression,
+          slower
+        - 'bitshuffle': blosc with lz4 and bit shuffle; e.g. for sparse hit
+          maps with small values
+'''
+
+# Installing blosc can be troublesome under windows, thus do not requiere it
+try:
+    import blosc
+    has_blosc = True
+except ImportError:
+    has_blosc = False
+
+codecs = ('none', 'blosc-lz4', 'zstd', 'bitshuffle')
+# Arrays smaller than this size in bytes are not compressed
+MIN_SIZE = 1024
+# Maximum type size blosc can shuffle
+_MAX_TYPESIZE = 255
+
+
+def get_default_codec():
+    ''' Codec used if none is set; blosc-lz4 if blosc is installed '''
+    return 'blosc-lz4' if has_blosc else 'none'
+
+
+def check_codec(codec):
+    ''' Raise a ValueError if the codec is unknown or cannot be used '''
+    if codec not in codecs:
+        raise ValueError('Unknown codec %s, use one of %s' % (codec, ', '.join(codecs)))
+    if codec != 'none' and not has_blosc:
+        raise ValueError('Codec %s needs blosc, install it or use codec none' % codec)
+
+
+def _blosc_settings(codec):
+    ''' Compressor name and shuffle mode of a blosc codec '''
+    if codec == 'zstd':
+        return 'zstd', blosc.SHUFFLE
+    if codec == 'bitshuffle':
+        return 'lz4', blosc.BITSHUFFLE
+    return 'lz4', blosc.SHUFFLE
+
+
+def compress(data, itemsize, codec=None, threshold=MIN_SIZE):
+    ''' Compress the array buffer data with items of itemsize bytes
+
+        Returns the codec used and the compressed data. Data smaller than
+        threshold bytes is returned uncompressed with codec 'none'.
+    '''
+    if codec is None:
+        codec = get_default_codec()
+    data = memoryview(data)
+    # Byte view of the contiguous buffer; empty arrays cannot be casted
+    data = data.cast('B') if data.nbytes else memoryview(b'')
+    if codec == 'none' or data.nbytes < threshold:
+        return 'none', data
+    check_codec(codec)
+    cname, shuffle = _blosc_settings(codec)
+    typesize = itemsize if 0 < itemsize <= _MAX_TYPESIZE else 1
+    return codec, blosc.compress(data, typesize=typesize, cname=cname, shuffle=shuffle)
+
+
+def decompress(data, codec):
+    ''' Decompress data compressed with the codec '''
+    if codec == 'none':
+        return data
+    if codec not in codecs:
+        raise ValueError('Unknown codec %s' % codec)
+    if not has_blosc:
+        raise RuntimeError('Data is compressed with codec %s, install blosc to decode it' % codec)
+    return blosc.decompress(data)
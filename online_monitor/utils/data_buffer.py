@@ -0,0 +1,122 @@
+import threading
+import random
+import queue
+from collections import deque
+
+
+class DataBuffer(object):
+
+    '''Thread safe FIFO buffer with a size budget and a drop policy.
+
+    If the buffer exceeds its budget, data is dropped according to the drop
+    policy. Dropped messages are counted, not logged.
+
+    Parameter
+    ----------
+    max_items : number
+        Maximum number of buffered messages. If None no limit is applied.
+    max_bytes : number
+        Maximum size of the buffered messages in bytes. If None no limit is
+        applied.
+    drop_policy : str
+        What to do if the budget is exceeded:
+            - 'newest': drop the new message
+            - 'oldest': drop the oldest messages until the new one fits
+            - 'latest': keep only the latest message, independent of the budget
+            - 'sample': keep the new message with the probability
+              sample_fraction (dropping the oldest), otherwise drop it
+    sample_fraction : number
+        Probability to keep a message for the 'sample' drop policy
+    '''
+
+    drop_policies = ('newest', 'oldest', 'latest', 'sample')
+
+    def __init__(self, max_items=None, max_bytes=None, drop_policy='oldest',
+                 sample_fraction=0.1):
+        if drop_policy not in self.drop_policies:
+            raise ValueError('Unknown drop policy %s, use one of %s' % (drop_policy, ', '.join(self.drop_policies)))
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.drop_policy = drop_policy
+        self.sample_fraction = sample_fraction
+
+        self._items = deque()
+        self._n_signals = 0  # pending wake up signals
+        self._not_empty = threading.Condition()
+        self.n_bytes = 0  # size of buffered messages
+        self.n_received = 0  # all messages put into the buffer
+        self.n_dropped = 0  # dropped messages
+
+    def _exceeds_budget(self, n_bytes):
+        if self.max_items and len(self._items) >= self.max_items:
+            return True
+        if self.max_bytes and self._items and self.n_bytes + n_bytes > self.max_bytes:
+            return True
+        return False
+
+    def _drop_oldest(self):
+        _, n_bytes = self._items.popleft()
+        self.n_bytes -= n_bytes
+        self.n_dropped += 1
+
+    def put(self, item, n_bytes=0):
+        ''' Add a message of size n_bytes, never blocks '''
+        with self._not_empty:
+            self.n_received += 1
+            if self.drop_policy == 'latest':
+                while self._items:
+                    self._drop_oldest()
+            elif self._exceeds_budget(n_bytes):
+                if self.drop_policy == 'newest':
+                    self.n_dropped += 1
+                    return
+                if self.drop_policy == 'sample':
+                    if random.random() >= self.sample_fraction:
+                        self.n_dropped += 1
+                        return
+                    self._drop_oldest()
+                while self._items and self._exceeds_budget(n_bytes):
+                    self._drop_oldest()
+            self._items.append((item, n_bytes))
+            self.n_bytes += n_bytes
+            self._not_empty.notify()
+
+    def put_signal(self):
+        ''' Wake up a blocking get(), that returns (None, 0) then
+
+            Signals are never dropped and are returned before messages.
+        '''
+        with self._not_empty:
+            self._n_signals += 1
+            self._not_empty.notify()
+
+    def get(self, block=True, timeout=None):
+        ''' Remove and return the oldest message and its size
+
+            Raises queue.Empty if no message is available, same as
+            queue.Queue.get()
+        '''
+        with self._not_empty:
+            if block and not self._n_signals and not self._items:
+                self._not_empty.wait_for(lambda: self._n_signals or self._items, timeout)
+            if self._n_signals:
+                self._n_signals -= 1
+                return None, 0
+            if not self._items:
+                raise queue.Empty
+            item, n_bytes = self._items.popleft()
+            self.n_bytes -= n_bytes
+            return item, n_bytes
+
+    def qsize(self):
+        return len(self._items)
+
+    @property
+    def sampling_factor(self):
+        ''' Ratio of received to not dropped messages
+
+            Is 1 if no data was dropped, scale rates by this factor to correct
+            for the dropped messages
+        '''
+        n_kept = self.n_received - self.n_dropped
+        return float(self.n_received) / n_kept if n_kept else 1.
@@ -0,0 +1,86 @@
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+class DoubleBuffer(object):
+
+    '''Two dicts of arrays to hand data over between threads.
+
+    A writer thread (e.g. Receiver.process_data() in the receive thread)
+    updates the back buffer, the GUI thread takes the front buffer in
+    refresh_data() with swap(). The GUI thread is never blocked by the
+    writer: if the back buffer is written at the moment, swap() returns None
+    and the data is taken with the next refresh.
+
+    Usage:
+
+        # receive thread
+        with self.buffer.write() as back:
+            back.setdefault('hist', np.zeros(100))
+            back['hist'] += np.bincount(data['x'], minlength=100)
+
+        # GUI thread
+        front = self.buffer.swap()
+        if front:
+            self.plot.setData(front['hist'])
+
+    The front buffer is not changed until the next swap().
+
+    Parameter
+    ----------
+    accumulate : boolean
+        If True the back buffer gets a copy of the front buffer before the
+        first write after a swap, thus the arrays hold the data accumulated
+        since the start. The copy is done in the writer thread. If False
+        the writer overwrites the arrays.
+    '''
+
+    def __init__(self, accumulate=True):
+        self.accumulate = accumulate
+        self._front, self._back = {}, {}
+        self._lock = threading.Lock()
+        self._updated = False  # back buffer holds data not swapped yet
+        self._outdated = False  # back buffer misses the front buffer data
+
+    @contextmanager
+    def write(self):
+        ''' Context yielding the back buffer to write to '''
+        with self._lock:
+            if self._outdated:
+                for key, value in self._front.items():
+                    back_value = self._back.get(key)
+                    if isinstance(value, np.ndarray) and isinstance(back_value, np.ndarray) and \
+                            back_value.shape == value.shape and back_value.dtype == value.dtype:
+                        np.copyto(back_value, value)  # no new allocation
+                    else:
+                        self._back[key] = value.copy() if isinstance(value, np.ndarray) else value
+                self._outdated = False
+            yield self._back
+            self._updated = True
+
+    def swap(self):
+        ''' Returns the front buffer with the new data; None if there is no
+            new data or the back buffer is written at the moment
+        '''
+        if not self._lock.acquire(False):
+            return None
+        try:
+            if not self._updated:
+                return None
+            self._front, self._back = self._back, self._front
+            self._updated = False
+            self._outdated = self.accumulate
+            return self._front
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        ''' Remove the accumulated data, the next swap() returns an empty
+            front buffer
+        '''
+        with self._lock:
+            self._back = {}
+            self._updated = True
+            self._outdated = False
@@ -0,0 +1,247 @@
+import json
+import struct
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+import zmq
+
+
+class Metrics(object):
+
+    '''Throughput and timing statistics of a node (producer, converter,
+    receiver).
+
+    Counters are only incremented and never reset; the published values are
+    the differences to the last publication. Counters and timers are updated
+    under a lock, thus they can be updated from several threads (e.g. the
+    receive thread and interpretation threads) while another thread
+    publishes.
+
+    The statistics are published with a ZeroMQ PUB socket as three frames:
+        - json header with node name, kind and timer names
+        - fields packed as little endian doubles (see Metrics.fields)
+        - uint32 histograms of the timers (n_timers x n_bins)
+
+    Parameter
+    ----------
+    name : str
+        Name of the node
+    kind : str
+        Kind of the node (e.g. forwarder)
+    timers : iterable
+        Names of the timers to fill histograms for; further timers are added
+        on first use (e.g. trace latencies, see utils.tracing)
+    address : str
+        Address to bind the publishing socket to; if None nothing is published
+    interval : number
+        Publishing interval in seconds
+    '''
+
+    fields = ('time', 'interval', 'messages_in', 'bytes_in', 'messages_out',
+              'bytes_out', 'queue_depth', 'dropped', 'lost', 'cpu_load',
+              'sampling_factor')
+    # Upper edges of the timer histogram bins in seconds; 1 us to 10 s
+    time_bins = np.logspace(-6, 1, 29)
+
+    def __init__(self, name, kind, timers=(), address=None, interval=1.):
+        self.name = name
+        self.kind = kind
+        self.timers = tuple(timers)
+        self.address = address
+        self.interval = interval
+        self.socket = None
+
+        self.messages_in, self.bytes_in = 0, 0
+        self.messages_out, self.bytes_out = 0, 0
+        self.queue_depth, self.dropped, self.cpu_load = 0, 0, 0.
+        self.lost = 0  # messages lost in transmission (see utils.tracing)
+        # Ratio of received to kept messages (see utils.data_buffer.DataBuffer)
+        self.sampling_factor = 1.
+        self.histograms = np.zeros((len(self.timers), len(self.time_bins) + 1), dtype=np.uint32)
+        self._timer_index = dict((timer, index) for index, timer in enumerate(self.timers))
+        self._last_published = {}
+        self._last_histograms = self.histograms.copy()
+        self._last_publish_time = time.time()
+        self._lock = threading.Lock()
+
+    def setup_socket(self, context):
+        ''' Create the publishing socket, has to be called in the publishing
+            process / thread
+        '''
+        if self.address:
+            self.socket = context.socket(zmq.PUB)
+            self.socket.setsockopt(zmq.LINGER, 0)
+            self.socket.bind(self.address)
+
+    def close(self):
+        if self.socket:
+            self.socket.close()
+            self.socket = None
+
+    def count_in(self, n_bytes, n_messages=1):
+        with self._lock:
+            self.messages_in += n_messages
+            self.bytes_in += n_bytes
+
+    def count_out(self, n_bytes, n_messages=1):
+        with self._lock:
+            self.messages_out += n_messages
+            self.bytes_out += n_bytes
+
+    def add_timer(self, timer):
+        with self._lock:
+            self._add_timer(timer)
+
+    def _add_timer(self, timer):
+        if timer in self._timer_index:  # added by another thread meanwhile
+            return
+        self.histograms = np.vstack((self.histograms, np.zeros((1, self.histograms.shape[1]), dtype=np.uint32)))
+        self._timer_index[timer] = len(self.timers)
+        self.timers += (timer, )
+
+    def add_time(self, timer, seconds):
+        time_bin = np.searchsorted(self.time_bins, seconds)
+        with self._lock:
+            if timer not in self._timer_index:
+                self._add_timer(timer)
+            self.histograms[self._timer_index[timer], time_bin] += 1
+
+    @contextmanager
+    def timer(self, timer):
+        ''' Measure the execution time of a with block '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(timer, time.perf_counter() - start)
+
+    def publish(self, force=False):
+        ''' Publish the statistics if the interval elapsed '''
+        now = time.time()
+        if not self.socket or (not force and now - self._last_publish_time < self.interval):
+            return
+        values = dict(time=now, interval=now - self._last_publish_time,
+                      queue_depth=self.queue_depth, dropped=self.dropped,
+                      lost=self.lost, cpu_load=self.cpu_load,
+                      sampling_factor=self.sampling_factor)
+        with self._lock:
+            counters = dict((field, getattr(self, field))
+                            for field in ('messages_in', 'bytes_in', 'messages_out', 'bytes_out'))
+            timers = self.timers
+            histograms = self.histograms.copy()
+        for field, value in counters.items():
+            values[field] = value - self._last_published.get(field, 0)
+            self._last_published[field] = value
+        last_histograms = np.zeros_like(histograms)  # timers can be added
+        last_histograms[:len(self._last_histograms)] = self._last_histograms
+        header = json.dumps(dict(name=self.name, kind=self.kind, timers=timers))
+        try:
+            self.socket.send_multipart([header.encode('utf-8'),
+                                        struct.pack('<%dd' % len(self.fields), *[values[field] for field in self.fields]),
+                                        histograms - last_histograms], flags=zmq.NOBLOCK)
+        except zmq.Again:
+            pass
+        self._last_histograms = histograms
+        self._last_publish_time = now
+
+    @classmethod
+    def unpack(cls, frames):
+        ''' Decode published statistics to a dict '''
+        metrics = json.loads(frames[0])
+        metrics.update(zip(cls.fields, struct.unpack('<%dd' % len(cls.fields), frames[1])))
+        histograms = np.frombuffer(frames[2], dtype=np.uint32).reshape((len(metrics['timers']), -1))
+        metrics['histograms'] = dict(zip(metrics['timers'], histograms))
+        return metrics
+
+    @classmethod
+    def quantile(cls, histogram, q):
+        ''' Upper edge of the histogram bin with the q quantile; None if empty '''
+        n_entries = histogram.sum()
+        if not n_entries:
+            return None
+        index = np.searchsorted(np.cumsum(histogram), q * n_entries)
+        return cls.time_bins[min(index, len(cls.time_bins) - 1)]
+
+
+def get_metrics_addresses(configuration):
+    ''' Metrics addresses of all nodes defined in the configuration '''
+    addresses = []
+    for section in ('producer_sim', 'converter', 'receiver', 'headless_receiver'):
+        for settings in (configuration.get(section) or {}).values():
+            if settings.get('metrics'):
+                addresses.append(settings['metrics'])
+    return addresses
+
+
+class MetricsView(object):
+
+    ''' Collects the statistics published by the nodes and formats them as a
+        table for console output
+    '''
+
+    def __init__(self, addresses):
+        self.context = zmq.Context()
+        self.receiver = self.context.socket(zmq.SUB)
+        self.receiver.setsockopt_string(zmq.SUBSCRIBE, u'')
+        for address in addresses:
+            self.receiver.connect(address)
+        self.nodes = {}  # latest statistics per node
+        self._n_lines = 0
+
+    def collect(self):
+        ''' Receive all available statistics '''
+        while True:
+            try:
+                metrics = Metrics.unpack(self.receiver.recv_multipart(flags=zmq.NOBLOCK))
+            except zmq.Again:
+                break
+            self.nodes[(metrics['name'], metrics['kind'])] = metrics
+
+    def format_table(self):
+        def format_time(seconds):
+            return '-' if seconds is None else '%1.0e' % seconds
+
+        def format_timers(timers):
+            return ', '.join('%s %s/%s' % (timer, format_time(Metrics.quantile(histogram, 0.5)),
+                                           format_time(Metrics.quantile(histogram, 0.99)))
+                             for timer, histogram in timers)
+
+        lines = ['%-12s %-20s %9s %10s %9s %10s %6s %8s %8s %8s %6s  %s' % ('Node', 'Kind', 'In [1/s]', 'In [MB/s]', 'Out [1/s]',
+                                                                             'Out [MB/s]', 'Queue', 'Dropped', 'Lost', 'Sampling',
+                                                                             'CPU', 'Timer p50/p99 [s]')]
+        for (name, _), metrics in sorted(self.nodes.items()):
+            interval = metrics['interval'] or 1.
+            # Trace latencies are listed below the node
+            latencies = sorted((timer, histogram) for timer, histogram in metrics['histograms'].items()
+                               if timer.startswith(('hop ', 'path ')))
+            timers = format_timers((timer, histogram) for timer, histogram in metrics['histograms'].items()
+                                   if not timer.startswith(('hop ', 'path ')))
+            lines.append('%-12s %-20s %9.1f %10.2f %9.1f %10.2f %6d %8d %8d %8.2f %6.1f  %s' % (name, metrics['kind'],
+                                                                                         metrics['messages_in'] / interval,
+                                                                                         metrics['bytes_in'] / interval / 1e6,
+                                                                                         metrics['messages_out'] / interval,
+                                                                                         metrics['bytes_out'] / interval / 1e6,
+                                                                                         metrics['queue_depth'],
+                                                                                         metrics['dropped'],
+                                                                                         metrics['lost'],
+                                                                                         metrics['sampling_factor'],
+                                                                                         metrics['cpu_load'],
+                                                                                         timers))
+            lines.extend('    %s' % format_timers([latency]) for latency in latencies)
+        return '\n'.join(lines)
+
+    def show(self, stream):
+        ''' Collect statistics and redraw the table on a console stream '''
+        self.collect()
+        table = self.format_table()
+        if self._n_lines:  # move cursor up to overwrite the last table
+            stream.write('\x1b[%dA\x1b[J' % self._n_lines)
+        stream.write(table + '\n')
+        stream.flush()
+        self._n_lines = table.count('\n') + 1
+
+    def close(self):
+        self.receiver.close()
+        self.context.term()
@@ -4,20 +4,108 @@ import logging
 import signal
 import time
 
-from online_monitor.utils import utils
+from online_monitor.utils import utils, tracing
+from online_monitor.utils.shared_memory import ShmSocket
+from online_monitor.utils.metrics import Metrics
+
+
+class ProducerSocket(ShmSocket):
+
+    ''' Publishing socket counting the send messages for the metrics,
+        prepending the topic frame and appending the trace trailer (see
+        utils.tracing)
+
+        Large frames are send via shared memory if bound to a shm:// address
+        (see utils.shared_memory).
+    '''
+
+    # Class attributes, otherwise interpreted as socket options
+    metrics = None
+    sequence = False  # append sequence numbers
+    trace_source = None  # name of the producer if time stamps are taken
+    topic = None  # topic send in front of every message
+    _in_message = False  # a frame of the actual message was send already
+    _seq = None  # sequence number of the next message per topic
+    _n_bytes = 0  # size of the already send frames of the actual message
+
+    def send(self, data, flags=0, **kwargs):
+        if self.metrics is None and not self.sequence and self.topic is None:
+            return ShmSocket.send(self, data, flags=flags, **kwargs)
+        last_frame = not flags & zmq.SNDMORE
+        if self.topic is not None and not self._in_message:
+            self._send(utils.topic_frame(self.topic), flags | zmq.SNDMORE)
+        self._in_message = not last_frame
+        if self.sequence and last_frame:
+            # Increase the sequence number first, to see messages that
+            # cannot be send (zmq.Again) as lost
+            # Subscribers might filter topics, thus every topic has its own
+            # sequence numbers
+            if self._seq is None:
+                self._seq = {}
+            seq = self._seq.get(self.topic, 0)
+            self._seq[self.topic] = seq + 1
+            trace = tracing.new_trace(seq, source=self.trace_source)
+            self._send(data, flags | zmq.SNDMORE, **kwargs)
+            data, kwargs = tracing.pack(trace), {}
+        result = self._send(data, flags, **kwargs)
+        if self.metrics is not None and last_frame:
+            self.metrics.count_out(self._n_bytes)
+            self._n_bytes = 0
+            self.metrics.publish()
+        return result
+
+    def _send(self, data, flags, **kwargs):
+        if self.metrics is None:
+            return ShmSocket.send(self, data, flags=flags, **kwargs)
+        with self.metrics.timer('send'):
+            result = ShmSocket.send(self, data, flags=flags, **kwargs)
+        self._n_bytes += utils.get_nbytes(data)
+        return result
 
 
 class ProducerSim(multiprocessing.Process):
 
-    ''' For testing we have to generate some random data to fake a DAQ. This is done with this Producer Simulation'''
-
-    def __init__(self, backend, kind='Test', name='Undefined', loglevel='INFO', **kwarg):
+    ''' For testing we have to generate some random data to fake a DAQ. This is done with this Producer Simulation
+
+    Parameter
+    ----------
+    backend : str
+        Address to publish the data at
+    kind : str
+        String describing the kind of producer simulation
+    name : str
+        Name of the simulated DAQ/device
+    metrics : str
+        Address to publish throughput and timing statistics at (see
+        utils.metrics.Metrics). If None no statistics are published.
+    metrics_interval : number
+        Publishing interval of the statistics in seconds
+    sequence : boolean
+        Append a sequence number to every message (see utils.tracing), to
+        allow the subscribers to detect lost messages
+    trace : boolean
+        Append time stamps to every message to measure the latency along the
+        pipeline (see utils.tracing); implies sequence
+    topic : str
+        Topic frame to send in front of every message, to allow the
+        subscribers to filter. If None no topic frame is send.
+    loglevel : str
+        The verbosity level for the logging (e.g. INFO, WARNING)
+    '''
+
+    def __init__(self, backend, kind='Test', name='Undefined', metrics=None, metrics_interval=1.,
+                 sequence=False, trace=False, topic=None, loglevel='INFO', **kwarg):
         multiprocessing.Process.__init__(self)
 
         self.backend_address = backend
         self.name = name  # name of the DAQ/device
         self.kind = kind
         self.config = kwarg
+        self.sequence = sequence or trace
+        self.trace = trace
+        self.topic = topic
+        self.metrics = Metrics(name=name, kind=kind, timers=('send',),
+                               address=metrics, interval=metrics_interval)
 
         self.loglevel = loglevel
         self.exit = multiprocessing.Event()  # exit signal
@@ -31,8 +119,15 @@ class ProducerSim(multiprocessing.Process):
         # Setup ZeroMQ connetions, has to be within run; otherwise ZMQ does not work
         self.context = zmq.Context()
         # Send socket facing services (e.g. online monitor)
-        self.sender = self.context.socket(zmq.PUB)
+        self.sender = self.context.socket(zmq.PUB, socket_class=ProducerSocket)
         self.sender.bind(self.backend_address)
+        self.metrics.setup_socket(self.context)
+        if self.metrics.socket:
+            self.sender.metrics = self.metrics
+        self.sender.sequence = self.sequence
+        self.sender.topic = self.topic
+        if self.trace:
+            self.sender.trace_source = self.name
 
     def run(self):  # The receiver loop running in extra process; is called after start() method
         utils.setup_logging(self.loglevel)
@@ -42,9 +137,11 @@ class ProducerSim(multiprocessing.Process):
 
         while not self.exit.wait(0.02):
             self.send_data()
+            self.metrics.publish()
 
         # Close connections
         self.sender.close()
+        self.metrics.close()
         self.context.term()
         logging.info("Close %s producer %s at %s", self.kind, self.name, self.backend_address)
 
@@ -150,22 +150,27 @@ def get_producer_sim_path():
     return [path]
 
 
-def set_window_geometry(geometry):
+def _geometry_option(name):
+    # Main window geometry is stored without name
+    return 'geometry' if name is None else 'geometry_%s' % name
+
+
+def set_window_geometry(geometry, name=None):
     config = configparser.ConfigParser()
     config.read(_file_name)
     try:
         config.add_section('OnlineMonitor')
     except configparser.DuplicateSectionError:  # already existing
         pass
-    config.set('OnlineMonitor', 'geometry', str(geometry)[1:-1])  # store new string representation
+    config.set('OnlineMonitor', _geometry_option(name), str(geometry)[1:-1])  # store new string representation
     with open(_file_name, 'w') as f:
         config.write(f)
 
 
-def get_window_geometry():
+def get_window_geometry(name=None):
     config = configparser.ConfigParser()
     config.read(_file_name)
     try:
-        return ast.literal_eval(config.get('OnlineMonitor', 'geometry'))
+        return ast.literal_eval(config.get('OnlineMonitor', _geometry_option(name)))
     except configparser.NoOptionError:
         return (100, 100, 1024, 768)  # std. settings
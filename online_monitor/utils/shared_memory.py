@@ -0,0 +1,253 @@
+''' Shared memory transport for nodes running on the same host.
+
+    Addresses of the form shm://name[?size=bytes] select this transport. The
+    publisher copies the large frames of every message into a shared memory
+    ring buffer and sends only the small frames plus a descriptor frame via a
+    ZeroMQ ipc socket. If ipc is not supported (e.g. under windows) the
+    descriptors are send via tcp on the local host, at the port given with
+    shm://name?port=number or a port derived from the name. The subscribers copy the frames out of the ring buffer
+    and check that they were not overwritten meanwhile, otherwise the message
+    is lost. Thus the ring buffer has to be large enough to hold the messages
+    buffered by the subscribers (high water mark).
+
+    Use the multipart wire format to move the array data into the ring
+    buffer; json messages are single frames with base64 encoded arrays.
+'''
+
+import os
+import sys
+import json
+import zlib
+import logging
+import tempfile
+
+import numpy as np
+import zmq
+from multiprocessing import shared_memory, resource_tracker
+
+from online_monitor.utils import utils
+
+# Prefix identifying the descriptor frame
+SHM_MAGIC = b'\x00om.shm\x00'
+# Default size of the ring buffer in bytes
+DEFAULT_SIZE = 128 * 1024 * 1024
+# Frames smaller than this are send via the socket
+MIN_FRAME_SIZE = 1024
+# The ring buffer starts with a header holding the total number of written
+# bytes and the capacity
+HEADER_SIZE = 64
+# First port of the range the tcp fallback ports are derived in
+MIN_PORT = 49152
+# ipc endpoints are not available under windows
+has_ipc = zmq.has('ipc')
+
+
+def is_shm_address(address):
+    return address.startswith('shm://')
+
+
+def parse_address(address):
+    ''' Name, ring buffer size and tcp fallback port of a shm:// address
+
+        The port is None if not given.
+    '''
+    name, _, query = address[len('shm://'):].partition('?')
+    size, port = DEFAULT_SIZE, None
+    for option in query.split('&'):
+        key, _, value = option.partition('=')
+        if key == 'size':
+            size = int(value)
+        elif key == 'port':
+            port = int(value)
+    return name, size, port
+
+
+def get_endpoint(name, port=None):
+    ''' ZeroMQ address of the socket sending the descriptors
+
+        Without ipc support a local tcp address is used; the port is derived
+        from the name if not given.
+    '''
+    if has_ipc:
+        return 'ipc://' + os.path.join(tempfile.gettempdir(), 'online_monitor_shm_%s' % name)
+    if port is None:
+        port = MIN_PORT + zlib.crc32(name.encode('utf-8')) % (65536 - MIN_PORT)
+    return 'tcp://127.0.0.1:%d' % port
+
+
+def socket_class(address):
+    ''' ZeroMQ socket class to use for the address '''
+    return ShmSocket if is_shm_address(address) else zmq.Socket
+
+
+def _byte_view(frame):
+    # zmq.Frame, bytes or contiguous array
+    return utils.frame_buffer(frame).cast('B')
+
+
+class RingWriter(object):
+
+    ''' Writes frames into a new shared memory ring buffer '''
+
+    def __init__(self, name, size):
+        self.shm = shared_memory.SharedMemory(name='om_%s_%d' % (name, os.getpid()),
+                                              create=True, size=size + HEADER_SIZE)
+        self.capacity = size
+        self._header = np.ndarray(2, dtype=np.uint64, buffer=self.shm.buf)
+        self._header[:] = (0, size)
+
+    def write(self, view):
+        ''' Write the bytes and return their start position in the stream of
+            all written bytes
+        '''
+        total = int(self._header[0])
+        position = total % self.capacity
+        if position + view.nbytes > self.capacity:  # wrap around
+            total += self.capacity - position
+            position = 0
+        # Mark the space as used before writing to it, see RingReader
+        self._header[0] = total + view.nbytes
+        self.shm.buf[HEADER_SIZE + position:HEADER_SIZE + position + view.nbytes] = view
+        return total
+
+    def pack(self, frames):
+        ''' Move the large frames into the ring buffer and append the
+            descriptor frame
+        '''
+        inline_frames, moved_frames = [], []
+        for index, frame in enumerate(frames):
+            view = _byte_view(frame)
+            if view.nbytes < MIN_FRAME_SIZE or view.nbytes > self.capacity:
+                inline_frames.append(frame)
+            else:
+                moved_frames.append([index, self.write(view), view.nbytes])
+        if not moved_frames:
+            return frames
+        descriptor = dict(shm=self.shm.name, frames=moved_frames)
+        return inline_frames + [SHM_MAGIC + json.dumps(descriptor).encode('utf-8')]
+
+    def close(self):
+        del self._header  # release the buffer before closing
+        self.shm.close()
+        self.shm.unlink()
+
+
+class RingReader(object):
+
+    ''' Reads the frames of received messages from the ring buffer '''
+
+    def __init__(self):
+        self.shm = None
+        self.n_overwritten = 0  # messages lost since overwritten
+
+    def _attach(self, name):
+        if self.shm is not None:
+            if self.shm.name == name:
+                return
+            self.close()  # publisher restarted with a new ring buffer
+        if sys.version_info >= (3, 13):
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the publisher is allowed to remove the shared memory; the
+            # resource tracker only tracks posix shared memory
+            if os.name == 'posix':
+                resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self._header = np.ndarray(2, dtype=np.uint64, buffer=self.shm.buf)
+
+    def unpack(self, frames):
+        ''' Restore the frames moved into the ring buffer
+
+            Returns None if the ring buffer was overwritten meanwhile. Single
+            frame messages consist of the descriptor only, if their frame was
+            moved.
+        '''
+        if not frames:
+            return frames
+        view = _byte_view(frames[-1])
+        if bytes(view[:len(SHM_MAGIC)]) != SHM_MAGIC:
+            return frames
+        descriptor = json.loads(bytes(view[len(SHM_MAGIC):]))
+        self._attach(descriptor['shm'])
+        capacity = int(self._header[1])
+        frames = list(frames[:-1])
+        for index, start, n_bytes in descriptor['frames']:
+            position = HEADER_SIZE + start % capacity
+            frames.insert(index, bytes(self.shm.buf[position:position + n_bytes]))
+        # The writer marks the space before writing; thus the copied frames
+        # are valid if not marked for writing again
+        if int(self._header[0]) > min(start for _, start, _ in descriptor['frames']) + capacity:
+            self.n_overwritten += 1
+            return None
+        return frames
+
+    def close(self):
+        if self.shm is not None:
+            del self._header
+            self.shm.close()
+            self.shm = None
+
+
+class ShmSocket(zmq.Socket):
+
+    ''' ZeroMQ socket transporting large frames via shared memory if bound /
+        connected to a shm:// address
+
+        Messages are received with recv_multipart(); messages that were
+        overwritten in the ring buffer before they were received are
+        skipped.
+    '''
+
+    # Class attributes, otherwise interpreted as socket options
+    writer = None
+    reader = None
+    _frames = None  # frames of the actual message to send
+
+    def bind(self, address):
+        if is_shm_address(address):
+            name, size, port = parse_address(address)
+            self.writer = RingWriter(name, size)
+            address = get_endpoint(name, port)
+        return zmq.Socket.bind(self, address)
+
+    def connect(self, address):
+        if is_shm_address(address):
+            self.reader = RingReader()
+            name, _, port = parse_address(address)
+            address = get_endpoint(name, port)
+        return zmq.Socket.connect(self, address)
+
+    def send(self, data, flags=0, copy=True, track=False, **kwargs):
+        if self.writer is None:
+            return zmq.Socket.send(self, data, flags=flags, copy=copy, track=track, **kwargs)
+        # Collect the frames of the message, they are packed with the last one
+        if self._frames is None:
+            self._frames = []
+        self._frames.append(data)
+        if flags & zmq.SNDMORE:
+            return None
+        frames, self._frames = self.writer.pack(self._frames), None
+        for frame in frames[:-1]:
+            zmq.Socket.send(self, frame, flags=flags | zmq.SNDMORE, copy=copy, track=track)
+        return zmq.Socket.send(self, frames[-1], flags=flags, copy=copy, track=track)
+
+    def recv_multipart(self, flags=0, copy=True, track=False):
+        while True:
+            frames = zmq.Socket.recv_multipart(self, flags=flags, copy=copy, track=track)
+            if self.reader is None:
+                return frames
+            frames = self.reader.unpack(frames)
+            if frames is not None:
+                return frames
+            if self.reader.n_overwritten == 1:
+                logging.warning('Message overwritten in shared memory before '
+                                'it was received, increase the ring buffer size!')
+
+    def close(self, linger=None):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+        return zmq.Socket.close(self, linger=linger)
@@ -0,0 +1,101 @@
+''' Trace metadata to detect lost messages and to measure the latency of the
+    data along the pipeline.
+
+    A traced message has an additional last frame (trailer) holding a json
+    dict with the sequence number of the message in the stream of the
+    publisher and optionally a list of [node, event, time stamp] entries
+    that every node appends to. The trailer is split off before
+    deserialization, thus deserialize_data() and interpret_data() never see
+    it.
+
+    Time stamps are taken with time.time(); the nodes of an online monitor
+    usually run on different hosts, where monotonic clocks are not comparable.
+'''
+
+import json
+import time
+
+from online_monitor.utils import utils
+
+# Prefix identifying the trailer frame
+TRACE_MAGIC = b'\x00om.trace\x00'
+
+
+def new_trace(seq, source=None):
+    ''' Trace of a send message; time stamps are only taken if the name of
+        the source is given
+    '''
+    trace = {'seq': seq}
+    if source is not None:
+        trace['stamps'] = [[source, 'send', time.time()]]
+    return trace
+
+
+def is_timed(trace):
+    ''' True if time stamps are taken for the trace '''
+    return trace is not None and 'stamps' in trace
+
+
+def stamp(trace, node, event):
+    trace['stamps'].append([node, event, time.time()])
+
+
+def pack(trace):
+    ''' Trailer frame of the trace '''
+    return TRACE_MAGIC + json.dumps(trace).encode('utf-8')
+
+
+def split_trace(frames):
+    ''' Split the trace trailer from the received frames
+
+        Returns the remaining frames and the trace; the trace is None for
+        messages without trailer.
+    '''
+    if len(frames) < 2:
+        return frames, None
+    trailer = utils.frame_buffer(frames[-1])
+    if bytes(trailer[:len(TRACE_MAGIC)]) != TRACE_MAGIC:
+        return frames, None
+    return frames[:-1], json.loads(bytes(trailer[len(TRACE_MAGIC):]))
+
+
+def record_latencies(metrics, trace):
+    ''' Fill the latencies of all hops and of the full path of the trace into
+        the timer histograms of metrics (see utils.metrics.Metrics)
+    '''
+    stamps = trace['stamps']
+    for (node, event, time_stamp), (next_node, next_event, next_time_stamp) in zip(stamps[:-1], stamps[1:]):
+        metrics.add_time('hop %s.%s > %s.%s' % (node, event, next_node, next_event),
+                         next_time_stamp - time_stamp)
+    nodes = [node for node, event, _ in stamps if event == 'send'] + [stamps[-1][0]]
+    metrics.add_time('path %s' % ' > '.join(nodes), stamps[-1][2] - stamps[0][2])
+
+
+class SequenceChecker(object):
+
+    ''' Detects gaps in the sequence numbers of received streams and counts
+        the lost messages
+    '''
+
+    def __init__(self):
+        self.n_received = 0  # received messages with sequence number
+        self.n_lost = 0
+        self._last_seq = {}  # last sequence number per stream
+
+    def check(self, stream, seq):
+        ''' Returns the number of lost messages before this message '''
+        last_seq = self._last_seq.get(stream)
+        self._last_seq[stream] = seq
+        self.n_received += 1
+        # First message of the stream or the publisher restarted
+        if last_seq is None or seq <= last_seq:
+            return 0
+        n_lost = seq - last_seq - 1
+        self.n_lost += n_lost
+        return n_lost
+
+    @property
+    def lost_fraction(self):
+        ''' Fraction of messages lost in transmission '''
+        n_messages = self.n_received + self.n_lost
+        return float(self.n_lost) / n_messages if n_messages else 0.
@@ -8,14 +8,19 @@ import base64
 import sys
 import numpy as np
 import struct
+import time
+import zlib
 import pickle as pickle
+from functools import lru_cache
 from array import array
 from importlib.machinery import SourceFileLoader
 from importlib import import_module
 from inspect import getmembers, isclass
-from online_monitor.utils import settings
+from online_monitor.utils import settings, compression
 from matplotlib import colormaps
 from copy import copy
+from collections import OrderedDict
+from collections.abc import Mapping
 
 # Installing blosc can be troublesome under windows, thus do not requiere it
 try:
@@ -56,6 +61,10 @@ def parse_args(args):
         '--log', '-l',
         help='Logging level (e.g. DEBUG, INFO, WARNING, ERROR, CRITICAL)',
         default='INFO')
+    parser.add_argument(
+        '--metrics', '-m', action='store_true',
+        help='Show the statistics published by the nodes with a metrics '
+             'address')
     args_parsed = parser.parse_args(args)
     if not args_parsed.config_file:
         parser.error("You have to specify "
@@ -183,9 +192,21 @@ def load_receiver(importname, base_class_type, *args, **kargs):
 # from http://stackoverflow.com/questions/3488934/simplejson-and-numpy-array#
 class NumpyEncoder(json.JSONEncoder):
 
+    def __init__(self, *args, codec=None, codec_threshold=compression.MIN_SIZE, **kwargs):
+        ''' codec: compression of the arrays (see utils.compression); arrays
+            smaller than codec_threshold bytes are not compressed. If None
+            the arrays are encoded as by older versions, thus older
+            receivers can decode them: all arrays are blosc compressed if
+            blosc is installed and no codec is stored.
+        '''
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+        self.codec = codec
+        self.codec_threshold = codec_threshold
+
     def default(self, obj):
         """If input object is an ndarray it will be converted into a dict
-        holding dtype, shape and the data, base64 encoded and blosc compressed.
+        holding dtype, shape, codec (if set) and the data, compressed and
+        base64 encoded. Numpy scalars are converted to python types.
         """
         if isinstance(obj, np.ndarray):
             if obj.flags['C_CONTIGUOUS']:
@@ -194,20 +215,43 @@ class NumpyEncoder(json.JSONEncoder):
                 cont_obj = np.ascontiguousarray(obj)
                 assert(cont_obj.flags['C_CONTIGUOUS'])
                 obj_data = cont_obj.data
-            if has_blosc:
-                obj_data = blosc.compress(obj_data, typesize=8)
+            if self.codec is None:  # legacy encoding
+                if has_blosc:
+                    obj_data = blosc.compress(obj_data, typesize=8)
+                header = {}
+            else:
+                codec, obj_data = compression.compress(obj_data, obj.dtype.itemsize,
+                                                       self.codec, self.codec_threshold)
+                header = dict(codec=codec)
             data_b64 = base64.b64encode(obj_data)
             # http://stackoverflow.com/questions/24369666/typeerror-b1-is-not-json-serializable
             data_b64 = data_b64.decode('utf-8')
             return dict(__ndarray__=data_b64,
                         dtype=str(obj.dtype),
-                        shape=obj.shape)
+                        shape=obj.shape,
+                        **header)
+        if isinstance(obj, np.generic):  # numpy scalars
+            return obj.item()
+        if isinstance(obj, Mapping):  # e.g. LazyMessage
+            return dict(obj)
         return json.JSONEncoder.default(self, obj)
 
 
+@lru_cache(maxsize=1024)
+def dtype_from_str(dtype):
+    ''' Create a numpy dtype from its string representation
+
+        The dtypes are cached, since parsing the string is slow.
+    '''
+    try:
+        return np.dtype(ast.literal_eval(dtype))
+    except (ValueError, SyntaxError):  # If the array is not a recarray
+        return np.dtype(dtype)
+
+
 def json_numpy_obj_hook(dct):
     """Decodes a previously encoded numpy ndarray with proper shape and dtype.
-    And decompresses the data with blosc
+    And decompresses the data with the codec given in the header
 
     :param dct: (dict) json encoded ndarray
     :return: (ndarray) if input was an encoded ndarray
@@ -217,26 +261,387 @@ def json_numpy_obj_hook(dct):
         # http://stackoverflow.com/questions/24369666/typeerror-b1-is-not-json-serializable
         a = a.encode('utf-8')
         data = base64.b64decode(a)
-        if has_blosc:
+        if 'codec' in dct:
+            data = compression.decompress(data, dct['codec'])
+        elif has_blosc:  # data of old versions is compressed if blosc is installed
             data = blosc.decompress(data)
 
+        return np.frombuffer(data, dtype_from_str(dct['dtype'])).reshape(dct['shape'])
+
+    return dct
+
+
+class NumpyFrameEncoder(json.JSONEncoder):
+
+    def __init__(self, *args, codec='none', codec_threshold=compression.MIN_SIZE, **kwargs):
+        json.JSONEncoder.__init__(self, *args, **kwargs)
+        self.frames = []  # raw array buffers referenced in the header
+        self.codec = codec
+        self.codec_threshold = codec_threshold
+
+    def default(self, obj):
+        """If input object is an ndarray it is replaced by a dict holding
+        dtype, shape and the index of the frame the raw data is send in.
+        The array data itself is appended to the frames without copying, if
+        not compressed. Numpy scalars are converted to python types.
+        """
+        if isinstance(obj, np.ndarray):
+            obj_data = np.ascontiguousarray(obj)
+            codec, frame = compression.compress(obj_data.data, obj.dtype.itemsize,
+                                                self.codec, self.codec_threshold)
+            self.frames.append(obj_data if codec == 'none' else frame)
+            header = dict(__ndframe__=len(self.frames),
+                          dtype=str(obj.dtype),
+                          shape=obj.shape)
+            if codec != 'none':  # the header stays as before without compression
+                header['codec'] = codec
+            return header
+        if isinstance(obj, np.generic):  # numpy scalars
+            return obj.item()
+        if isinstance(obj, Mapping):  # e.g. LazyMessage
+            return dict(obj)
+        return json.JSONEncoder.default(self, obj)
+
+
+def multipart_enc(data, codec='none', codec_threshold=compression.MIN_SIZE):
+    ''' Encode data into a list of zmq frames
+
+        The first frame is a json header describing the data, all following
+        frames hold the raw array buffers. Send the frames with
+        socket.send_multipart(frames, copy=False) to avoid copying the arrays.
+        If data holds no arrays the header is identical to the json
+        serialization with utils.NumpyEncoder. Arrays are only compressed if
+        a codec is given (see utils.compression), since the compression
+        copies the data.
+    '''
+    encoder = NumpyFrameEncoder(codec=codec, codec_threshold=codec_threshold)
+    header = encoder.encode(data).encode('utf-8')
+    return [header] + encoder.frames
+
+
+def frame_buffer(frame):
+    ''' Memoryview of a received frame without copying; frames are zmq.Frame
+        if received with copy=False, bytes otherwise
+    '''
+    return memoryview(getattr(frame, 'buffer', frame))
+
+
+def unpack_frames(frames):
+    ''' Convert received zmq frames to the input of deserialize_data()
+
+        Single frame messages are returned as bytes to stay compatible with
+        custom deserializers, multipart messages as list of frames.
+    '''
+    if len(frames) == 1:
+        return bytes(frame_buffer(frames[0]))
+    return frames
+
+
+# Prefix of the topic frame send in front of the data, to not match messages
+# without topic
+TOPIC_PREFIX = b'\x00om.topic\x00'
+
+
+def topic_frame(topic):
+    ''' First frame of a message with topic, also used as ZeroMQ subscription
+
+        Subscriptions match all topics starting with the subscribed topic.
+    '''
+    return TOPIC_PREFIX + topic.encode('utf-8')
+
+
+def split_topic(frames):
+    ''' Split the topic frame from the received frames
+
+        Returns the remaining frames and the topic; the topic is None for
+        messages without topic frame.
+    '''
+    if len(frames) < 2:
+        return frames, None
+    frame = frame_buffer(frames[0])
+    if bytes(frame[:len(TOPIC_PREFIX)]) != TOPIC_PREFIX:
+        return frames, None
+    return frames[1:], bytes(frame[len(TOPIC_PREFIX):]).decode('utf-8')
+
+
+def get_nbytes(frames):
+    ''' Size in bytes of a frame (bytes, array, zmq.Frame) or list of frames '''
+    if isinstance(frames, list):
+        return sum(memoryview(frame).nbytes for frame in frames)
+    return memoryview(frames).nbytes
+
+
+def multipart_dec(frames):
+    ''' Decode a list of zmq frames encoded with multipart_enc or a
+        SchemaEncoder
+
+        The arrays are created on top of the frame buffers, thus no data is
+        copied. The arrays are read only.
+    '''
+    if is_schema_message(frames):
+        return schema_dec(frames)
+
+    def frame_hook(dct):
+        if '__ndframe__' in dct:
+            data = compression.decompress(frame_buffer(frames[dct['__ndframe__']]),
+                                          dct.get('codec', 'none'))
+            return np.frombuffer(data, dtype_from_str(dct['dtype'])).reshape(dct['shape'])
+        return json_numpy_obj_hook(dct)
+
+    return json.loads(bytes(frame_buffer(frames[0])), object_hook=frame_hook)
+
+
+# Prefix of the first frame of messages encoded with a stream schema
+SCHEMA_PREFIX = b'\x00om.schema\x00'
+
+
+class _LRUCache(OrderedDict):
+
+    ''' Dict keeping only the maxsize items used last '''
+
+    def __init__(self, maxsize):
+        OrderedDict.__init__(self)
+        self.maxsize = maxsize
+
+    def lookup(self, key):
+        ''' Returns the value of the key or None '''
         try:
-            dtype = np.dtype(ast.literal_eval(dct['dtype']))
-        except ValueError:  # If the array is not a recarray
-            dtype = dct['dtype']
+            value = self[key]
+        except KeyError:
+            return None
+        self.move_to_end(key)
+        return value
 
-        return np.frombuffer(data, dtype).reshape(dct['shape'])
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
+        while len(self) > self.maxsize:
+            self.popitem(last=False)
 
-    return dct
 
+# Compiled schemas of the received streams by schema id
+_schemas = _LRUCache(maxsize=1024)
 
-def simple_enc(data=None, meta={}):
 
-    data_buffer = array('B', [])
+def _split_arrays(data, path=()):
+    ''' Split the arrays from the other values of nested dicts
+
+        Returns the values without arrays and (key path, array) tuples.
+    '''
+    values, arrays = {}, []
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            arrays.append((path + (key, ), value))
+        elif isinstance(value, Mapping):
+            values[key], actual_arrays = _split_arrays(value, path + (key, ))
+            arrays.extend(actual_arrays)
+        else:
+            values[key] = value
+    return values, arrays
+
+
+class SchemaEncoder(object):
+
+    ''' Encodes data dicts into zmq frames without array headers
+
+        The key paths and dtypes of the arrays (the schema) are only send
+        with the first message of a new schema and again every interval
+        seconds for subscribers connecting later. Every message holds the
+        schema id, the array shapes, the json encoded values without the
+        arrays and the raw array buffers; thus arrays of variable length keep
+        their schema. Decode the frames with utils.multipart_dec; messages
+        with a schema that was not received yet are decoded to None.
+
+        interval : number
+            Time in seconds after that the schema is send again
+    '''
 
+    # Maximum number of schemas remembered, the least recently used are
+    # announced again if used again
+    max_schemas = 64
+
+    def __init__(self, interval=1.):
+        self.interval = interval
+        # (key path, dtype) tuples -> [id, json, time the schema was send last]
+        self._schemas = _LRUCache(maxsize=self.max_schemas)
+
+    def encode(self, data):
+        values, arrays = _split_arrays(data)
+        key = tuple((path, array.dtype) for path, array in arrays)
+        schema = self._schemas.lookup(key)
+        if schema is None:
+            schema_json = json.dumps({'arrays': [(path, str(array.dtype))
+                                                 for path, array in arrays]}).encode('utf-8')
+            schema = [zlib.crc32(schema_json), schema_json, None]
+            self._schemas[key] = schema
+        # Shapes as number of dimensions followed by the dimensions per array
+        shapes = []
+        for _, array in arrays:
+            shapes.append(array.ndim)
+            shapes.extend(array.shape)
+        header = SCHEMA_PREFIX + struct.pack('<II%dq' % len(shapes), schema[0], len(shapes), *shapes)
+        now = time.time()
+        if schema[2] is None or now - schema[2] >= self.interval:
+            header += schema[1]
+            schema[2] = now
+        return ([header, json.dumps(values, cls=NumpyEncoder).encode('utf-8')] +
+                [np.ascontiguousarray(array) for _, array in arrays])
+
+
+def is_schema_message(frames):
+    ''' True if the frames are encoded with a SchemaEncoder '''
+    return bytes(frame_buffer(frames[0])[:len(SCHEMA_PREFIX)]) == SCHEMA_PREFIX
+
+
+def schema_dec(frames):
+    ''' Decode frames encoded with a SchemaEncoder
+
+        Returns None if the schema of the message was not received yet.
+    '''
+    header = frame_buffer(frames[0])
+    schema_id, n_shapes = struct.unpack_from('<II', header, len(SCHEMA_PREFIX))
+    shapes = struct.unpack_from('<%dq' % n_shapes, header, len(SCHEMA_PREFIX) + 8)
+    schema_start = len(SCHEMA_PREFIX) + 8 + 8 * n_shapes
+    arrays = _schemas.lookup(schema_id)
+    if arrays is None and len(header) > schema_start:
+        schema = json.loads(bytes(header[schema_start:]))
+        arrays = [(path, dtype_from_str(dtype)) for path, dtype in schema['arrays']]
+        _schemas[schema_id] = arrays
+    if arrays is None:
+        return None
+    values = json.loads(bytes(frame_buffer(frames[1])), object_hook=json_numpy_obj_hook)
+    index = 0
+    for (path, dtype), frame in zip(arrays, frames[2:]):
+        shape = shapes[index + 1:index + 1 + shapes[index]]
+        index += 1 + shapes[index]
+        target = values
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = np.frombuffer(frame_buffer(frame), dtype).reshape(shape)
+    return values
+
+
+class LazyMessage(Mapping):
+
+    ''' Read only dict of a received message decoding values on demand
+
+        The json header is parsed on the first access and every array is
+        decoded (base64, decompression, frombuffer) when it is accessed the
+        first time. Thus messages that are dropped or only partly read are
+        cheap. Nested dicts are lazy messages too. Pickling decodes all
+        values into a std. dict, e.g. to send the message to a worker.
+
+        header : bytes
+            json encoded data (see NumpyEncoder) or header frame of a
+            multipart message (see multipart_enc)
+        frames : list
+            Frames of a multipart message
+    '''
+
+    def __init__(self, header, frames=None, values=None):
+        self._header = header
+        self._frames = frames
+        self._values = values  # parsed header
+        self._decoded = {}
+
+    def _parse(self):
+        if self._values is None:
+            self._values = json.loads(bytes(frame_buffer(self._header)))
+            self._header = None
+        return self._values
+
+    def _decode(self, value):
+        if isinstance(value, dict):
+            if '__ndframe__' in value:
+                data = compression.decompress(frame_buffer(self._frames[value['__ndframe__']]),
+                                              value.get('codec', 'none'))
+                return np.frombuffer(data, dtype_from_str(value['dtype'])).reshape(value['shape'])
+            if '__ndarray__' in value:
+                return json_numpy_obj_hook(value)
+            return LazyMessage(None, self._frames, value)
+        if isinstance(value, list):
+            return [self._decode(actual_value) for actual_value in value]
+        return value
+
+    def __getitem__(self, key):
+        try:
+            return self._decoded[key]
+        except KeyError:
+            value = self._decode(self._parse()[key])
+            self._decoded[key] = value
+            return value
+
+    def __iter__(self):
+        return iter(self._parse())
+
+    def __len__(self):
+        return len(self._parse())
+
+    def __repr__(self):
+        return 'LazyMessage(%s)' % ', '.join(repr(key) for key in self)
+
+    def to_dict(self):
+        ''' Decode all values into a std. dict '''
+        return {key: value.to_dict() if isinstance(value, LazyMessage) else value
+                for key, value in self.items()}
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(), ))
+
+
+def lazy_dec(data):
+    ''' Decode received data into a LazyMessage
+
+        Data is a list of frames for multipart messages, bytes otherwise
+        (see unpack_frames()). Messages with a schema (see SchemaEncoder)
+        have no headers to defer and are decoded at once.
+    '''
+    if isinstance(data, list):
+        if is_schema_message(data):
+            return schema_dec(data)
+        return LazyMessage(data[0], data)
+    return LazyMessage(data)
+
+
+# Prefix of messages encoded with simple_enc version 2
+SIMPLE_PREFIX = b'\x00om.simple2\x00'
+
+
+def simple_enc(data=None, meta=None, codec='none', codec_threshold=compression.MIN_SIZE, version=1):
+    ''' Encode one array and a meta data dict into one buffer
+
+        Version 1 appends the pickled meta data and its length to the data.
+        Version 2 writes a prefix, the length of the json encoded meta data,
+        the meta data and the data into one preallocated buffer; the data is
+        copied only once and no pickle is needed for decoding. simple_dec()
+        decodes both versions. The given meta data is not changed, the
+        decoded meta data holds the array description (data_meta) in
+        addition.
+    '''
+    meta = dict(meta) if meta is not None else {}
+    data_bytes = b''
     if data is not None:
-        meta['data_meta'] = {'dtype': data.dtype, 'shape': data.shape}
-        frombytes(data_buffer, data.tobytes())
+        codec, data_bytes = compression.compress(np.ascontiguousarray(data).data, data.dtype.itemsize,
+                                                 codec, codec_threshold)
+        # Version 2 meta data has to be json serializable
+        meta['data_meta'] = {'dtype': str(data.dtype) if version == 2 else data.dtype,
+                             'shape': data.shape}
+        if codec != 'none':  # the meta data stays as before without compression
+            meta['data_meta']['codec'] = codec
+
+    if version == 2:
+        meta_json = json.dumps(meta, cls=NumpyEncoder).encode('utf-8')
+        header_len = len(SIMPLE_PREFIX) + 4 + len(meta_json)
+        data_buffer = bytearray(header_len + len(data_bytes))
+        struct.pack_into('<%dsI%ds' % (len(SIMPLE_PREFIX), len(meta_json)), data_buffer, 0,
+                         SIMPLE_PREFIX, len(meta_json), meta_json)
+        memoryview(data_buffer)[header_len:] = data_bytes
+        return data_buffer
+    if version != 1:
+        raise ValueError('Unknown simple_enc version %s' % version)
+
+    data_buffer = array('B', [])
+    frombytes(data_buffer, data_bytes)
 
     meta_json = pickle.dumps(meta)
     meta_json_buffer = array('B', [])
@@ -253,16 +658,31 @@ def simple_enc(data=None, meta={}):
 
 
 def simple_dec(data_buffer):
+    ''' Decode a buffer encoded with simple_enc() of any version
 
-    len_buffer = data_buffer[-4:]
-    length = struct.unpack("I", len_buffer)[0]
-
-    meta = pickle.loads(data_buffer[-4 - length:-4])
+        Returns the array, None if no data was encoded, and the meta data.
+        Arrays of version 2 buffers are not copied and read only.
+    '''
+    data_buffer = frame_buffer(data_buffer)
+    if data_buffer[:len(SIMPLE_PREFIX)] == SIMPLE_PREFIX:
+        length = struct.unpack_from('<I', data_buffer, len(SIMPLE_PREFIX))[0]
+        header_len = len(SIMPLE_PREFIX) + 4 + length
+        meta = json.loads(bytes(data_buffer[header_len - length:header_len]),
+                          object_hook=json_numpy_obj_hook)
+        data_buffer = data_buffer[header_len:]
+        if 'data_meta' in meta:  # same types as for version 1
+            meta['data_meta']['dtype'] = dtype_from_str(meta['data_meta']['dtype'])
+            meta['data_meta']['shape'] = tuple(meta['data_meta']['shape'])
+    else:
+        length = struct.unpack("I", data_buffer[-4:])[0]
+        meta = pickle.loads(data_buffer[-4 - length:-4])
+        data_buffer = data_buffer[:-4 - length]
 
     if 'data_meta' in meta:
         dtype = meta['data_meta']['dtype']
         shape = meta['data_meta']['shape']
-        data = np.frombuffer(data_buffer[:-4 - length], dtype).reshape(shape)
+        data = compression.decompress(data_buffer, meta['data_meta'].get('codec', 'none'))
+        data = np.frombuffer(data, dtype).reshape(shape)
     else:
         data = None
 